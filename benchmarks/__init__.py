@@ -0,0 +1,13 @@
+"""
+Benchmarks of nodeshot_citysdk_synchronizers
+
+run them from the root of the repository, eg:
+
+    python -m benchmarks.slug_allocation
+"""
+import os
+import sys
+
+
+sys.path.append('%s/tests' % os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ci.settings")
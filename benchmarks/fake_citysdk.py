@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the CitySDK Tourism and Mobility APIs, keeps records in memory
+
+    * Tourism API at http://HOST:PORT/tourism/
+    * Mobility API at http://HOST:PORT/mobility/
+    * feeds registered with add_feed() or add_feed_file() at http://HOST:PORT/feeds/<name>
+
+latency (seconds, or a (min, max) range) is added to every API request;
+error_rate is the fraction of API requests rejected with 503 without being
+processed, lost_response_rate the fraction processed and then answered with 502
+(as when a proxy loses the response), which exercises the retries.
+
+usage:
+
+    python -m benchmarks.fake_citysdk [port, default 8000]
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import random
+import shutil
+import sys
+import threading
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from time import time, sleep
+from urlparse import urlparse, parse_qs
+
+import simplejson as json
+
+
+class FakeCitySdk(object):
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0,
+                 lost_response_rate=0, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lost_response_rate = lost_response_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.feeds = {}
+        self.feed_files = {}
+        self.reset()
+        self.server = ThreadingHTTPServer((host, port), RequestHandler)
+        self.server.citysdk = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server.server_address
+
+    @property
+    def tourism_url(self):
+        return '%stourism/' % self.url
+
+    @property
+    def mobility_url(self):
+        return '%smobility/' % self.url
+
+    def feed_url(self, name):
+        return '%sfeeds/%s' % (self.url, name)
+
+    def add_feed(self, name, content):
+        """ serve content (bytes) at feed_url(name) """
+        self.feeds[name] = content
+
+    def add_feed_file(self, name, path):
+        """ serve the file at path at feed_url(name), streamed, for feeds too large for memory """
+        self.feed_files[name] = path
+
+    def reset(self):
+        """ forget all the records and the statistics """
+        with self.lock:
+            self.categories = {}
+            self.pois = {}
+            self.nodes = {}
+            self.sessions = set()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        with self.lock:
+            self.requests = 0
+            self.errors = 0
+            self.durations = []
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def percentiles(self, *percents):
+        """ percentiles of the time (seconds) spent serving API requests """
+        with self.lock:
+            durations = sorted(self.durations)
+        if not durations:
+            return [None for percent in percents]
+        return [durations[min(len(durations) - 1, int(len(durations) * percent / 100.0))]
+                for percent in percents]
+
+    def delay(self):
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            latency = self.random.uniform(*latency)
+        if latency:
+            sleep(latency)
+
+    def draw(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    # --- tourism --- #
+
+    def tourism(self, method, path, query, body, cookies):
+        if path == 'auth' and method == 'POST':
+            session = uuid.uuid4().hex
+            with self.lock:
+                self.sessions.add(session)
+            return 200, {}, { 'Set-Cookie': 'ss-id=%s; path=/' % session }
+
+        if cookies.get('ss-id') not in self.sessions:
+            return 401, { 'ResponseStatus': { 'Message': 'Not authenticated' } }, None
+
+        if path == 'categories':
+            if method == 'GET':
+                return 200, { 'categories': [
+                    { 'id': category_id, 'value': value } for category_id, value in self.categories.items()
+                ] }, None
+            if method == 'PUT':
+                category_id = uuid.uuid4().hex[0:24]
+                with self.lock:
+                    self.categories[category_id] = body['category']['value']
+                return 200, category_id, None
+
+        parts = path.split('/')
+        if len(parts) != 2 or not parts[0].endswith('s'):
+            return 404, { 'message': 'not found' }, None
+        citysdk_type = parts[0][0:-1]
+
+        if parts[1] == 'search' and method == 'GET':
+            category = query.get('category')
+            name = query.get('name')
+            records = []
+            for record in self.pois.values():
+                if category and self.categories.get(record['category'][0]['id']) != category:
+                    continue
+                if name and name not in [label['value'] for label in record['label']]:
+                    continue
+                records.append(record)
+            records.sort(key=lambda record: record['id'])
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', -1))
+            records = records[offset:] if limit < 0 else records[offset:offset + limit]
+            return 200, { citysdk_type: records }, None
+
+        if parts[1] != '':
+            return 404, { 'message': 'not found' }, None
+
+        if method == 'PUT':
+            record = body[citysdk_type]
+            record['id'] = uuid.uuid4().hex[0:24]
+            with self.lock:
+                self.pois[record['id']] = record
+            return 200, { 'id': record['id'] }, None
+        if method == 'POST':
+            record = body[citysdk_type]
+            with self.lock:
+                if record.get('id') not in self.pois:
+                    return 404, { 'message': 'not found' }, None
+                self.pois[record['id']] = record
+            return 200, {}, None
+        if method == 'DELETE':
+            with self.lock:
+                if self.pois.pop(body.get('id'), None) is None:
+                    return 404, { 'message': 'not found' }, None
+            return 200, {}, None
+
+        return 405, { 'message': 'method not allowed' }, None
+
+    # --- mobility --- #
+
+    def mobility(self, method, path, query, body, headers):
+        if path == 'get_session':
+            session = uuid.uuid4().hex
+            with self.lock:
+                self.sessions.add(session)
+            return 200, { 'results': [session] }, None
+
+        session = headers.get('X-Auth')
+        if path == 'release_session':
+            with self.lock:
+                self.sessions.discard(session)
+            return 200, { 'status': 'success' }, None
+
+        if path == 'nodes' and method == 'GET':
+            nodes = [node for node in self.nodes.values() if node['layer'] == query.get('layer')]
+            return 200, { 'results': nodes[0:int(query.get('per_page', 10))] }, None
+
+        if session not in self.sessions:
+            return 401, { 'message': 'session expired' }, None
+
+        parts = path.split('/')
+        if parts[0] == 'nodes' and len(parts) == 2 and method == 'PUT':
+            layer = parts[1]
+            create_type = body['create']['params']['create_type']
+            with self.lock:
+                for node in body['nodes']:
+                    if create_type == 'create':
+                        cdk_id = '%s.%s' % (layer, node['id'].replace('-', '.'))
+                    else:
+                        cdk_id = node['cdk_id']
+                        if cdk_id not in self.nodes:
+                            return 422, { 'message': 'node %s not found' % cdk_id }, None
+                    node = dict(node, cdk_id=cdk_id, layer=layer)
+                    self.nodes[cdk_id] = node
+            return 200, { 'status': 'success' }, None
+
+        if method == 'GET' and len(parts) == 1:
+            node = self.nodes.get(parts[0])
+            if node is None:
+                return 404, { 'message': 'not found' }, None
+            return 200, { 'results': [node] }, None
+
+        if method == 'DELETE' and len(parts) == 2:
+            with self.lock:
+                if self.nodes.pop(parts[0], None) is None:
+                    return 404, { 'message': 'not found' }, None
+            return 200, { 'status': 'success' }, None
+
+        return 404, { 'message': 'not found' }, None
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def send(self, status, content, headers=None, raw=False):
+        """ send content encoded in JSON, or as it is if raw """
+        if not raw:
+            content = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream' if raw else 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_file(self, path):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+    def dispatch(self, method):
+        citysdk = self.server.citysdk
+        url = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+
+        if url.path.startswith('/feeds/'):
+            name = url.path[len('/feeds/'):]
+            if name in citysdk.feed_files:
+                return self.send_file(citysdk.feed_files[name])
+            content = citysdk.feeds.get(name)
+            if content is None:
+                return self.send(404, { 'message': 'not found' })
+            return self.send(200, content, raw=True)
+
+        start = time()
+        citysdk.delay()
+        try:
+            body = json.loads(raw_body) if raw_body else {}
+        except ValueError:
+            body = {}
+
+        # errors are not injected in authentication requests, which are not retried
+        injectable = url.path.rsplit('/', 1)[-1] not in ('auth', 'get_session', 'release_session')
+
+        if injectable and citysdk.draw(citysdk.error_rate):
+            status, content, headers = 503, { 'message': 'injected error' }, None
+        elif url.path.startswith('/tourism/'):
+            cookies = dict(
+                cookie.strip().split('=', 1) for cookie in (self.headers.get('Cookie') or '').split(';')
+                if '=' in cookie
+            )
+            status, content, headers = citysdk.tourism(method, url.path[len('/tourism/'):], query, body, cookies)
+        elif url.path.startswith('/mobility/'):
+            status, content, headers = citysdk.mobility(method, url.path[len('/mobility/'):], query, body, self.headers)
+        else:
+            status, content, headers = 404, { 'message': 'not found' }, None
+
+        # processed but the response is lost on the way back
+        if injectable and status == 200 and citysdk.draw(citysdk.lost_response_rate):
+            status, content = 502, { 'message': 'injected lost response' }
+
+        with citysdk.lock:
+            citysdk.requests += 1
+            citysdk.errors += status >= 500
+            citysdk.durations.append(time() - start)
+        self.send(status, content, headers)
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    citysdk = FakeCitySdk(port=port)
+    print('CitySDK Tourism API at %s' % citysdk.tourism_url)
+    print('CitySDK Mobility API at %s' % citysdk.mobility_url)
+    citysdk.server.serve_forever()
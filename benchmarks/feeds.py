@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Deterministic synthetic feeds in the formats read by the synchronizers:
+the same arguments always give the same feed.
+
+Each record is a function of the seed and of its index only, so feeds of
+millions of records are written to files one record at a time, without
+keeping them in memory, and the second snapshot (see SyntheticFeed.churn)
+can be generated independently of the first one.
+"""
+from __future__ import absolute_import
+
+import random
+from collections import namedtuple
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+import simplejson as json
+
+# center of the synthetic records (Rome)
+LAT = 41.9
+LNG = 12.5
+
+TYPES = ('Biblioteca', 'Scuola', 'Municipio', 'Parco', 'Museo')
+CITIES = ('Roma', 'Tivoli', 'Frascati', 'Anzio', 'Velletri')
+# names shared by the duplicate records
+COMMON_NAMES = ('largo agostino gemelli 8', 'viale di valle aurelia, 73', 'Via G. Pullino 97',
+                'Piazza del Campidoglio', 'Biblioteca comunale')
+
+# ids of the street segments are the primary keys of their nodes,
+# they start from here so that they do not clash with the nodes of the fixtures
+FIRST_STREET_ID = 1000001
+
+Record = namedtuple('Record', ['index', 'name', 'address', 'city', 'lat', 'lng', 'kind', 'velocity'])
+
+
+class SyntheticFeed(object):
+    """
+    Records of two snapshots of a feed:
+        * size: records of the first snapshot
+        * duplicate_rate: fraction of records named after one of COMMON_NAMES
+        * churn: fraction of the records of the first snapshot which, in the
+          second one, are deleted, changed or added (a third each); records
+          with a common name churn too, so the numbers appended to the names
+          of the following ones, and their slugs, might change
+    """
+    KEPT, CHANGED, DELETED, ADDED = 'kept', 'changed', 'deleted', 'added'
+
+    def __init__(self, size, duplicate_rate=0, churn=0, seed=1):
+        self.size = size
+        self.duplicate_rate = duplicate_rate
+        self.churn = churn
+        self.seed = seed
+
+    @property
+    def added_count(self):
+        return int(self.size * self.churn / 3)
+
+    def _draw(self, index):
+        """ values of record index, always drawn in the same order """
+        rand = random.Random(self.seed * 100000007 + index)
+        duplicate = rand.random() < self.duplicate_rate
+        common_name = rand.choice(COMMON_NAMES)
+        fate = rand.random()
+        lat = LAT + rand.uniform(-0.3, 0.3)
+        lng = LNG + rand.uniform(-0.3, 0.3)
+        city = rand.choice(CITIES)
+        kind = rand.choice(TYPES)
+        velocity = rand.randint(0, 90)
+        return duplicate, common_name, fate, lat, lng, city, kind, velocity
+
+    def fate(self, index):
+        """ what happens to record index in the second snapshot """
+        if index >= self.size:
+            return self.ADDED
+        fate = self._draw(index)[2]
+        if fate < self.churn / 3.0:
+            return self.DELETED
+        if fate < self.churn * 2 / 3.0:
+            return self.CHANGED
+        return self.KEPT
+
+    def record(self, index, snapshot=1):
+        """ record index in snapshot (1 or 2), None if not present """
+        duplicate, common_name, fate, lat, lng, city, kind, velocity = self._draw(index)
+        name = common_name if duplicate else u'Access point %d' % index
+        record = Record(index, name, u'Via Roma %d' % index, city, lat, lng, kind, velocity)
+        if snapshot == 1:
+            return record if index < self.size else None
+        status = self.fate(index)
+        if status == self.DELETED:
+            return None
+        if status == self.CHANGED:
+            return record._replace(address=u'%s bis' % record.address,
+                                   lat=record.lat + 0.001, velocity=(velocity + 1) % 91)
+        return record
+
+    def records(self, snapshot=1):
+        """ yields the records of snapshot (1 or 2) """
+        stop = self.size if snapshot == 1 else self.size + self.added_count
+        for index in range(stop):
+            record = self.record(index, snapshot)
+            if record is not None:
+                yield record
+
+    def nodes(self, snapshot, name=None, by_index=False, reserved=None):
+        """
+        returns {identifier: hash of the values} of the nodes a synchronizer gives
+        to the records of snapshot and {slug: index of the record} of their slugs;
+        names are made unique by the SlugAllocator of the synchronizers,
+        see expected() for the arguments
+        """
+        from nodeshot_citysdk_synchronizers.utils import SlugAllocator
+
+        allocator = SlugAllocator(reserved=reserved)
+        nodes = {}
+        slugs = {}
+        for record in self.records(snapshot):
+            node_name, slug = allocator.allocate(name(record) if name else record.name,
+                                                 pk=record.index if by_index else None)
+            slugs[slug] = record.index
+            # velocity is a measurement, not a field of the node
+            nodes[record.index if by_index else slug] = hash(record._replace(name=node_name, velocity=None))
+        return nodes, slugs
+
+    def expected(self, name=None, by_index=False):
+        """
+        counts of the nodes added, changed, deleted and unmodified by the second
+        snapshot, computed by comparing the nodes of the two snapshots:
+            * name: function which returns the name given by the synchronizer
+              to a record, the name of the record if omitted
+            * by_index: nodes are identified by the index of their record, like
+              street segments whose ids are the primary keys of the nodes,
+              instead of by slug; slugs of the nodes of the first snapshot
+              are taken while the second one is synced
+        """
+        first, slugs = self.nodes(1, name, by_index)
+        second = self.nodes(2, name, by_index, reserved=slugs if by_index else None)[0]
+
+        counts = { self.ADDED: 0, self.CHANGED: 0, self.DELETED: 0, 'unmodified': 0 }
+        for key, values in second.items():
+            old_values = first.pop(key, None)
+            if old_values is None:
+                counts[self.ADDED] += 1
+            elif old_values != values:
+                counts[self.CHANGED] += 1
+            else:
+                counts['unmodified'] += 1
+        counts[self.DELETED] = len(first)
+        return counts
+
+
+def write_provinciawifi(records, f):
+    """ ProvinciaWifi XML feed """
+    f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<ProvinciaWifi>\n')
+    for record in records:
+        f.write((
+            u'<AccessPoint><Denominazione>%s</Denominazione><Indirizzo>%s</Indirizzo>'
+            u'<Comune>%s</Comune><Latitudine>%.6f</Latitudine><longitudine>%.6f</longitudine>'
+            u'<Tipologia>%s</Tipologia></AccessPoint>\n' % (
+                escape(record.name), escape(record.address), record.city,
+                record.lat, record.lng, record.kind
+            )
+        ).encode('utf-8'))
+    f.write(b'</ProvinciaWifi>\n')
+
+
+def write_geojson_points(records, f):
+    """ GeoJSON FeatureCollection of points """
+    f.write(b'{"type": "FeatureCollection", "features": [')
+    for i, record in enumerate(records):
+        if i:
+            f.write(b', ')
+        f.write(json.dumps({
+            'type': 'Feature',
+            'geometry': { 'type': 'Point', 'coordinates': [record.lng, record.lat] },
+            'properties': {
+                'name': record.name,
+                'description': '%s %d' % (record.kind, record.index),
+                'address': '%s, %s' % (record.address, record.city)
+            }
+        }).encode('utf-8'))
+    f.write(b']}')
+
+
+def write_openwisp(records, f):
+    """ OpenWISP GeoRSS feed """
+    f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<rss version="2.0" xmlns:georss="http://www.georss.org/georss"><channel>\n'
+            b'<title>OpenWISP</title>\n')
+    for record in records:
+        f.write((
+            u'<item><title>%s</title><description>%s</description><guid>%s</guid>'
+            u'<georss:point>%.6f %.6f</georss:point>'
+            u'<created>2014-05-12T10:00:00+00:00</created><updated>2014-05-12T10:00:00+00:00</updated></item>\n' % (
+                escape(record.name), escape(u'%s, %s' % (record.address, record.city)),
+                u'00:%02x:%02x:%02x:%02x:%02x' % tuple((record.index >> shift) & 255 for shift in (32, 24, 16, 8, 0)),
+                record.lat, record.lng
+            )
+        ).encode('utf-8'))
+    f.write(b'</channel></rss>\n')
+
+
+def write_rome_streets(records, f):
+    """ Province of Rome streets GeoJSON, one street segment for each record """
+    f.write(b'{"type": "FeatureCollection", "features": [')
+    for i, record in enumerate(records):
+        if i:
+            f.write(b', ')
+        lat, lng = record.lat, record.lng
+        f.write(json.dumps({
+            'id': FIRST_STREET_ID + record.index,
+            'type': 'Feature',
+            'geometry': {
+                'type': 'LineString',
+                'coordinates': [[lng, lat], [lng + 0.0003, lat + 0.0002], [lng + 0.0005, lat + 0.0006]]
+            },
+            'properties': { 'LOCATION': record.name.upper() }
+        }).encode('utf-8'))
+    f.write(b']}')
+
+
+def write_rome_measurements(records, f):
+    """ Province of Rome measurements GeoJSON of the street segments of write_rome_streets """
+    f.write(b'{"type": "FeatureCollection", "features": [')
+    for i, record in enumerate(records):
+        if i:
+            f.write(b', ')
+        f.write(json.dumps({
+            'id': FIRST_STREET_ID + record.index,
+            'type': 'Feature',
+            'geometry': None,
+            'properties': {
+                'TIMESTAMP': '2014-05-12 10:%02d:00' % (record.index % 60),
+                'VELOCITY': record.velocity
+            }
+        }).encode('utf-8'))
+    f.write(b']}')
+
+
+def render(writer, count, seed=1, duplicate_rate=0):
+    """ returns, as bytes, the first snapshot of a feed of count records """
+    f = BytesIO()
+    writer(SyntheticFeed(count, duplicate_rate=duplicate_rate, seed=seed).records(), f)
+    return f.getvalue()
+
+
+def provinciawifi_xml(count, seed=1, duplicate_rate=0):
+    return render(write_provinciawifi, count, seed, duplicate_rate)
+
+
+def geojson_points(count, seed=1, duplicate_rate=0):
+    return render(write_geojson_points, count, seed, duplicate_rate)
+
+
+def openwisp_georss(count, seed=1, duplicate_rate=0):
+    return render(write_openwisp, count, seed, duplicate_rate)
+
+
+def rome_streets(count, seed=1, duplicate_rate=0):
+    return render(write_rome_streets, count, seed, duplicate_rate)
+
+
+def rome_measurements(count, seed=1, duplicate_rate=0):
+    return render(write_rome_measurements, count, seed, duplicate_rate)
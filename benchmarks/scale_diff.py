@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Verifies correctness and timing of the add/change/delete diff at scale:
+for each source format the first snapshot of a synthetic feed is synced
+in an empty layer, then the second snapshot (see feeds.SyntheticFeed) is
+synced in the same layer; the counts reported by the synchronizer and
+the nodes left in the DB are checked against the counts expected by the
+generator, which compares the nodes the two snapshots give, identified
+the same way the synchronizer identifies them (by slug or by primary key).
+Expected counts are computed by the parent process, so that they do not
+add to the peak memory of the sync.
+
+Feeds are written to temporary files and streamed by FakeCitySdk, so that
+snapshots of millions of records are never kept in memory by the generator.
+
+A test database is created (DATABASES of tests/ci/settings.py) and destroyed at the end;
+exits with status 1 if any count does not match.
+
+usage:
+
+    python -m benchmarks.scale_diff [--size 1000000] [--duplicate-rate 0.01] [--churn 0.1]
+                                    [--only ProvinciaWifi,ProvinceRomeTraffic,OpenWisp]
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import traceback
+from multiprocessing import Process, Queue
+from time import time
+
+from django.db import connection
+
+from . import feeds
+from .fake_citysdk import FakeCitySdk
+from .sync_throughput import test_database, prepare_layer, peak_rss_mb
+
+
+# name: (synchronizer path, {config key: feed writer}, arguments of SyntheticFeed.expected)
+CASES = [
+    ('ProvinciaWifi', 'nodeshot_citysdk_synchronizers.ProvinciaWifi',
+     { 'url': feeds.write_provinciawifi }, {}),
+    ('ProvinceRomeTraffic', 'nodeshot_citysdk_synchronizers.ProvinceRomeTraffic',
+     { 'streets_url': feeds.write_rome_streets, 'measurements_url': feeds.write_rome_measurements },
+     { 'name': lambda record: record.name.upper()[0:70], 'by_index': True }),
+    ('OpenWisp', 'nodeshot.interop.sync.synchronizers.OpenWisp',
+     { 'url': feeds.write_openwisp }, {}),
+]
+
+MESSAGE_COUNT = re.compile(r'(\d+) (?:nodes|streets) (added|changed|deleted)')
+
+
+def write_snapshots(feed, writers, directory):
+    """ writes both snapshots of each feed, returns {snapshot: {config key: path}} """
+    paths = { 1: {}, 2: {} }
+    for snapshot in (1, 2):
+        for key, writer in writers.items():
+            path = os.path.join(directory, '%s.%d' % (key, snapshot))
+            with open(path, 'wb') as f:
+                writer(feed.records(snapshot), f)
+            paths[snapshot][key] = path
+    return paths
+
+
+def sync_snapshot(layer, citysdk, paths, snapshot):
+    """ points the layer to the feeds of snapshot, syncs it and returns (seconds, message) """
+    from nodeshot.interop.sync.models import LayerExternal
+
+    external = LayerExternal.objects.get(layer=layer)
+    for key, path in paths[snapshot].items():
+        name = '%s.%d' % (key, snapshot)
+        citysdk.add_feed_file(name, path)
+        external.config[key] = citysdk.feed_url(name)
+    # streets are downloaded at most once a day
+    external.config.pop('last_time_streets_checked', None)
+    external.save()
+
+    synchronizer = LayerExternal.objects.get(layer=layer).synchronizer
+    start = time()
+    synchronizer.sync()
+    return time() - start, synchronizer.message
+
+
+def message_counts(message):
+    counts = dict((key, 0) for key in ('added', 'changed', 'deleted'))
+    for count, key in MESSAGE_COUNT.findall(message or ''):
+        counts[key] += int(count)
+    return counts
+
+
+def run_case(case, options, queue):
+    """ runs in a fresh process, so that peak memory is measured for this case only """
+    try:
+        queue.put(measure_case(case, options))
+    except Exception:
+        queue.put({ 'synchronizer': case[0], 'error': traceback.format_exc() })
+    finally:
+        connection.close()
+
+
+def synthetic_feed(options):
+    return feeds.SyntheticFeed(options.size, duplicate_rate=options.duplicate_rate,
+                               churn=options.churn, seed=options.seed)
+
+
+def measure_case(case, options):
+    from nodeshot.core.nodes.models import Node
+    from nodeshot.interop.sync.models import LayerExternal
+
+    name, path, writers = case[0:3]
+    connection.close()
+    feed = synthetic_feed(options)
+    directory = tempfile.mkdtemp(prefix='nodeshot-scale-')
+    citysdk = FakeCitySdk().start()
+    try:
+        start = time()
+        paths = write_snapshots(feed, writers, directory)
+        generation = time() - start
+
+        layer = prepare_layer()
+        external = LayerExternal.objects.get(layer=layer)
+        external.synchronizer_path = path
+        external._reload_schema()
+        external.config = { 'verify_ssl': False }
+        external.full_clean()
+        external.save()
+
+        first_elapsed, first_message = sync_snapshot(layer, citysdk, paths, 1)
+        first_nodes = Node.objects.filter(layer=layer).count()
+        second_elapsed, second_message = sync_snapshot(layer, citysdk, paths, 2)
+        second_nodes = Node.objects.filter(layer=layer).count()
+    finally:
+        citysdk.stop()
+        shutil.rmtree(directory)
+
+    return {
+        'synchronizer': name,
+        'records': options.size,
+        'generation': generation,
+        'first_sync': first_elapsed,
+        'second_sync': second_elapsed,
+        'first_message': first_message,
+        'first_nodes': first_nodes,
+        'second_nodes': second_nodes,
+        'reported': message_counts(second_message),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def check_case(result, expected, options):
+    """ returns the differences between the result of a case and the expected counts """
+    counts = result['reported']
+    errors = []
+    if result['first_nodes'] != options.size:
+        errors.append('%d nodes after the first snapshot, expected %d' % (result['first_nodes'], options.size))
+    if message_counts(result['first_message'])['added'] != options.size:
+        errors.append('first snapshot reported: %s' % result['first_message'].strip())
+    expected_nodes = options.size - expected['deleted'] + expected['added']
+    if result['second_nodes'] != expected_nodes:
+        errors.append('%d nodes after the second snapshot, expected %d' % (result['second_nodes'], expected_nodes))
+    for key in ('added', 'changed', 'deleted'):
+        if counts[key] != expected[key]:
+            errors.append('%d records %s by the second snapshot, expected %d' % (counts[key], key, expected[key]))
+    return errors
+
+
+def run(options):
+    only = [name for name in options.only.split(',') if name]
+    results = []
+    with test_database():
+        print('%-22s %9s %8s %8s %8s %12s %12s %12s %9s' % (
+            'synchronizer', 'records', 'added', 'changed', 'deleted',
+            'generation s', 'first sync s', 'second sync s', 'RSS MB'
+        ))
+        for case in CASES:
+            if only and case[0] not in only:
+                continue
+            queue = Queue()
+            process = Process(target=run_case, args=(case, options, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            results.append(result)
+            if 'error' in result:
+                print('%-22s failed:\n%s' % (result['synchronizer'], result['error']))
+                continue
+            result['expected'] = synthetic_feed(options).expected(**case[3])
+            result['errors'] = check_case(result, result['expected'], options)
+            print('%-22s %9d %8d %8d %8d %12.2f %12.2f %12.2f %9.1f' % (
+                result['synchronizer'], result['records'], result['reported']['added'],
+                result['reported']['changed'], result['reported']['deleted'],
+                result['generation'], result['first_sync'], result['second_sync'],
+                result['peak_rss_mb']
+            ))
+            for error in result['errors']:
+                print('    ERROR: %s' % error)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='add/change/delete diff at scale')
+    parser.add_argument('--size', type=int, default=1000000, help='records of the first snapshot')
+    parser.add_argument('--duplicate-rate', type=float, default=0.01,
+                        help='fraction of records sharing their name with other records')
+    parser.add_argument('--churn', type=float, default=0.1,
+                        help='fraction of records deleted, changed or added by the second snapshot')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', default='', help='comma separated names of the synchronizers to run')
+    results = run(parser.parse_args())
+    if any('error' in result or result['errors'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
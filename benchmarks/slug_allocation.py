@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the slug deduplication performed by ProvinciaWifi.save
+on 100k synthetic AccessPoints, many of which share the same name
+"""
+from __future__ import absolute_import, print_function
+
+import random
+from time import time
+
+from django.template.defaultfilters import slugify
+
+from nodeshot_citysdk_synchronizers.utils import SlugAllocator
+
+
+def generate_names(count, duplicate_rate=0.3, seed=1):
+    """ returns count AccessPoint names, duplicate_rate of which share a few common names """
+    rand = random.Random(seed)
+    common = ['largo agostino gemelli 8', 'viale di valle aurelia, 73', 'Via G. Pullino 97']
+    names = []
+    for i in range(count):
+        if rand.random() < duplicate_rate:
+            names.append(rand.choice(common))
+        else:
+            names.append('via %d, %d' % (rand.randint(0, count), rand.randint(1, 200)))
+    return names
+
+
+def legacy_allocate(names):
+    """ list based algorithm used before SlugAllocator """
+    external_nodes_slug = []
+    results = []
+    for name in names:
+        slug = slugify(name)
+        number = 1
+        original_name = name
+        while slug in external_nodes_slug:
+            number = number + 1
+            name = "%s - %d" % (original_name, number)
+            slug = slugify(name)
+        external_nodes_slug.append(slug)
+        results.append((name, slug))
+    return results
+
+
+def allocate(names):
+    allocator = SlugAllocator()
+    return [allocator.allocate(name) for name in names]
+
+
+def run(count=100000, legacy_count=2000):
+    names = generate_names(count)
+
+    start = time()
+    legacy_results = legacy_allocate(names[:legacy_count])
+    legacy_elapsed = time() - start
+
+    # both algorithms must give the same names
+    assert allocate(names[:legacy_count]) == legacy_results
+
+    start = time()
+    results = allocate(names)
+    elapsed = time() - start
+
+    assert len(set(slug for name, slug in results)) == count
+
+    print('legacy algorithm: %d AccessPoints in %.3f seconds' % (legacy_count, legacy_elapsed))
+    print('SlugAllocator:    %d AccessPoints in %.3f seconds' % (count, elapsed))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares peak memory usage (RSS) of loading the Province of Rome streets file
+with json.loads and of parsing it incrementally with iter_json_array
+
+usage:
+
+    python -m benchmarks.streets_memory [size in MB, default 500]
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import resource
+import tempfile
+from multiprocessing import Process, Queue
+
+import simplejson as json
+
+from nodeshot_citysdk_synchronizers.parsers import iter_json_array
+
+
+FEATURE = ('{"id": %d, "type": "Feature", "geometry": {"type": "LineString", "coordinates": '
+           '[[12.48378944397, 41.882369995117], [12.483909606934, 41.882068634033], '
+           '[12.483980178833, 41.881820678711]]}, "properties": {"LOCATION": "VIA DI SANTA PRISCA %d"}}')
+
+
+def generate_streets_file(path, size_mb):
+    """ writes a synthetic streets FeatureCollection of about size_mb megabytes """
+    size = size_mb * 1024 * 1024
+    written = 0
+    i = 0
+    with open(path, 'wb') as f:
+        f.write(b'{"type": "FeatureCollection", "features": [')
+        while written < size:
+            feature = (FEATURE % (i, i)).encode('utf-8')
+            if i:
+                f.write(b', ')
+            f.write(feature)
+            written += len(feature) + 2
+            i += 1
+        f.write(b']}')
+    return i
+
+
+def read_chunks(path, chunk_size=65536):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def legacy(path):
+    """ whole file in memory, then the whole object graph """
+    with open(path, 'rb') as f:
+        content = f.read()
+    return len(json.loads(content)['features'])
+
+
+def streaming(path):
+    return sum(1 for feature in iter_json_array(read_chunks(path), 'features'))
+
+
+def measure(function, path, queue):
+    count = function(path)
+    # kilobytes on linux
+    queue.put((count, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def run(size_mb=500):
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        features = generate_streets_file(path, size_mb)
+        print('synthetic streets file: %d MB, %d features' % (size_mb, features))
+        for function in (legacy, streaming):
+            # each measurement runs in a fresh process
+            queue = Queue()
+            process = Process(target=measure, args=(function, path, queue))
+            process.start()
+            count, peak_rss = queue.get()
+            process.join()
+            assert count == features
+            print('%-10s peak RSS: %d MB' % (function.__name__, peak_rss // 1024))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs each synchronizer against synthetic feeds, served together with the
+CitySDK APIs by FakeCitySdk, and reports throughput, latency percentiles
+of the CitySDK requests and peak memory; no live CitySDK instance is needed.
+
+A test database is created (DATABASES of tests/ci/settings.py) and destroyed at the end.
+
+usage:
+
+    python -m benchmarks.sync_throughput [--sizes 1000,10000,100000] [--only ProvinciaWifi,...]
+                                         [--latency SECONDS] [--error-rate RATE]
+                                         [--lost-response-rate RATE] [--json FILE]
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import resource
+import traceback
+from contextlib import contextmanager
+from multiprocessing import Process, Queue
+from time import time
+
+import simplejson as json
+from django.conf import settings
+from django.core import management
+from django.db import connection
+from django.test.runner import DiscoverRunner
+
+from . import feeds
+from .fake_citysdk import FakeCitySdk
+
+
+TOURISM_CONFIG = {
+    'citysdk_username': 'admin',
+    'citysdk_password': 'password',
+    'citysdk_category': 'Benchmark',
+    'citysdk_category_id': '',
+    'citysdk_type': 'poi',
+    'citysdk_lang': 'it-IT',
+    'citysdk_term': 'center'
+}
+
+MOBILITY_CONFIG = {
+    'citysdk_username': 'admin',
+    'citysdk_password': 'password',
+    'citysdk_layer': 'benchmark.layer'
+}
+
+# name: (synchronizer path, CitySDK API, {config key: feed generator})
+CASES = [
+    ('ProvinciaWifi', 'nodeshot_citysdk_synchronizers.ProvinciaWifi',
+     None, { 'url': feeds.provinciawifi_xml }),
+    ('ProvinciaWifiCitySdkTourism', 'nodeshot_citysdk_synchronizers.ProvinciaWifiCitySdkTourism',
+     'tourism', { 'url': feeds.provinciawifi_xml }),
+    ('ProvinciaWifiCitySdkMobility', 'nodeshot_citysdk_synchronizers.ProvinciaWifiCitySdkMobility',
+     'mobility', { 'url': feeds.provinciawifi_xml }),
+    ('GeoJsonCitySdkTourism', 'nodeshot_citysdk_synchronizers.GeoJsonCitySdkTourism',
+     'tourism', { 'url': feeds.geojson_points }),
+    ('GeoJsonCitySdkMobility', 'nodeshot_citysdk_synchronizers.GeoJsonCitySdkMobility',
+     'mobility', { 'url': feeds.geojson_points }),
+    ('OpenWispCitySdkTourism', 'nodeshot_citysdk_synchronizers.OpenWispCitySdkTourism',
+     'tourism', { 'url': feeds.openwisp_georss }),
+    ('ProvinceRomeTraffic', 'nodeshot_citysdk_synchronizers.ProvinceRomeTraffic',
+     None, { 'streets_url': feeds.rome_streets, 'measurements_url': feeds.rome_measurements }),
+]
+
+
+def peak_rss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@contextmanager
+def test_database():
+    """ creates the test database with the fixtures of the tests, destroys it at the end """
+    # queries are not logged, it would skew time and memory
+    settings.DEBUG = False
+
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        from nodeshot.core.base.tests import user_fixtures
+        management.call_command('loaddata', 'initial_data.json', user_fixtures,
+                                'test_layers.json', 'test_status.json', verbosity=0)
+        # the cases run in child processes, which open their own connections
+        connection.close()
+        yield
+    finally:
+        runner.teardown_databases(old_config)
+
+
+def prepare_layer():
+    """ the external layer used by every case, emptied without pushing anything """
+    from nodeshot.core.layers.models import Layer
+    from nodeshot.core.nodes.models import Node
+    from nodeshot.interop.sync.models import LayerExternal
+
+    layer = Layer.objects.external()[0]
+    layer.minimum_distance = 0
+    layer.area = 'POINT (12.0 42.0)'
+    layer.new_nodes_allowed = False
+    layer.save()
+
+    external, created = LayerExternal.objects.get_or_create(layer=layer)
+    external.synchronizer_path = 'None'
+    external.config = {}
+    external.save()
+    Node.objects.filter(layer=layer).delete()
+    return Layer.objects.get(pk=layer.pk)
+
+
+def run_case(case, count, options, queue):
+    """ runs in a fresh process, so that peak memory is measured for this case only """
+    try:
+        queue.put(measure_case(case, count, options))
+    except Exception:
+        queue.put({ 'synchronizer': case[0], 'records': count, 'error': traceback.format_exc() })
+    finally:
+        connection.close()
+
+
+def measure_case(case, count, options):
+    from nodeshot.core.nodes.models import Node
+    from nodeshot.interop.sync.models import LayerExternal
+
+    name, path, api, generators = case
+    connection.close()
+    layer = prepare_layer()
+
+    citysdk = FakeCitySdk(latency=options.latency,
+                          error_rate=options.error_rate,
+                          lost_response_rate=options.lost_response_rate).start()
+    config = { 'verify_ssl': False }
+    for key, generator in generators.items():
+        citysdk.add_feed(key, generator(count))
+        config[key] = citysdk.feed_url(key)
+    if api == 'tourism':
+        config.update(TOURISM_CONFIG, citysdk_url=citysdk.tourism_url)
+    elif api == 'mobility':
+        config.update(MOBILITY_CONFIG, citysdk_url=citysdk.mobility_url)
+
+    external = LayerExternal.objects.get(layer=layer)
+    external.synchronizer_path = path
+    external._reload_schema()
+    external.config = config
+    external.full_clean()
+    external.save()
+    # requests performed while configuring the layer are not measured
+    citysdk.reset_statistics()
+
+    synchronizer = LayerExternal.objects.get(layer=layer).synchronizer
+    rss = peak_rss_mb()
+    start = time()
+    synchronizer.sync()
+    elapsed = time() - start
+
+    citysdk.stop()
+
+    p50, p95, p99 = citysdk.percentiles(50, 95, 99)
+    remote = { 'tourism': len(citysdk.pois), 'mobility': len(citysdk.nodes) }.get(api)
+    return {
+        'synchronizer': name,
+        'records': count,
+        'elapsed': elapsed,
+        'throughput': count / elapsed,
+        'local_nodes': Node.objects.filter(layer=layer).count(),
+        'remote_records': remote,
+        'requests': citysdk.requests,
+        'errors': citysdk.errors,
+        'latency_p50': p50,
+        'latency_p95': p95,
+        'latency_p99': p99,
+        'peak_rss_mb': peak_rss_mb(),
+        'rss_increase_mb': peak_rss_mb() - rss,
+        'metrics': getattr(synchronizer, 'metrics_report', None)
+    }
+
+
+def milliseconds(value):
+    return '-' if value is None else '%.1f' % (value * 1000)
+
+
+def run(sizes, only=None, options=None):
+    results = []
+    with test_database():
+        print('%-30s %8s %9s %10s %8s %8s %9s %9s %9s %9s' % (
+            'synchronizer', 'records', 'seconds', 'records/s', 'requests',
+            'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'RSS MB'
+        ))
+        for case in CASES:
+            if only and case[0] not in only:
+                continue
+            for count in sizes:
+                queue = Queue()
+                process = Process(target=run_case, args=(case, count, options, queue))
+                process.start()
+                result = queue.get()
+                process.join()
+                results.append(result)
+                if 'error' in result:
+                    print('%-30s %8d failed:\n%s' % (result['synchronizer'], result['records'], result['error']))
+                    continue
+                print('%-30s %8d %9.2f %10.1f %8d %8d %9s %9s %9s %9.1f' % (
+                    result['synchronizer'], result['records'], result['elapsed'],
+                    result['throughput'], result['requests'], result['errors'],
+                    milliseconds(result['latency_p50']), milliseconds(result['latency_p95']),
+                    milliseconds(result['latency_p99']), result['peak_rss_mb']
+                ))
+                if result['remote_records'] is not None and result['remote_records'] != result['local_nodes']:
+                    print('    WARNING: %d local nodes, %d records on CitySDK' % (
+                        result['local_nodes'], result['remote_records']
+                    ))
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=4)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nodeshot_citysdk_synchronizers benchmarks')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated numbers of records of the synthetic feeds')
+    parser.add_argument('--only', default='', help='comma separated names of the synchronizers to run')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each CitySDK request')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of CitySDK requests rejected with 503')
+    parser.add_argument('--lost-response-rate', type=float, default=0,
+                        help='fraction of CitySDK requests processed and answered with 502')
+    parser.add_argument('--json', help='write the results, including the metrics of each run, to this file')
+    options = parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(',')]
+    only = [name for name in options.only.split(',') if name]
+    run(sizes, only, options)
+
+
+if __name__ == '__main__':
+    main()
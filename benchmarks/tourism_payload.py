@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the serialization of the records sent to the CitySDK Tourism API:
+nested dictionary built and serialized for each node vs TourismPayloadBuilder
+"""
+from __future__ import absolute_import, print_function
+
+from time import time
+
+import simplejson as json
+
+from nodeshot_citysdk_synchronizers.payloads import TourismPayloadBuilder
+
+
+CONFIG = {
+    'citysdk_type': 'poi',
+    'citysdk_term': 'center',
+    'citysdk_lang': 'it-IT',
+    'citysdk_category_id': '52b0a1e9e4b0e0e0d0a1b2c3',
+    'citysdk_resource_url': 'http://citysdk.example.com/citysdk/pois/',
+    'organization': 'Provincia di Roma'
+}
+
+
+def generate_nodes(count):
+    """ returns count tuples (lat, lng, name, address, description, created) """
+    return [
+        (41.9 + i * 1e-6, 12.4 + i * 1e-6, u'Via Roma %d' % i, u'Via Roma %d, Roma' % i,
+         u'Indirizzo: Via Roma %d, Roma; Tipologia: Biblioteca' % i, u'2014-05-12 10:00:00+00:00')
+        for i in range(count)
+    ]
+
+
+def legacy_serialize(node):
+    """ nested dictionary built for each node, as convert_format used to do """
+    lat, lng, name, address, description, created = node
+    return json.dumps({
+        CONFIG['citysdk_type'] :{
+            "location":{
+                "point":[
+                    {
+                        "Point":{
+                            "posList":"%s %s" % (float(lat), float(lng)),
+                            "srsName":"http://www.opengis.net/def/crs/EPSG/0/4326"
+                        },
+                        "term": CONFIG['citysdk_term']
+                    }
+                ],
+                "address": {
+                    "value":"""BEGIN:VCARD
+N:;%s;;;;
+ADR;INTL;PARCEL;WORK:;;%s;
+END:VCARD""" % (name, address),
+                    "type": "text/vcard"
+                },
+            },
+            "label":[{ "term": "primary", "value": name }],
+            "description":[{ "value": description, "lang": CONFIG['citysdk_lang'] }],
+            "category":[{ "id": CONFIG['citysdk_category_id'] }],
+            "base": CONFIG['citysdk_resource_url'],
+            "lang": CONFIG['citysdk_lang'],
+            "created": created,
+            "author":{ "term": "primary", "value": CONFIG['organization'] },
+            "license":{ "term": "primary", "value": "open-data" }
+        }
+    })
+
+
+def run(count=100000):
+    nodes = generate_nodes(count)
+    builder = TourismPayloadBuilder(CONFIG['citysdk_type'],
+                                    CONFIG['citysdk_term'],
+                                    CONFIG['citysdk_lang'],
+                                    CONFIG['citysdk_category_id'],
+                                    CONFIG['citysdk_resource_url'],
+                                    CONFIG['organization'])
+
+    def build(node):
+        lat, lng, name, address, description, created = node
+        return builder.build(lat, lng, name, 'ADR;INTL;PARCEL;WORK:;;%s;' % address, description, created)
+
+    # both must give the same records
+    assert json.loads(build(nodes[0])) == json.loads(legacy_serialize(nodes[0]))
+
+    start = time()
+    for node in nodes:
+        legacy_serialize(node)
+    legacy_elapsed = time() - start
+
+    start = time()
+    for node in nodes:
+        build(node)
+    elapsed = time() - start
+
+    print('nested dictionary:     %.2f microseconds per node' % (legacy_elapsed / count * 1e6))
+    print('TourismPayloadBuilder: %.2f microseconds per node' % (elapsed / count * 1e6))
+
+
+if __name__ == '__main__':
+    run()
@@ -1,19 +1,32 @@
 from __future__ import absolute_import
 
-import requests
 import simplejson as json
+from collections import OrderedDict
+from time import time
 
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
 from django.utils.translation import ugettext_lazy as _
 
 from nodeshot.interop.sync.synchronizers.base import BaseSynchronizer, GenericGisSynchronizer
 from nodeshot.interop.sync.models import NodeExternal
 
+from .outbound import OutboundQueueMixin
+from .client import CitySdkClient, CitySdkError, make_response
+from .metrics import SyncMetricsMixin, get_run_metrics, timed
+from .ratelimit import get_rate_limiter, release_rate_limiter
+from .utils import loaded_external, pushes_run_in_sync_process
+
 from celery.utils.log import get_logger
 logger = get_logger(__name__)
 
+# nodes waiting to be sent in bulk, keyed by layer primary key and then by
+# create type and node primary key; a layer is present only while one of
+# its imports is running in this process, pushes performed by other processes
+# (celery workers) are not queued, see pushes_run_in_sync_process()
+_bulk_queues = {}
+
 
-class CitySdkMobilityMixin(object):
+class CitySdkMobilityMixin(OutboundQueueMixin):
     """
     CitySdkMobility synchronizer mixin
     Provides methods to perform following operations:
@@ -54,8 +67,48 @@ class CitySdkMobilityMixin(object):
                 'help_text': _('Layer name on CitySDK Mobility API')
             }
         },
+        {
+            'name': 'citysdk_bulk_size',
+            'class': 'IntegerField',
+            'kwargs': {
+                'default': 0,
+                'help_text': _('During imports send up to this number of nodes in each request, '
+                               '0 sends one node at a time; needs CELERY_ALWAYS_EAGER')
+            }
+        },
+        {
+            'name': 'citysdk_rate_limit',
+            'class': 'FloatField',
+            'kwargs': {
+                'default': 0,
+                'help_text': _('Maximum requests per second sent to this CitySDK instance by all its layers, '
+                               '0 means no limit; the rate is lowered automatically when the server is overloaded')
+            }
+        },
+        {
+            'name': 'citysdk_rate_burst',
+            'class': 'IntegerField',
+            'kwargs': {
+                'default': 0,
+                'help_text': _('Maximum requests sent in a burst, 0 means equal to the rate limit')
+            }
+        },
+        {
+            'name': 'citysdk_outbound_queue',
+            'class': 'BooleanField',
+            'kwargs': {
+                'default': False,
+                'help_text': _('Store changes in a persistent queue which is pushed to CitySDK '
+                               'by a background task instead of pushing them immediately')
+            }
+        },
     ]
 
+    # session tokens expire 1 minute after the last request,
+    # a new one is requested a bit earlier to avoid racing the server
+    session_ttl = 60
+    session_refresh_margin = 10
+
     def __init__(self, *args, **kwargs):
         super(CitySdkMobilityMixin, self).__init__(*args, **kwargs)
         self._init_config()
@@ -71,6 +124,102 @@ class CitySdkMobilityMixin(object):
             self.citysdk_url = citysdk_url
         else:
             self.citysdk_url = '%s/' % citysdk_url
+        self.bulk_size = int(self.config.get('citysdk_bulk_size') or 0)
+
+    @property
+    def _http_key(self):
+        return ('citysdk_mobility', self.layer.pk)
+
+    @property
+    def rate_limiter(self):
+        """ rate limiter shared by the layers which use the same CitySDK instance, if enabled """
+        rate = float(self.config.get('citysdk_rate_limit') or 0)
+        if not rate:
+            return None
+        return get_rate_limiter(self.config['citysdk_url'], rate,
+                                int(self.config.get('citysdk_rate_burst') or 0),
+                                owner=self.layer.pk)
+
+    def release_disabled_rate_limit(self):
+        """ a disabled limit must not throttle the other layers which use the same CitySDK instance """
+        if not float(self.config.get('citysdk_rate_limit') or 0):
+            release_rate_limiter(self.config['citysdk_url'], self.layer.pk)
+
+    @property
+    def client(self):
+        """ CitySDK client which uses the pooled HTTP session of this layer, built once """
+        client = getattr(self, '_client', None)
+        if client is None:
+            client = self._client = CitySdkClient(self._http_key,
+                                                  verify=self.verify_ssl,
+                                                  headers={ 'Content-type': 'application/json' },
+                                                  reauthenticate=self._reauthenticate,
+                                                  limiter=self.rate_limiter)
+        # metrics are collected for each sync run
+        client.metrics = get_run_metrics(self.layer)
+        return client
+
+    @property
+    def http(self):
+        """ pooled HTTP session shared by every request performed for this layer """
+        return self.client.http
+
+    def sync(self, *args, **kwargs):
+        """
+        in bulk mode nodes are queued only while the import is running:
+        the queue is removed, and the session token released, even if the import fails
+        """
+        queue_created = (self.bulk_size and pushes_run_in_sync_process() and
+                         self.layer.pk not in _bulk_queues)
+        if queue_created:
+            _bulk_queues[self.layer.pk] = { 'create': OrderedDict(), 'update': OrderedDict() }
+        try:
+            return super(CitySdkMobilityMixin, self).sync(*args, **kwargs)
+        finally:
+            if queue_created:
+                queue = _bulk_queues.pop(self.layer.pk)
+                unsent = len(queue['create']) + len(queue['update'])
+                if unsent:
+                    logger.error('%d nodes of layer "%s" queued in bulk mode have not been '
+                                 'sent to CitySDK, the import did not complete' % (unsent, self.layer))
+            self.end_session()
+
+    def before_start(self, *args, **kwargs):
+        """
+        before the import starts open a fresh pool of connections
+        and get the session token which will be used for the whole run
+        """
+        super(CitySdkMobilityMixin, self).before_start(*args, **kwargs)
+        self.client.close()
+        self.authenticate(force_http_request=True)
+        if self.bulk_size and not pushes_run_in_sync_process():
+            logger.warning('bulk mode needs CELERY_ALWAYS_EAGER, nodes of layer "%s" '
+                           'are sent one at a time by the celery workers' % self.layer)
+
+    def after_complete(self, *args, **kwargs):
+        """ send queued nodes """
+        super(CitySdkMobilityMixin, self).after_complete(*args, **kwargs)
+        self.flush()
+
+    def end_session(self):
+        """ release session token and close pooled connections """
+        try:
+            session = self.http.headers.get('X-Auth')
+            if session is not None:
+                self.release_session(session)
+        except Exception as e:
+            # must not hide the error which stopped the import, if any
+            logger.warning('could not release CitySDK session token: %s' % e)
+        finally:
+            self.client.close()
+
+    def after_external_layer_saved(self, layer_config=None):
+        """
+        Method that will be called after the external layer has been saved
+        """
+        if layer_config:
+            self.config = layer_config
+        self.release_disabled_rate_limit()
 
     def clean(self):
         """
@@ -81,10 +230,29 @@ class CitySdkMobilityMixin(object):
         session = self.get_session()
         self.release_session(session)
 
+    def authenticate(self, force_http_request=False):
+        """
+        ensure a valid session token is attached to the pooled HTTP session
+        and return it; the token is reused as long as it is not about to expire
+        """
+        http = self.http
+        session = http.headers.get('X-Auth')
+        # if force_http_request is True get a new token anyway
+        if force_http_request is False and session is not None:
+            idle = time() - (http.last_request_at or 0)
+            if idle < self.session_ttl - self.session_refresh_margin:
+                return session
+        return self.get_session()
+
     def get_session(self):
-        """ authenticate into the CitySDK Mobility API and return session token """
+        """
+        authenticate into the CitySDK Mobility API and return session token;
+        the token is also attached to the pooled HTTP session as X-Auth header
+        """
         self.verbose('Authenticating to CitySDK')
         logger.info('== Authenticating to CitySDK ==')
+        # do not send an expired token along with the authentication request
+        self.http.headers.pop('X-Auth', None)
 
         authentication_url = '%sget_session?e=%s&p=%s' % (
             self.citysdk_url,
@@ -93,10 +261,7 @@ class CitySdkMobilityMixin(object):
         )
 
         try:
-            response = requests.get(
-                authentication_url,
-                verify=self.verify_ssl
-            )
+            response = self.http.get(authentication_url)
         except Exception as e:
             message = 'API Authentication Error: "%s"' % e
             logger.error(message)
@@ -113,25 +278,50 @@ class CitySdkMobilityMixin(object):
         # store session token
         # will be valid for 1 minute after each request
         session = json.loads(response.content)['results'][0]
+        self.http.headers['X-Auth'] = session
 
         return session
 
     def release_session(self, session):
         release_url = '%srelease_session' % self.citysdk_url
-        response = requests.get(
-            release_url,
-            verify=self.verify_ssl,
-            headers={ 'Content-type': 'application/json', 'X-Auth': session }
-        )
+        response = self.http.get(release_url, headers={ 'X-Auth': session })
+        # token is not valid anymore
+        if self.http.headers.get('X-Auth') == session:
+            self.http.headers.pop('X-Auth')
 
         if response.status_code == 200:
             return True
         else:
             return False
 
-    def convert_format(self, node, create_type="create"):
-        """ Prepares the JSON that will be sent to the CitySDK API """
-        data = node.data or {}
+    def _reauthenticate(self):
+        """ called by the client when the session token has been rejected """
+        logger.info('== CitySDK session token rejected, authenticating again ==')
+        self.authenticate(force_http_request=True)
+
+    def _request(self, method, url, **kwargs):
+        """
+        perform a request with the current session token;
+        if the token has been rejected the client authenticates again and retries once
+        """
+        return self.client.request(method, url, **kwargs)
+
+    @property
+    def citysdk_api_url(self):
+        return '%snodes/%s' % (self.citysdk_url, self.config['citysdk_layer'])
+
+    def get_external_id(self, node):
+        """ returns the cdk_id which CitySDK assigns to a newly created node """
+        return '{layer}.{slug}'.format(
+            layer=self.config['citysdk_layer'],
+            slug=node.slug.replace('-', '.')
+        )
+
+    def convert_node(self, node, create_type="create"):
+        """ Prepares the JSON representation of a single node """
+        data = dict(node.data or {})
+        # used internally to detect changes of the external records
+        data.pop('fingerprint', None)
 
         if node.status: data['status'] = node.status.slug
         if node.description: data['description'] = node.description
@@ -140,95 +330,194 @@ class CitySdkMobilityMixin(object):
         if node.user: data['owner'] = node.user.get_full_name()
 
         result = {
+            "name": node.name,
+            "geom" : json.loads(node.geometry.json),
+            "data" : data
+        }
+
+        if create_type == "create":
+            result['id'] = node.slug
+        elif create_type == "update":
+            result['cdk_id'] = node.external.external_id
+
+        return result
+
+    def convert_format(self, node, create_type="create"):
+        """ Prepares the JSON that will be sent to the CitySDK API """
+        return self.convert_nodes([node], create_type)
+
+    def convert_nodes(self, nodes, create_type="create"):
+        """ Prepares the JSON that will be sent to the CitySDK API for a list of nodes """
+        return {
             "create": {
                 "params": {
                     "create_type": create_type,
                     "srid": 4326
                 }
             },
-            "nodes": [
-                {
-                    "name": node.name,
-                    "geom" : json.loads(node.geometry.json),
-                    "data" : data
-                }
-            ]
+            "nodes": [self.convert_node(node, create_type) for node in nodes]
         }
 
-        if create_type == "create":
-            result['nodes'][0]['id'] = node.slug
-        elif create_type == "update":
-            result['nodes'][0]['cdk_id'] = node.external.external_id
+    def _enqueue(self, node, create_type):
+        """
+        queue node if an import of this layer in bulk mode is running
+        and send the queue when it is full; returns False otherwise
+        """
+        queue = _bulk_queues.get(self.layer.pk)
+        if queue is None:
+            return False
+        # a node saved more than once during the import is sent once, with its last values
+        if node.pk in queue['create']:
+            create_type = 'create'
+        elif create_type == 'create':
+            queue['update'].pop(node.pk, None)
+        queue[create_type][node.pk] = node
+        if len(queue[create_type]) >= self.bulk_size:
+            self.flush(create_type)
+        return True
 
-        return result
+    @timed('flush')
+    def flush(self, *create_types):
+        """ send the nodes queued in bulk mode (all the queues if no create_type is given) """
+        queue = _bulk_queues.get(self.layer.pk)
+        if not queue:
+            return
+
+        for create_type in create_types or ('create', 'update'):
+            nodes = list(queue[create_type].values())
+            queue[create_type] = OrderedDict()
+            if not nodes:
+                continue
+            self.authenticate()
+            size = self.bulk_size or len(nodes)
+            sent_nodes = []
+            for i in range(0, len(nodes), size):
+                sent_nodes += self._send_bulk(nodes[i:i + size], create_type)
+
+            if create_type == 'create':
+                NodeExternal.objects.bulk_create([
+                    NodeExternal(node=node, external_id=self.get_external_id(node))
+                    for node in sent_nodes
+                ])
+
+            for node in sent_nodes:
+                if create_type == 'create':
+                    message = 'New record "%s" saved in CitySDK through the HTTP API"' % node.name
+                else:
+                    message = 'Updated record "%s" through the CitySDK HTTP API' % node.name
+                self.verbose(message)
+                logger.info(message)
+
+            message = '%d of %d records sent to CitySDK in bulk (%s)' % (len(sent_nodes), len(nodes), create_type)
+            self.verbose(message)
+            logger.info(message)
 
+    def _find_added(self, nodes):
+        """
+        returns a successful response if all the nodes are present on CitySDK
+        (they have been created by a request which failed), None otherwise
+        """
+        for node in nodes:
+            node_url = '%s%s' % (self.citysdk_url, self.get_external_id(node))
+            if self.client.request('GET', node_url).status_code != 200:
+                return None
+        logger.info('%d records had been created by a request which failed' % len(nodes))
+        return make_response(b'{}')
+
+    def _send_bulk(self, nodes, create_type):
+        """
+        send a list of nodes in a single request and return the nodes which have been saved;
+        when the request is rejected the list is split in two halves which are sent separately
+        until the nodes which caused the error are found
+        """
+        citysdk_record = self.convert_nodes(nodes, create_type)
+        if create_type == 'create':
+            response = self._request('PUT', self.citysdk_api_url, data=json.dumps(citysdk_record),
+                                     operation='add', retry_check=lambda: self._find_added(nodes))
+        else:
+            response = self._request('PUT', self.citysdk_api_url, data=json.dumps(citysdk_record),
+                                     operation='change')
+
+        if response.status_code == 200:
+            return list(nodes)
+
+        # server side errors are not caused by the data we sent, do not split
+        if len(nodes) == 1 or response.status_code >= 500:
+            for node in nodes:
+                message = 'ERROR while sending "%s" (%s) to CitySDK API. Response: %s' % (
+                    node.name, create_type, response.content
+                )
+                logger.error(message)
+            return []
+
+        half = len(nodes) // 2
+        return self._send_bulk(nodes[:half], create_type) + self._send_bulk(nodes[half:], create_type)
+
+    @timed('add')
     def add(self, node, authenticate=True):
         """ Add a new record into CitySDK db """
-        session = self.get_session()
+        if self._queue_outbound('add', node):
+            return True
 
-        citysdk_record = self.convert_format(node)
-        citysdk_api_url = '%snodes/%s' % (self.citysdk_url, self.config['citysdk_layer'])
+        # the node has already been added, do not create a duplicate
+        if loaded_external(node) is not None:
+            return self.change(node, authenticate=authenticate)
 
-        # citysdk sync
-        response = requests.put(
-            citysdk_api_url,
-            data=json.dumps(citysdk_record),
-            verify=self.verify_ssl,
-            headers={ 'Content-type': 'application/json', 'X-Auth': session }
-        )
+        if self._enqueue(node, 'create'):
+            return True
 
-        self.release_session(session)
+        if authenticate:
+            self.authenticate()
 
-        if response.status_code != 200:
-            message = 'ERROR while creating "%s". Response: %s' % (node.name, response.content)
-            logger.error(message)
-            return False
-        else:
-            ext = NodeExternal()
-            ext.node = node
-            ext.external_id = '{layer}.{slug}'.format(
-                layer=self.config['citysdk_layer'],
-                slug=node.slug.replace('-', '.')
-            )
-            ext.save()
+        citysdk_record = self.convert_format(node)
+
+        # citysdk sync, a retried add must not create a duplicate
+        response = self._request('PUT', self.citysdk_api_url, data=json.dumps(citysdk_record),
+                                 operation='add', retry_check=lambda: self._find_added([node]))
 
         try:
-            data = json.loads(response.content)
-        except json.JSONDecodeError as e:
-            logger.error('== ERROR: JSONDecodeError %s ==' % e)
+            self.client.decode(response, 'ERROR while creating "%s".' % node.name)
+        except CitySdkError as e:
+            logger.error(e)
             return False
 
+        NodeExternal.objects.create(node=node, external_id=self.get_external_id(node))
+
         message = 'New record "%s" saved in CitySDK through the HTTP API"' % node.name
         self.verbose(message)
         logger.info(message)
 
         return True
 
+    @timed('change')
     def change(self, node, authenticate=True):
         """ Add a new record into CitySDK db """
-        session = self.get_session()
+        if self._queue_outbound('change', node):
+            return True
+
+        if self.bulk_size:
+            try:
+                node.external
+            # in case external_id is not in the local DB we need to create instead
+            except ObjectDoesNotExist:
+                create_type = 'create'
+            else:
+                create_type = 'update'
+            if self._enqueue(node, create_type):
+                return True
+
+        if authenticate:
+            self.authenticate()
 
         citysdk_record = self.convert_format(node, create_type='update')
-        citysdk_api_url = '%snodes/%s' % (self.citysdk_url, self.config['citysdk_layer'])
 
         # citysdk sync
-        response = requests.put(
-            citysdk_api_url,
-            data=json.dumps(citysdk_record),
-            verify=self.verify_ssl,
-            headers={ 'Content-type': 'application/json', 'X-Auth': session }
-        )
-
-        self.release_session(session)
-
-        if response.status_code != 200:
-            message = 'ERROR while updating record "%s" through CitySDK API\n%s' % (node.name, response.content)
-            logger.error(message)
-            return False
+        response = self._request('PUT', self.citysdk_api_url, data=json.dumps(citysdk_record),
+                                 operation='change')
 
         try:
-            json.loads(response.content)
-        except json.JSONDecodeError as e:
+            self.client.decode(response, 'ERROR while updating record "%s" through CitySDK API' % node.name)
+        except CitySdkError as e:
             logger.error(e)
             return False
 
@@ -238,9 +527,14 @@ class CitySdkMobilityMixin(object):
 
         return True
 
+    @timed('delete')
     def delete(self, external_id, authenticate=True):
         """ Delete record from CitySDK db """
-        session = self.get_session()
+        if self._queue_outbound('delete', external_id):
+            return True
+
+        if authenticate:
+            self.authenticate()
 
         citysdk_api_url = '%s%s/%s' % (
             self.citysdk_url,
@@ -248,14 +542,8 @@ class CitySdkMobilityMixin(object):
             self.config['citysdk_layer']
         )
 
-        response = requests.delete(
-            citysdk_api_url,
-            params={ 'delete_node': True },
-            verify=self.verify_ssl,
-            headers={ 'Content-type': 'application/json', 'X-Auth': session }
-        )
-
-        self.release_session(session)
+        response = self._request('DELETE', citysdk_api_url, params={ 'delete_node': True },
+                                 operation='delete')
 
         if response.status_code != 200:
             message = 'Failed to delete a record through the CitySDK HTTP API'
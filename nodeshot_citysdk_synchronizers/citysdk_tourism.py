@@ -1,19 +1,72 @@
 from __future__ import absolute_import
 
-import requests
 import simplejson as json
+import threading
+from collections import OrderedDict
+from time import time
 
 from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
 from django.utils.translation import ugettext_lazy as _
 
+from nodeshot.core.nodes.models import Node
 from nodeshot.interop.sync.synchronizers.base import BaseSynchronizer, GenericGisSynchronizer
-from nodeshot.interop.sync.models import NodeExternal
+from nodeshot.interop.sync.models import LayerExternal, NodeExternal
+
+from .outbound import OutboundQueueMixin
+from .payloads import TourismPayloadBuilder
+from .client import CitySdkClient, make_response
+from .metrics import SyncMetricsMixin, get_run_metrics, timed
+from .ratelimit import get_rate_limiter, release_rate_limiter
+from .settings import CITYSDK_HTTP_POOL_SIZE, CITYSDK_CATEGORY_CACHE_TTL
+from .utils import loaded_external, pushes_run_in_sync_process
 
 from celery.utils.log import get_logger
 logger = get_logger(__name__)
 
+# operations waiting to be performed concurrently, keyed by layer primary key
+# and then by node primary key (external id for deletes); a layer is present
+# only while one of its imports is running in this process, pushes performed
+# by other processes (celery workers) are not queued, see pushes_run_in_sync_process()
+_push_queues = {}
+# payload builders, keyed by layer primary key
+_payload_builders = {}
+# categories of each CitySDK instance, keyed by (citysdk_url, type, lang)
+_category_indexes = {}
+_category_indexes_lock = threading.Lock()
+
+JSON_HEADERS = { 'content-type': 'application/json' }
+
 
-class CitySdkTourismMixin(object):
+class CategoryIndex(object):
+    """
+    categories of a CitySDK instance indexed by ID and by value,
+    "key in index" looks for an exact ID or value, "index[value]" returns the ID
+    """
+    def __init__(self, categories, ttl=CITYSDK_CATEGORY_CACHE_TTL):
+        self.ids = set()
+        self.values = {}
+        self.expires = time() + ttl
+        # becomes True once the index is returned from the cache
+        self.cached = False
+        for category in categories:
+            self.add(category['id'], category['value'])
+
+    def __contains__(self, key):
+        return key in self.ids or key in self.values
+
+    def __getitem__(self, value):
+        return self.values[value]
+
+    @property
+    def expired(self):
+        return time() > self.expires
+
+    def add(self, category_id, value):
+        self.ids.add(category_id)
+        self.values[value] = category_id
+
+
+class CitySdkTourismMixin(OutboundQueueMixin):
     """
     CitySdkTourismMixin synchronizer mixin
     Provides methods to perform following operations:
@@ -90,6 +143,41 @@ class CitySdkTourismMixin(object):
                 'help_text': _('type (eg: poi)'),
             }
         },
+        {
+            'name': 'citysdk_workers',
+            'class': 'IntegerField',
+            'kwargs': {
+                'default': 1,
+                'help_text': _('During imports send up to this number of concurrent requests, '
+                               '1 sends one request at a time; needs CELERY_ALWAYS_EAGER')
+            }
+        },
+        {
+            'name': 'citysdk_rate_limit',
+            'class': 'FloatField',
+            'kwargs': {
+                'default': 0,
+                'help_text': _('Maximum requests per second sent to this CitySDK instance by all its layers, '
+                               '0 means no limit; the rate is lowered automatically when the server is overloaded')
+            }
+        },
+        {
+            'name': 'citysdk_rate_burst',
+            'class': 'IntegerField',
+            'kwargs': {
+                'default': 0,
+                'help_text': _('Maximum requests sent in a burst, 0 means equal to the rate limit')
+            }
+        },
+        {
+            'name': 'citysdk_outbound_queue',
+            'class': 'BooleanField',
+            'kwargs': {
+                'default': False,
+                'help_text': _('Store changes in a persistent queue which is pushed to CitySDK '
+                               'by a background task instead of pushing them immediately')
+            }
+        },
         {
             'name': 'verify_ssl',
             'class': 'BooleanField',
@@ -98,6 +186,10 @@ class CitySdkTourismMixin(object):
     ]
 
     _persisted_cookies = None
+    # number of operations queued in concurrent mode before they are performed
+    concurrent_batch_size = 100
+    # records retrieved with each request during reconciliation
+    reconcile_page_size = 500
 
     def __init__(self, *args, **kwargs):
         super(CitySdkTourismMixin, self).__init__(*args, **kwargs)
@@ -110,10 +202,50 @@ class CitySdkTourismMixin(object):
         """ Init required attributes if necessary (for internal use only) """
         if getattr(self, 'citysdk_categories_url', None) is None:
             self.citysdk_resource_url = '%s%ss/' % (self.config['citysdk_url'], self.config['citysdk_type'])
+            self.citysdk_search_url = '%ssearch' % self.citysdk_resource_url
             self.citysdk_categories_url = '%scategories?list=%s&limit=0&format=json' % (self.config['citysdk_url'], self.config['citysdk_type'])
             self.citysdk_category_id = self.config.get('citysdk_category_id')
 
         self.verify_ssl=self.config.get('verify_ssl', True)
+        self.workers = int(self.config.get('citysdk_workers') or 1)
+
+    @property
+    def _http_key(self):
+        return ('citysdk_tourism', self.layer.pk)
+
+    @property
+    def rate_limiter(self):
+        """ rate limiter shared by the layers which use the same CitySDK instance, if enabled """
+        rate = float(self.config.get('citysdk_rate_limit') or 0)
+        if not rate:
+            return None
+        return get_rate_limiter(self.config['citysdk_url'], rate,
+                                int(self.config.get('citysdk_rate_burst') or 0),
+                                owner=self.layer.pk)
+
+    def release_disabled_rate_limit(self):
+        """ a disabled limit must not throttle the other layers which use the same CitySDK instance """
+        if not float(self.config.get('citysdk_rate_limit') or 0):
+            release_rate_limiter(self.config['citysdk_url'], self.layer.pk)
+
+    @property
+    def client(self):
+        """ CitySDK client which uses the pooled HTTP session of this layer, built once """
+        client = getattr(self, '_client', None)
+        if client is None:
+            client = self._client = CitySdkClient(self._http_key,
+                                                  verify=self.verify_ssl,
+                                                  pool_size=max(CITYSDK_HTTP_POOL_SIZE, self.workers),
+                                                  reauthenticate=self._reauthenticate,
+                                                  limiter=self.rate_limiter)
+        # metrics are collected for each sync run
+        client.metrics = get_run_metrics(self.layer)
+        return client
+
+    @property
+    def http(self):
+        """ pooled HTTP session shared by every request performed for this layer """
+        return self.client.http
 
     def clean(self):
         """
@@ -128,19 +260,50 @@ class CitySdkTourismMixin(object):
         Method that will be called after the external layer has been saved
         """
         self.find_citysdk_category(layer_config)
+        self.release_disabled_rate_limit()
+
+    def sync(self, *args, **kwargs):
+        """
+        in concurrent mode operations are queued only while the import is running:
+        the queue is removed, and the pooled connections closed, even if the import fails
+        """
+        queue_created = (self.workers > 1 and pushes_run_in_sync_process() and
+                         self.layer.pk not in _push_queues)
+        if queue_created:
+            _push_queues[self.layer.pk] = OrderedDict()
+        try:
+            return super(CitySdkTourismMixin, self).sync(*args, **kwargs)
+        finally:
+            if queue_created:
+                unsent = len(_push_queues.pop(self.layer.pk))
+                if unsent:
+                    logger.error('%d operations of layer "%s" queued in concurrent mode have not been '
+                                 'performed on CitySDK, the import did not complete' % (unsent, self.layer))
+            self._persisted_cookies = None
+            self.client.close()
 
     def before_start(self, *args, **kwargs):
         """ before the import starts do authentication (1 time only) """
+        # start the run with a fresh pool of connections
+        self.client.close()
         # first time
         self.authenticate(force_http_request=True)
         # store cookies in a string
         self._persisted_cookies = self.cookies
         self.layer.external.config = self.config
         self.layer.external.save(after_save=False)
+        if self.workers > 1 and not pushes_run_in_sync_process():
+            logger.warning('concurrent mode needs CELERY_ALWAYS_EAGER, nodes of layer "%s" '
+                           'are pushed one at a time by the celery workers' % self.layer)
 
     def after_complete(self, *args, **kwargs):
-        """ clear self._persisted_cookies """
-        self._persisted_cookies = None
+        """ perform queued operations """
+        self.flush()
+
+    def prepare_drain(self):
+        """ authenticate once for all the operations of the outbound queue """
+        super(CitySdkTourismMixin, self).prepare_drain()
+        self._persisted_cookies = self.cookies
 
     def authenticate(self, force_http_request=False):
         """ authenticate into the CitySDK API if necessary """
@@ -148,6 +311,7 @@ class CitySdkTourismMixin(object):
         # if force_http_request is True do HTTP request anyway
         if force_http_request is False and self._persisted_cookies is not None:
             self.cookies = self._persisted_cookies
+            self.http.cookies.update(self.cookies)
             return True
 
         self.verbose('Authenticating to CitySDK')
@@ -155,7 +319,8 @@ class CitySdkTourismMixin(object):
 
         citysdk_auth_url = '%sauth?format=json' % self.config['citysdk_url']
 
-        response = requests.post(citysdk_auth_url, verify=self.verify_ssl, params={
+        # not sent through the client, which authenticates again on 401
+        response = self.http.post(citysdk_auth_url, params={
             'username': self.config['citysdk_username'],
             'password': self.config['citysdk_password'],
         })
@@ -165,10 +330,41 @@ class CitySdkTourismMixin(object):
             logger.error(message)
             raise ImproperlyConfigured(message)
 
+        # the session cookie is stored in the pooled session too
+        # and will be sent along with every subsequent request
         self.cookies = response.cookies.get_dict()
 
         return True
 
+    def _reauthenticate(self):
+        """ called by the client when the session cookie has expired """
+        self.authenticate(force_http_request=True)
+        if self._persisted_cookies is not None:
+            self._persisted_cookies = self.cookies
+
+    def get_category_index(self, refresh=False):
+        """
+        returns the CategoryIndex of the CitySDK instance of this layer;
+        categories are retrieved once for all the layers which share
+        the same CitySDK instance and cached for CITYSDK_CATEGORY_CACHE_TTL seconds
+        """
+        key = (self.config['citysdk_url'], self.config['citysdk_type'], self.config['citysdk_lang'])
+
+        with _category_indexes_lock:
+            index = _category_indexes.get(key)
+            if index is not None and not refresh and not index.expired:
+                index.cached = True
+                return index
+
+            self.authenticate()
+            client = self.client
+            response = client.request('GET', self.citysdk_categories_url)
+            categories = client.decode(response, 'ERROR while retrieving CitySDK categories')
+
+            index = CategoryIndex(categories.get('categories') or [])
+            _category_indexes[key] = index
+            return index
+
     def find_citysdk_category(self, layer_config=None):
         """
         Automatically finds the citysdk category ID
@@ -184,14 +380,16 @@ class CitySdkTourismMixin(object):
         if layer_config:
             self.config = layer_config
 
-        self.authenticate()
-        response = requests.get(self.citysdk_categories_url, cookies=self.cookies, verify=self.verify_ssl)
-
         citysdk_category_id = self.citysdk_category_id
+        index = self.get_category_index()
+
+        # categories cached before they were created or deleted by someone else
+        if citysdk_category_id not in index and self.config['citysdk_category'] not in index and index.cached:
+            index = self.get_category_index(refresh=True)
 
         # do we already have the category id in the db config?
-        # And is the category present in the API response?
-        if citysdk_category_id and citysdk_category_id in response.content:
+        # And is the category present in CitySDK?
+        if citysdk_category_id and citysdk_category_id in index:
             message = 'category with ID "%s" already present in config' % citysdk_category_id
             self.verbose(message)
             logger.info(message)
@@ -201,7 +399,7 @@ class CitySdkTourismMixin(object):
         # if not go and find it!
         else:
             # category does not exist, create it
-            if self.config['citysdk_category'] not in response.content:
+            if self.config['citysdk_category'] not in index:
 
                 category = {
                     "list": self.config['citysdk_type'],  # poi, event, route
@@ -221,11 +419,10 @@ class CitySdkTourismMixin(object):
 
                 self.verbose('Creating new category in CitySDK DB')
                 logger.info('== Creating new category in CitySDK DB ==')
+                self.authenticate()
                 # put to create
-                response = requests.put(self.citysdk_categories_url, data=json.dumps(category),
-                                        headers={'content-type': 'application/json'},
-                                        cookies=self.cookies,
-                                        verify=self.verify_ssl)
+                response = self.client.request('PUT', self.citysdk_categories_url, data=json.dumps(category),
+                                               headers=JSON_HEADERS)
 
                 # raise exception if something has gone wrong
                 if response.status_code is not 200:
@@ -236,26 +433,19 @@ class CitySdkTourismMixin(object):
 
                 # get ID
                 citysdk_category_id = json.loads(response.content)
+                # other layers will find it without retrieving the categories again
+                index.add(citysdk_category_id, self.config['citysdk_category'])
 
                 message = 'category with ID "%s" has been created' % citysdk_category_id
                 self.verbose(message)
                 logger.info(message)
             # category already exists, find ID
             else:
-                categories = json.loads(response.content)['categories']
-
-                for category in categories:
-                    if category['value'] == self.config['citysdk_category']:
-                        citysdk_category_id = category['id']
-
-                # raise exception if not found - should not happen but who knows
-                if citysdk_category_id is None:
-                    message = 'Category was thought to be there but could not be found!'
-                    logger.info(message)
-                    raise ImproperlyConfigured(message)
+                citysdk_category_id = index[self.config['citysdk_category']]
 
             # now store ID in the database both in case category has been created or not
             self.config['citysdk_category_id'] = citysdk_category_id
+            self.citysdk_category_id = citysdk_category_id
             self.layer.external.config = self.config
             self.layer.external.save(after_save=False)
             # verbose output
@@ -263,142 +453,209 @@ class CitySdkTourismMixin(object):
             self.verbose(message)
             logger.info(message)
 
-    def convert_format(self, node):
-        """ Prepares the JSON that will be sent to the CitySDK API """
-
-        # determine description or fill some hopefully useful value
+    @property
+    def payload_builder(self):
+        """ payload builder of this layer, built again only if the invariant parts have changed """
+        builder = _payload_builders.get(self.layer.pk)
+        key = (
+            self.config['citysdk_type'],
+            self.config['citysdk_term'],
+            self.config['citysdk_lang'],
+            self.citysdk_category_id,
+            self.citysdk_resource_url,
+            self.layer.organization
+        )
+        if builder is None or builder.key != key:
+            builder = TourismPayloadBuilder(*key)
+            _payload_builders[self.layer.pk] = builder
+        return builder
+
+    def get_description(self, node):
+        """ determine description or fill some hopefully useful value """
         if not node.description.strip():
-            description = '%s in %s' % (node.name, node.address)
-        else:
-            description = node.description
-
-        return {
-            self.config['citysdk_type'] :{
-                "location":{
-                    "point":[
-                        {
-                            "Point":{
-                                "posList":"%s %s" % (float(node.point.coords[1]), float(node.point.coords[0])),
-                                "srsName":"http://www.opengis.net/def/crs/EPSG/0/4326"
-                            },
-                            "term": self.config['citysdk_term']
-                        }
-                    ],
-                    "address": {
-                        "value":"""BEGIN:VCARD
-N:;%s;;;;
-ADR;INTL;PARCEL;WORK:;;%s;%s;%s;;%s
-END:VCARD""" % (
-                            node.name,
-                            node.data['address'],
-                            node.data['city'],
-                            node.data['province'],
-                            node.data['country'],
-                        ),
-                        "type": "text/vcard"
-                    },
-                },
-                "label":[
-                    {
-                        "term": "primary",
-                        "value": node.name
-                    },
-                ],
-                "description":[
-                    {
-                        "value": description,
-                        "lang": self.config['citysdk_lang']
-                    },
-                ],
-                "category":[
-                    {
-                        "id": self.citysdk_category_id
-                    }
-                ],
-                "base": self.citysdk_resource_url,
-                "lang": self.config['citysdk_lang'],
-                "created": unicode(node.added),
-                "author":{
-                    "term": "primary",
-                    "value": self.layer.organization
-                },
-                "license":{
-                    "term": "primary",
-                    "value": "open-data"
-                }
-            }
-        }
+            return '%s in %s' % (node.name, node.address)
+        return node.description
+
+    def get_vcard_address(self, node):
+        """ ADR line of the vCard sent as address """
+        return 'ADR;INTL;PARCEL;WORK:;;%s;%s;%s;;%s' % (
+            node.data['address'],
+            node.data['city'],
+            node.data['province'],
+            node.data['country'],
+        )
+
+    def serialize(self, node, external_id=None):
+        """ Prepares the JSON (bytes) that will be sent to the CitySDK API """
+        return self.payload_builder.build(
+            node.point.coords[1],
+            node.point.coords[0],
+            node.name,
+            self.get_vcard_address(node),
+            self.get_description(node),
+            unicode(node.added),
+            external_id=external_id
+        )
+
+    def convert_format(self, node):
+        """ Prepares the record that will be sent to the CitySDK API as a dictionary """
+        return json.loads(self.serialize(node))
 
+    @timed('add')
     def add(self, node, authenticate=True):
         """ Add a new record into CitySDK db """
-        if authenticate:
-            self.authenticate()
+        if self._queue_outbound('add', node):
+            return True
 
-        citysdk_record = self.convert_format(node)
+        # the node has already been added, do not create a duplicate
+        if loaded_external(node) is not None:
+            return self.change(node, authenticate=authenticate)
 
-        # citysdk sync
-        response = requests.put(self.citysdk_resource_url, data=json.dumps(citysdk_record),
-                     headers={ 'content-type': 'application/json' }, cookies=self.cookies,
-                     verify=self.verify_ssl)
+        if self._enqueue('add', node):
+            return True
 
-        if response.status_code != 200:
-            message = 'ERROR while creating "%s". Response: %s' % (node.name, response.content)
-            logger.error(message)
-            return False
+        if authenticate:
+            self.authenticate()
 
-        try:
-            data = json.loads(response.content)
-        except json.JSONDecodeError as e:
-            logger.error('== ERROR: JSONDecodeError %s ==' % e)
-            return False
+        response = self._perform(self._prepare_add(node))
+        external_id = self._process_add(node, response)
 
-        external = NodeExternal.objects.create(node=node, external_id=data['id'])
-        message = 'New record "%s" saved in CitySDK through the HTTP API"' % node.name
-        self.verbose(message)
-        logger.info(message)
+        if external_id is None:
+            return False
 
+        NodeExternal.objects.create(node=node, external_id=external_id)
         return True
 
+    @timed('change')
     def change(self, node, authenticate=True):
         """ Edit existing record in CitySDK db """
-        if authenticate:
-            self.authenticate()
-
-        citysdk_record = self.convert_format(node)
+        if self._queue_outbound('change', node):
+            return True
 
-        # citysdk sync
         try:
-            citysdk_record['poi']['id'] = node.external.external_id
-            response = requests.post(
-                        self.citysdk_resource_url,
-                        data=json.dumps(citysdk_record),
-                        headers={ 'content-type': 'application/json' },
-                        cookies=self.cookies,
-                        verify=self.verify_ssl)
-
-            if response.status_code == 200:
-                message = 'Updated record "%s" through the CitySDK HTTP API' % node.name
-                self.verbose(message)
-                logger.info(message)
-            else:
-                message = 'ERROR while updating record "%s" through CitySDK API\n%s' % (node.name, response.content)
-                logger.error(message)
-                raise ImproperlyConfigured(message)
+            external_id = node.external.external_id
+        # in case external_id is not in the local DB we need to create instead
+        except ObjectDoesNotExist:
+            return self.add(node, authenticate=authenticate)
 
+        if self._enqueue('change', node):
             return True
 
-        # in case external_id is not in the local DB we need to create instead
-        except ObjectDoesNotExist:
-            return self.add(node, authenticate=False)
+        if authenticate:
+            self.authenticate()
+
+        response = self._perform(self._prepare_change(node, external_id))
+        return self._process_change(node, response)
 
+    @timed('delete')
     def delete(self, external_id, authenticate=True):
         """ Delete record from CitySDK db """
+        if self._queue_outbound('delete', external_id):
+            return True
+
+        if self._enqueue('delete', external_id):
+            return True
+
         if authenticate:
             self.authenticate()
 
-        response = requests.delete(self.citysdk_resource_url, data='{"id":"%s"}' % external_id,
-                            headers={ 'content-type': 'application/json' }, cookies=self.cookies)
+        response = self._perform(self._prepare_delete(external_id))
+        return self._process_delete(external_id, response)
+
+    # each operation is split in three steps:
+    #   * _prepare_<operation>: builds the request (method, url, kwargs), might query the DB
+    #   * _perform: sends the request, safe to call from worker threads
+    #   * _process_<operation>: checks the response, called in order from the main thread
+
+    def _prepare_add(self, node):
+        return ('PUT', self.citysdk_resource_url, {
+            'data': self.serialize(node),
+            'headers': JSON_HEADERS,
+            'operation': 'add',
+            # a retried add must not create a duplicate
+            'retry_check': lambda: self._find_added(node)
+        })
+
+    def _prepare_change(self, node, external_id):
+        return ('POST', self.citysdk_resource_url, {
+            'data': self.serialize(node, external_id),
+            'headers': JSON_HEADERS,
+            'operation': 'change'
+        })
+
+    def _prepare_delete(self, external_id):
+        return ('DELETE', self.citysdk_resource_url, {
+            'data': '{"id":"%s"}' % external_id,
+            'headers': JSON_HEADERS,
+            'operation': 'delete'
+        })
+
+    def _find_added(self, node):
+        """
+        looks for the record of node in the category on CitySDK, returns a response
+        containing its ID (like the one of a successful add) or None if not found;
+        records must have the name and the position of node and must not
+        belong to other nodes already, which might have the same name
+        """
+        response = self.client.request('GET', self.citysdk_search_url, params={
+            'category': self.config['citysdk_category'],
+            'name': node.name,
+            'limit': -1,
+            'format': 'json'
+        })
+        if response.status_code != 200:
+            return None
+        citysdk_type = self.config['citysdk_type']
+        positions = self._compared_fields(self.convert_format(node)[citysdk_type])[2]
+        records = []
+        for record in json.loads(response.content).get(citysdk_type) or []:
+            fields = self._compared_fields(record)
+            if node.name in fields[0] and fields[2] == positions:
+                records.append(record)
+        owned = set(NodeExternal.objects.filter(external_id__in=[record['id'] for record in records])
+                                        .values_list('external_id', flat=True))
+        for record in records:
+            if record['id'] not in owned:
+                logger.info('record "%s" had been created by a request which failed' % node.name)
+                return make_response(json.dumps({ 'id': record['id'] }))
+        return None
+
+    def _perform(self, request):
+        method, url, kwargs = request
+        return self.client.request(method, url, **kwargs)
+
+    def _process_add(self, node, response):
+        """ returns the ID assigned by CitySDK or None if the record could not be created """
+        if response.status_code != 200:
+            message = 'ERROR while creating "%s". Response: %s' % (node.name, response.content)
+            logger.error(message)
+            return None
+
+        try:
+            data = json.loads(response.content)
+        except json.JSONDecodeError as e:
+            logger.error('== ERROR: JSONDecodeError %s ==' % e)
+            return None
+
+        message = 'New record "%s" saved in CitySDK through the HTTP API"' % node.name
+        self.verbose(message)
+        logger.info(message)
+
+        return data['id']
 
+    def _process_change(self, node, response):
+        if response.status_code == 200:
+            message = 'Updated record "%s" through the CitySDK HTTP API' % node.name
+            self.verbose(message)
+            logger.info(message)
+        else:
+            message = 'ERROR while updating record "%s" through CitySDK API\n%s' % (node.name, response.content)
+            logger.error(message)
+            raise ImproperlyConfigured(message)
+
+        return True
+
+    def _process_delete(self, external_id, response):
         if response.status_code != 200:
             message = 'Failed to delete a record through the CitySDK HTTP API'
             self.verbose(message)
@@ -411,6 +668,196 @@ END:VCARD""" % (
 
         return True
 
+    def _enqueue(self, operation, obj):
+        """
+        queue operation if an import of this layer in concurrent mode is running
+        and perform the queued operations when the queue is full; returns False otherwise
+        """
+        queue = _push_queues.get(self.layer.pk)
+        if queue is None:
+            return False
+        # a node saved more than once during the import is pushed once, with its last values;
+        # change() adds nodes which have no NodeExternal yet
+        key = ('delete', obj) if operation == 'delete' else ('node', obj.pk)
+        if queue.get(key, (None,))[0] == 'add':
+            operation = 'add'
+        queue[key] = (operation, obj)
+        if len(queue) >= self.concurrent_batch_size:
+            self.flush()
+        return True
+
+    @timed('flush')
+    def flush(self):
+        """
+        perform queued operations: HTTP requests are sent concurrently
+        by a pool of worker threads which share the authenticated session,
+        while responses are processed and saved in the DB in queue order
+        """
+        queue = _push_queues.get(self.layer.pk)
+        if not queue:
+            return
+
+        operations = list(queue.values())
+        queue.clear()
+
+        self.authenticate()
+
+        # building requests might need DB queries, do it in the main thread
+        prepared = []
+        for operation, obj in operations:
+            if operation == 'add':
+                request = self._prepare_add(obj)
+            elif operation == 'change':
+                request = self._prepare_change(obj, obj.external.external_id)
+            else:
+                request = self._prepare_delete(obj)
+            prepared.append(request)
+
+        responses = self.client.batch(prepared, self.workers)
+
+        externals = []
+        errors = []
+        for (operation, obj), response in zip(operations, responses):
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                if operation == 'add':
+                    external_id = self._process_add(obj, response)
+                    if external_id is not None:
+                        externals.append(NodeExternal(node=obj, external_id=external_id))
+                elif operation == 'change':
+                    self._process_change(obj, response)
+                else:
+                    self._process_delete(obj, response)
+            except Exception as e:
+                errors.append(e)
+
+        NodeExternal.objects.bulk_create(externals)
+
+        # same behaviour of sequential mode: the first error stops the import
+        if errors:
+            raise errors[0]
+
+    def iter_remote_records(self):
+        """ iterate over the records of the category on CitySDK, one page at a time """
+        offset = 0
+        while True:
+            client = self.client
+            response = client.request('GET', self.citysdk_search_url, params={
+                'category': self.config['citysdk_category'],
+                'limit': self.reconcile_page_size,
+                'offset': offset,
+                'format': 'json'
+            })
+            content = client.decode(response, 'ERROR while retrieving records from CitySDK API')
+
+            records = content.get(self.config['citysdk_type']) or []
+            for record in records:
+                yield record
+
+            if len(records) < self.reconcile_page_size:
+                break
+            offset += self.reconcile_page_size
+
+    @staticmethod
+    def _compared_fields(record):
+        """ fields of a record compared during reconciliation """
+        location = record.get('location', {})
+        return (
+            [label.get('value') for label in record.get('label', [])],
+            [description.get('value') for description in record.get('description', [])],
+            [point['Point'].get('posList') for point in location.get('point', [])],
+            location.get('address', {}).get('value')
+        )
+
+    def layers_sharing_category(self):
+        """ other layers which push records to the same CitySDK instance and category """
+        layers = []
+        for external in LayerExternal.objects.exclude(layer=self.layer).select_related('layer'):
+            config = external.config or {}
+            if (config.get('citysdk_url') == self.config['citysdk_url'] and
+                    config.get('citysdk_category') == self.config['citysdk_category']):
+                layers.append(external.layer)
+        return layers
+
+    def reconcile(self):
+        """
+        align CitySDK with the nodes of the layer: the records of the category are
+        retrieved page by page and compared in memory with the nodes of the layer,
+        then only the needed add, change and delete operations are performed
+        (concurrently if citysdk_workers is greater than 1);
+        records which do not correspond to any node are deleted only if no node
+        of other layers owns them and no other layer uses the same category,
+        otherwise they are kept
+        returns a dictionary with the number of operations performed
+        """
+        self.authenticate()
+        remote = dict((record['id'], record) for record in self.iter_remote_records())
+        citysdk_type = self.config['citysdk_type']
+
+        operations = []
+        stale_externals = []
+        unmodified = 0
+
+        for node in Node.objects.filter(layer=self.layer).select_related('external'):
+            try:
+                external_id = node.external.external_id
+            except ObjectDoesNotExist:
+                operations.append(('add', node))
+                continue
+
+            record = remote.pop(external_id, None)
+            if record is None:
+                # deleted from CitySDK, must be created again
+                stale_externals.append(node.external.pk)
+                operations.append(('add', node))
+            elif self._compared_fields(self.convert_format(node)[citysdk_type]) != self._compared_fields(record):
+                operations.append(('change', node))
+            else:
+                unmodified += 1
+
+        # records which do not correspond to any node of this layer nor of other layers
+        owned = set(NodeExternal.objects.filter(external_id__in=list(remote))
+                                        .values_list('external_id', flat=True))
+        orphans = [external_id for external_id in remote if external_id not in owned]
+        kept = 0
+        if orphans:
+            # records of another layer deleted from nodeshot might be among them
+            sharing_layers = self.layers_sharing_category()
+            if sharing_layers:
+                kept = len(orphans)
+                logger.warning('%d records of the CitySDK category "%s" are not deleted, '
+                               'the category is used by other layers too: %s' % (
+                                   kept, self.config['citysdk_category'],
+                                   ', '.join(unicode(layer) for layer in sharing_layers)))
+            else:
+                operations += [('delete', external_id) for external_id in orphans]
+
+        NodeExternal.objects.filter(pk__in=stale_externals).delete()
+
+        # operations are performed by the queue of the concurrent mode
+        queue_created = self.layer.pk not in _push_queues
+        if queue_created:
+            _push_queues[self.layer.pk] = OrderedDict()
+        try:
+            for operation, obj in operations:
+                self._enqueue(operation, obj)
+            self.flush()
+        finally:
+            if queue_created:
+                _push_queues.pop(self.layer.pk, None)
+
+        results = { 'add': 0, 'change': 0, 'delete': 0, 'kept': kept, 'unmodified': unmodified }
+        for operation, obj in operations:
+            results[operation] += 1
+
+        message = 'Reconciliation: %(add)d added, %(change)d changed, %(delete)d deleted, ' \
+                  '%(kept)d kept, %(unmodified)d unmodified' % results
+        self.verbose(message)
+        logger.info(message)
+
+        return results
+
 
-class CitySdkTourism(CitySdkTourismMixin, BaseSynchronizer):
+class CitySdkTourism(SyncMetricsMixin, CitySdkTourismMixin, BaseSynchronizer):
     SCHEMA = CitySdkTourismMixin.SCHEMA + [GenericGisSynchronizer.SCHEMA[1]]
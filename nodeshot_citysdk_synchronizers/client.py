@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+
+import simplejson as json
+from multiprocessing.pool import ThreadPool
+from time import time, sleep
+
+import requests
+from django.core.exceptions import ImproperlyConfigured
+
+from .retry import RetryPolicy
+from .sessions import get_pooled_session, close_pooled_session
+from .settings import CITYSDK_HTTP_POOL_SIZE
+
+from celery.utils.log import get_logger
+logger = get_logger(__name__)
+
+
+class CitySdkError(ImproperlyConfigured):
+    """ error returned by a CitySDK API, response is None if the server could not be reached """
+    def __init__(self, message, response=None):
+        super(CitySdkError, self).__init__(message)
+        self.response = response
+
+
+def make_response(content, status_code=200):
+    """ response of a request which did not need to be sent """
+    response = requests.models.Response()
+    response.status_code = status_code
+    response._content = content
+    return response
+
+
+class CitySdkClient(object):
+    """
+    HTTP client shared by the CitySDK mixins:
+        * requests are sent through the pooled session identified by key
+        * requests rejected with 401 are sent again once after calling reauthenticate
+        * requests wait for the rate limiter (TokenBucket), if any, which adapts
+          its rate to the responses received
+        * latency and size of requests are recorded in metrics (SyncMetrics), if any
+        * requests which failed for temporary reasons are sent again according
+          to the RetryPolicy; before sending again a request which is not idempotent
+          retry_check is called to find out whether the server has processed it anyway
+        * decode() checks the status of responses and decodes their JSON content
+        * batch() sends many requests keeping up to a given number of them in flight
+    """
+    def __init__(self, key, verify=True, headers=None,
+                 pool_size=CITYSDK_HTTP_POOL_SIZE, reauthenticate=None, limiter=None,
+                 retry_policy=None, metrics=None):
+        self.key = key
+        self.verify = verify
+        self.headers = headers or {}
+        self.pool_size = pool_size
+        self.reauthenticate = reauthenticate
+        self.limiter = limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = metrics
+
+    @property
+    def http(self):
+        """ pooled HTTP session shared by every client with the same key """
+        session = get_pooled_session(self.key, pool_size=self.pool_size)
+        session.verify = self.verify
+        session.headers.update(self.headers)
+        return session
+
+    def close(self):
+        """ close the pooled connections, next request will open new ones """
+        close_pooled_session(self.key)
+
+    def _send(self, method, url, operation='default', **kwargs):
+        if self.limiter is None and self.metrics is None:
+            return self.http.request(method, url, **kwargs)
+        if self.limiter is not None:
+            self.limiter.acquire()
+        start = time()
+        response = self.http.request(method, url, **kwargs)
+        elapsed = time() - start
+        if self.limiter is not None:
+            self.limiter.record(response, elapsed)
+        if self.metrics is not None:
+            data = kwargs.get('data')
+            self.metrics.observe_request(operation, elapsed,
+                                         sent=len(data) if isinstance(data, basestring) else 0,
+                                         received=len(response.content))
+        return response
+
+    def _send_authenticated(self, method, url, **kwargs):
+        response = self._send(method, url, **kwargs)
+        if response.status_code == 401 and self.reauthenticate is not None:
+            self.reauthenticate()
+            response = self._send(method, url, **kwargs)
+        return response
+
+    def request(self, method, url, operation='default', retry_check=None, **kwargs):
+        """
+        send a request, operation identifies the number of retries allowed by the policy;
+        retry_check, if given, returns the response to use in place of sending
+        the request again (eg: the record has been created anyway) or None
+        """
+        policy = self.retry_policy
+        attempt = 0
+        while True:
+            try:
+                result = self._send_authenticated(method, url, operation=operation, **kwargs)
+            except policy.RETRIABLE_EXCEPTIONS as e:
+                result = e
+
+            if attempt >= policy.max_retries(operation) or not policy.is_retriable(result):
+                if isinstance(result, Exception):
+                    raise result
+                return result
+
+            delay = policy.delay(attempt, result)
+            logger.warning('%s %s failed (%s), retrying in %.1f seconds' % (
+                method, url, getattr(result, 'status_code', result), delay
+            ))
+            sleep(delay)
+            attempt += 1
+
+            if retry_check is not None:
+                response = retry_check()
+                if response is not None:
+                    return response
+
+    def decode(self, response, error_message):
+        """ returns the JSON content of a successful response, raises CitySdkError otherwise """
+        if response.status_code != 200:
+            raise CitySdkError('%s\n%s' % (error_message, response.content), response)
+        try:
+            return json.loads(response.content)
+        except json.JSONDecodeError as e:
+            raise CitySdkError('%s\nJSONDecodeError %s' % (error_message, e), response)
+
+    def batch(self, requests, concurrency):
+        """
+        send requests, a list of (method, url, kwargs) tuples, keeping up to
+        concurrency requests in flight; returns responses in the same order,
+        exceptions are returned in place of the responses instead of being raised
+        """
+        def send(request):
+            method, url, kwargs = request
+            try:
+                return self.request(method, url, **kwargs)
+            except Exception as e:
+                return e
+
+        if concurrency <= 1 or len(requests) <= 1:
+            return [send(request) for request in requests]
+
+        pool = ThreadPool(min(concurrency, len(requests)))
+        try:
+            return pool.map(send, requests)
+        finally:
+            pool.close()
+            pool.join()
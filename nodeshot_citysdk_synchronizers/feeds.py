@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+
+import hashlib
+from tempfile import SpooledTemporaryFile
+
+import requests
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .metrics import get_run_metrics
+
+
+class FeedCacheMixin(object):
+    """
+    Conditional download of the feeds of a synchronizer:
+        * ETag and Last-Modified of the previous download are sent back to the server,
+          which can reply "304 Not Modified" without sending the feed again
+        * if the server does not support conditional requests the SHA1 hash
+          of the content is compared with the one of the previous download
+    Validators are stored in the config of the external layer (see feed_key(),
+    keys must not clash with the settings of the synchronizers, eg: "streets_url")
+    by store_feed_validators(), which must be called
+    only after the sync has completed, otherwise a failed sync would be skipped
+    the next time.
+    """
+    # content bigger than this is spooled to a temporary file on disk
+    feed_spool_size = 8 * 1024 * 1024
+    feed_chunk_size = 65536
+
+    _feed_validators = None
+
+    def feed_key(self, name, validator):
+        """ config key of a validator of the feed called name, eg: streets_feed_etag """
+        return '%s_feed_%s' % (name, validator)
+
+    def fetch_feed(self, name, url):
+        """
+        returns a file-like object containing the feed found at url
+        or None if the feed has not changed since the previous sync
+        """
+        if self._feed_validators is None:
+            self._feed_validators = {}
+
+        # validators are valid only if the url has not changed
+        cached = self.config.get(self.feed_key(name, 'url')) == url
+        etag = self.config.get(self.feed_key(name, 'etag'))
+        last_modified = self.config.get(self.feed_key(name, 'last_modified'))
+        headers = {}
+        if cached and etag:
+            headers['If-None-Match'] = etag
+        if cached and last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        response = requests.get(url, headers=headers, verify=self.verify_ssl, stream=True)
+
+        if response.status_code == 304:
+            response.close()
+            self.verbose('%s not modified since last sync' % name)
+            return None
+
+        if response.status_code != 200:
+            raise ImproperlyConfigured('Could not retrieve %s: HTTP %s' % (url, response.status_code))
+
+        content = SpooledTemporaryFile(max_size=self.feed_spool_size)
+        digest = hashlib.sha1()
+        size = 0
+        for chunk in response.iter_content(self.feed_chunk_size):
+            digest.update(chunk)
+            content.write(chunk)
+            size += len(chunk)
+        content.seek(0)
+
+        metrics = get_run_metrics(self.layer)
+        if metrics is not None:
+            metrics.increment('bytes_downloaded', size)
+
+        self._feed_validators.update({
+            self.feed_key(name, 'url'): url,
+            self.feed_key(name, 'etag'): response.headers.get('ETag', ''),
+            self.feed_key(name, 'last_modified'): response.headers.get('Last-Modified', ''),
+            self.feed_key(name, 'hash'): digest.hexdigest()
+        })
+
+        if cached and self.config.get(self.feed_key(name, 'hash')) == digest.hexdigest():
+            content.close()
+            self.verbose('%s has not changed since last sync' % name)
+            return None
+
+        return content
+
+    def store_feed_validators(self):
+        """ store validators of the feeds downloaded (and any other config change) in the external layer """
+        self.config.update(self._feed_validators or {})
+        self._feed_validators = None
+        self.layer.external.config = self.config
+        self.layer.external.save(after_save=False)
@@ -2,8 +2,10 @@ from __future__ import absolute_import
 
 from nodeshot.interop.sync.synchronizers import GeoJson
 from .citysdk_mobility import CitySdkMobilityMixin
+from .metrics import SyncMetricsMixin
+from .sharding import ShardedSyncMixin
 
 
-class GeoJsonCitySdkMobility(CitySdkMobilityMixin, GeoJson):
+class GeoJsonCitySdkMobility(SyncMetricsMixin, ShardedSyncMixin, CitySdkMobilityMixin, GeoJson):
     """ Import GeoJson and sync CitySDK """
-    SCHEMA = CitySdkMobilityMixin.SCHEMA + GeoJson.SCHEMA
+    SCHEMA = CitySdkMobilityMixin.SCHEMA + GeoJson.SCHEMA + ShardedSyncMixin.SCHEMA
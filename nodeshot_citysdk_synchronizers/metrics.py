@@ -0,0 +1,270 @@
+from __future__ import absolute_import
+
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import time
+
+from django.db import connection
+
+from .settings import (CITYSDK_METRICS_QUERIES,
+                       CITYSDK_METRICS_EXPORTER,
+                       CITYSDK_METRICS_STATSD_ADDRESS,
+                       CITYSDK_METRICS_STATSD_PREFIX,
+                       CITYSDK_METRICS_PROMETHEUS_FILE)
+
+from celery.utils.log import get_logger
+logger = get_logger(__name__)
+
+# metrics of the sync runs in progress, keyed by layer primary key;
+# the synchronizers created by signals during a run record in the same metrics
+_run_metrics = {}
+
+
+class SyncMetrics(object):
+    """
+    Metrics of a sync run:
+        * phases: wall time, calls and DB queries (if CITYSDK_METRICS_QUERIES)
+          of retrieve_data, parse, save, add, change, delete, ...
+        * counters: eg: bytes downloaded, bytes sent to and received from CitySDK
+        * latency histograms of the CitySDK requests, for each operation
+    """
+    # upper bounds (seconds) of the buckets of the latency histograms
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self, layer, count_queries=CITYSDK_METRICS_QUERIES):
+        self.layer = layer
+        self.count_queries = count_queries
+        self.started = time()
+        self.elapsed = None
+        self.phases = {}
+        self.counters = {}
+        self.latency = {}
+        self.lock = threading.Lock()
+        self._depth = 0
+
+    @contextmanager
+    def phase(self, name):
+        """ measure the code run in the block as phase name """
+        queries = None
+        if self.count_queries:
+            debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            queries = len(connection.queries)
+        self._depth += 1
+        start = time()
+        try:
+            yield
+        finally:
+            elapsed = time() - start
+            self._depth -= 1
+            if queries is not None:
+                count = len(connection.queries) - queries
+                connection.use_debug_cursor = debug_cursor
+                # the queries logged only to be counted are not kept
+                if not self._depth and not debug_cursor:
+                    del connection.queries[queries:]
+                queries = count
+            self.record_phase(name, elapsed, queries)
+
+    def record_phase(self, name, elapsed, queries=None):
+        with self.lock:
+            phase = self.phases.setdefault(name, { 'calls': 0, 'time': 0.0, 'queries': None })
+            phase['calls'] += 1
+            phase['time'] += elapsed
+            if queries is not None:
+                phase['queries'] = (phase['queries'] or 0) + queries
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe_request(self, operation, elapsed, sent=0, received=0):
+        """ record a request sent to CitySDK """
+        with self.lock:
+            histogram = self.latency.get(operation)
+            if histogram is None:
+                histogram = self.latency[operation] = {
+                    'buckets': [0] * len(self.LATENCY_BUCKETS), 'count': 0, 'sum': 0.0
+                }
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['count'] += 1
+            histogram['sum'] += elapsed
+        self.increment('http_bytes_sent', sent)
+        self.increment('http_bytes_received', received)
+
+    def finish(self):
+        self.elapsed = time() - self.started
+
+    def as_dict(self):
+        """ structured, JSON serializable representation """
+        with self.lock:
+            return {
+                'layer': self.layer,
+                'started': self.started,
+                'elapsed': self.elapsed,
+                'phases': dict((name, dict(phase)) for name, phase in self.phases.items()),
+                'counters': dict(self.counters),
+                'latency': dict(
+                    (operation, {
+                        # cumulative counts, as in prometheus histograms
+                        'buckets': [(bound, sum(histogram['buckets'][0:i + 1]))
+                                    for i, bound in enumerate(self.LATENCY_BUCKETS)],
+                        'count': histogram['count'],
+                        'sum': histogram['sum']
+                    })
+                    for operation, histogram in self.latency.items()
+                )
+            }
+
+
+def start_run_metrics(layer):
+    metrics = _run_metrics[layer.pk] = SyncMetrics(layer.slug)
+    return metrics
+
+
+def get_run_metrics(layer):
+    """ metrics of the sync run of layer in progress, None if not running """
+    return _run_metrics.get(layer.pk)
+
+
+def finish_run_metrics(layer):
+    metrics = _run_metrics.pop(layer.pk, None)
+    if metrics is not None:
+        metrics.finish()
+    return metrics
+
+
+def timed(phase):
+    """ decorator of synchronizer methods, measures them as phase if a run is in progress """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = get_run_metrics(self.layer)
+            if metrics is None:
+                return method(self, *args, **kwargs)
+            with metrics.phase(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StatsdExporter(object):
+    """ sends the metrics of a run to StatsD over UDP """
+    def __init__(self, address=CITYSDK_METRICS_STATSD_ADDRESS, prefix=CITYSDK_METRICS_STATSD_PREFIX):
+        self.address = tuple(address)
+        self.prefix = prefix
+
+    def lines(self, report):
+        prefix = '%s.%s' % (self.prefix, report['layer'].replace('.', '_'))
+        lines = ['%s.elapsed:%d|ms' % (prefix, report['elapsed'] * 1000)]
+        for name, phase in sorted(report['phases'].items()):
+            lines.append('%s.%s.time:%d|ms' % (prefix, name, phase['time'] * 1000))
+            lines.append('%s.%s.calls:%d|c' % (prefix, name, phase['calls']))
+            if phase['queries'] is not None:
+                lines.append('%s.%s.queries:%d|c' % (prefix, name, phase['queries']))
+        for name, value in sorted(report['counters'].items()):
+            lines.append('%s.%s:%d|c' % (prefix, name, value))
+        for operation, histogram in sorted(report['latency'].items()):
+            lines.append('%s.http.%s.requests:%d|c' % (prefix, operation, histogram['count']))
+            if histogram['count']:
+                lines.append('%s.http.%s.latency_avg:%d|ms' % (
+                    prefix, operation, histogram['sum'] / histogram['count'] * 1000
+                ))
+        return lines
+
+    def export(self, report):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in self.lines(report):
+                sock.sendto(line.encode('utf-8'), self.address)
+        finally:
+            sock.close()
+
+
+class PrometheusTextExporter(object):
+    """
+    writes the metrics of the last run of each layer in the prometheus
+    text format, eg: in the directory of the textfile collector of node_exporter
+    """
+    def __init__(self, path=CITYSDK_METRICS_PROMETHEUS_FILE):
+        self.path = path
+
+    def lines(self, report):
+        layer = 'layer="%s"' % report['layer']
+        lines = ['nodeshot_citysdk_sync_seconds{%s} %f' % (layer, report['elapsed'])]
+        for name, phase in sorted(report['phases'].items()):
+            labels = '%s,phase="%s"' % (layer, name)
+            lines.append('nodeshot_citysdk_phase_seconds{%s} %f' % (labels, phase['time']))
+            lines.append('nodeshot_citysdk_phase_calls{%s} %d' % (labels, phase['calls']))
+            if phase['queries'] is not None:
+                lines.append('nodeshot_citysdk_phase_queries{%s} %d' % (labels, phase['queries']))
+        for name, value in sorted(report['counters'].items()):
+            lines.append('nodeshot_citysdk_%s{%s} %d' % (name, layer, value))
+        for operation, histogram in sorted(report['latency'].items()):
+            labels = '%s,operation="%s"' % (layer, operation)
+            for bound, count in histogram['buckets']:
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append('nodeshot_citysdk_request_seconds_bucket{%s,le="%s"} %d' % (labels, le, count))
+            lines.append('nodeshot_citysdk_request_seconds_sum{%s} %f' % (labels, histogram['sum']))
+            lines.append('nodeshot_citysdk_request_seconds_count{%s} %d' % (labels, histogram['count']))
+        return lines
+
+    def export(self, report):
+        # one file for each layer, replaced atomically
+        path = '%s.%s.prom' % (self.path, report['layer'])
+        with open('%s.tmp' % path, 'w') as f:
+            f.write('\n'.join(self.lines(report)) + '\n')
+        os.rename('%s.tmp' % path, path)
+
+
+EXPORTERS = {
+    'statsd': StatsdExporter,
+    'prometheus': PrometheusTextExporter
+}
+
+
+class SyncMetricsMixin(object):
+    """
+    Collects the metrics of each sync run (see SyncMetrics), which are available
+    as structured data in self.metrics_report when the run is complete and
+    are exported by the exporter configured in CITYSDK_METRICS_EXPORTER, if any.
+    Phases of the methods defined by the synchronizers which come before
+    this mixin in the MRO must be measured with the timed decorator.
+    """
+    metrics_report = None
+
+    def sync(self, *args, **kwargs):
+        metrics = start_run_metrics(self.layer)
+        try:
+            with metrics.phase('sync'):
+                return super(SyncMetricsMixin, self).sync(*args, **kwargs)
+        finally:
+            finish_run_metrics(self.layer)
+            self.metrics_report = metrics.as_dict()
+            self.export_metrics(self.metrics_report)
+
+    def export_metrics(self, report):
+        if not CITYSDK_METRICS_EXPORTER:
+            return
+        try:
+            EXPORTERS[CITYSDK_METRICS_EXPORTER]().export(report)
+        except Exception as e:
+            logger.error('could not export metrics of layer %s: %s' % (report['layer'], e))
+
+    @timed('retrieve_data')
+    def retrieve_data(self, *args, **kwargs):
+        return super(SyncMetricsMixin, self).retrieve_data(*args, **kwargs)
+
+    @timed('parse')
+    def parse(self, *args, **kwargs):
+        return super(SyncMetricsMixin, self).parse(*args, **kwargs)
+
+    @timed('save')
+    def save(self, *args, **kwargs):
+        return super(SyncMetricsMixin, self).save(*args, **kwargs)
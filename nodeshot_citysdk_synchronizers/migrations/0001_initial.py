@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'OutboundOperation'
+        db.create_table(u'nodeshot_citysdk_synchronizers_outboundoperation', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('layer', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['layers.Layer'])),
+            ('node_id', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True)),
+            ('external_id', self.gf('django.db.models.fields.CharField')(db_index=True, max_length=255, blank=True)),
+            ('operation', self.gf('django.db.models.fields.CharField')(max_length=6)),
+            ('attempts', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('last_error', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('added', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('updated', self.gf('django.db.models.fields.DateTimeField')(auto_now=True, blank=True)),
+        ))
+        db.send_create_signal(u'nodeshot_citysdk_synchronizers', ['OutboundOperation'])
+
+        # Adding unique constraint on 'OutboundOperation', fields ['layer', 'node_id']
+        db.create_unique(u'nodeshot_citysdk_synchronizers_outboundoperation', ['layer_id', 'node_id'])
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'OutboundOperation', fields ['layer', 'node_id']
+        db.delete_unique(u'nodeshot_citysdk_synchronizers_outboundoperation', ['layer_id', 'node_id'])
+
+        # Deleting model 'OutboundOperation'
+        db.delete_table(u'nodeshot_citysdk_synchronizers_outboundoperation')
+
+    models = {
+        u'layers.layer': {
+            'Meta': {'object_name': 'Layer'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        u'nodeshot_citysdk_synchronizers.outboundoperation': {
+            'Meta': {'ordering': "['pk']", 'unique_together': "(('layer', 'node_id'),)", 'object_name': 'OutboundOperation'},
+            'added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'external_id': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '255', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'layer': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['layers.Layer']"}),
+            'node_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'operation': ('django.db.models.fields.CharField', [], {'max_length': '6'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['nodeshot_citysdk_synchronizers']
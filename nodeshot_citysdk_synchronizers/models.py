@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models, transaction, IntegrityError
+from django.utils.translation import ugettext_lazy as _
+
+from nodeshot.core.layers.models import Layer
+
+
+class OutboundOperationManager(models.Manager):
+    def push(self, layer, operation, obj):
+        """
+        store an operation in the outbound queue of layer,
+        coalescing it with the operation pending for the same record:
+            * add + change = add
+            * change + change = change
+            * add or change + delete = delete
+        obj is a node for add and change, an external id for delete
+        """
+        if operation == 'delete':
+            pending = self.filter(layer=layer, external_id=obj).first()
+            if pending is None:
+                return self.create(layer=layer, operation='delete', external_id=obj)
+            pending.operation = 'delete'
+            pending.attempts = 0
+            pending.save()
+            return pending
+
+        node = obj
+        try:
+            external_id = node.external.external_id
+        except ObjectDoesNotExist:
+            external_id = ''
+        # a node which is already present on the external service can only be changed
+        if external_id:
+            operation = 'change'
+
+        pending = self.filter(layer=layer, node_id=node.pk).first()
+        if pending is None:
+            try:
+                with transaction.atomic():
+                    return self.create(layer=layer, node_id=node.pk,
+                                       external_id=external_id, operation=operation)
+            except IntegrityError:
+                # pushed at the same time by another worker
+                pending = self.get(layer=layer, node_id=node.pk)
+
+        if pending.operation != 'add':
+            pending.operation = 'change'
+        pending.external_id = external_id or pending.external_id
+        pending.attempts = 0
+        pending.save()
+        return pending
+
+
+class OutboundOperation(models.Model):
+    """
+    operation waiting to be pushed to the external service of a layer;
+    removed from the queue as soon as it has been performed
+    """
+    OPERATIONS = (
+        ('add', _('add')),
+        ('change', _('change')),
+        ('delete', _('delete')),
+    )
+    layer = models.ForeignKey(Layer, verbose_name=_('layer'))
+    # not a foreign key: delete operations outlive their nodes
+    node_id = models.IntegerField(_('node id'), null=True, blank=True)
+    external_id = models.CharField(_('external id'), max_length=255, blank=True, db_index=True)
+    operation = models.CharField(_('operation'), max_length=6, choices=OPERATIONS)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    last_error = models.TextField(_('last error'), blank=True)
+    added = models.DateTimeField(_('added'), auto_now_add=True)
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+
+    objects = OutboundOperationManager()
+
+    class Meta:
+        ordering = ['pk']
+        unique_together = ('layer', 'node_id')
+        verbose_name = _('outbound operation')
+        verbose_name_plural = _('outbound operations')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.operation, self.node_id or self.external_id)
+
+    def perform(self, synchronizer):
+        """ push the operation through synchronizer, returns False if it failed """
+        from nodeshot.core.nodes.models import Node
+
+        if self.operation == 'delete':
+            return synchronizer.delete(self.external_id)
+
+        try:
+            node = Node.objects.get(pk=self.node_id)
+        except Node.DoesNotExist:
+            # node deleted before it could be pushed, if it was present
+            # on the external service a delete operation is queued too
+            return True
+
+        # an add interrupted after the node was stored on the external service becomes a change
+        try:
+            node.external
+        except ObjectDoesNotExist:
+            return synchronizer.add(node)
+        return synchronizer.change(node)
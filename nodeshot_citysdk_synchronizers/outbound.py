@@ -0,0 +1,30 @@
+from __future__ import absolute_import
+
+from .models import OutboundOperation
+from .tasks import schedule_outbound_drain
+
+
+class OutboundQueueMixin(object):
+    """
+    Optional persistent outbound queue for the CitySDK mixins:
+    when enabled add, change and delete store the operation in the DB
+    and return immediately, a celery task pushes queued operations later
+    """
+    _draining = False
+
+    @property
+    def outbound_queue(self):
+        return bool(self.config.get('citysdk_outbound_queue', False)) and not self._draining
+
+    def _queue_outbound(self, operation, obj):
+        """ store operation in the outbound queue if enabled, returns False otherwise """
+        if not self.outbound_queue:
+            return False
+        OutboundOperation.objects.push(self.layer, operation, obj)
+        schedule_outbound_drain(self.layer.pk)
+        return True
+
+    def prepare_drain(self):
+        """ called by the drain task before pushing queued operations """
+        self._draining = True
+        self.authenticate(force_http_request=True)
@@ -0,0 +1,158 @@
+from __future__ import absolute_import
+
+import codecs
+import simplejson as json
+
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+
+def iter_xml_records(source, tag, record_class):
+    """
+    parses incrementally the XML contained in the file-like object source
+    and yields an instance of record_class (eg: a namedtuple) for each element
+    named tag; each field of record_class is filled with the text of the first
+    child element with the same name (empty string if missing).
+    Elements are freed as soon as they have been processed, at any depth
+    of the document, so memory usage does not depend on its size.
+    """
+    fields = record_class._fields
+    # elements which have been opened and not closed yet
+    parents = []
+
+    for event, element in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        # ignore namespaces
+        if element.tag.rsplit('}', 1)[-1] != tag:
+            continue
+
+        values = {}
+        for child in element:
+            field = child.tag.rsplit('}', 1)[-1]
+            if field in fields and field not in values:
+                values[field] = unicode(child.text or '')
+        for field in fields:
+            values.setdefault(field, u'')
+
+        yield record_class(**values)
+        # free memory of the elements processed so far: the parent
+        # contains only this element and the siblings which precede it
+        if parents:
+            del parents[-1][:]
+        else:
+            element.clear()
+
+
+class JsonStreamReader(object):
+    """
+    reads JSON tokens and values from a stream of chunks of UTF-8 encoded bytes
+    (eg: requests.Response.iter_content()) keeping in memory only the chunks
+    which have not been consumed yet
+    """
+    WHITESPACE = u' \t\n\r'
+    DELIMITERS = WHITESPACE + u',:]}'
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = u''
+        self.position = 0
+        self.eof = False
+
+    def _read(self):
+        """ append next chunk to the buffer and discard what has been consumed """
+        try:
+            text = self.text_decoder.decode(next(self.chunks))
+        except StopIteration:
+            text = self.text_decoder.decode(b'', True)
+            self.eof = True
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+
+    def _skip_whitespace(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in self.WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer) or self.eof:
+                return
+            self._read()
+
+    def next_char(self):
+        """ returns the next character which is not whitespace """
+        self._skip_whitespace()
+        if self.position >= len(self.buffer):
+            raise ValueError('unexpected end of JSON data')
+        char = self.buffer[self.position]
+        self.position += 1
+        return char
+
+    def expect(self, *expected):
+        """ consumes the next character and returns it if it is one of the expected ones """
+        char = self.next_char()
+        if char not in expected:
+            raise ValueError('expected %s but found "%s" in JSON data' % (
+                ' or '.join('"%s"' % e for e in expected), char
+            ))
+        return char
+
+    def peek(self):
+        """ returns the next character which is not whitespace without consuming it """
+        self._skip_whitespace()
+        if self.position >= len(self.buffer):
+            raise ValueError('unexpected end of JSON data')
+        return self.buffer[self.position]
+
+    def decode(self):
+        """ decodes the next JSON value, reading more chunks until it is complete """
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                # a value which is not followed by a delimiter might have been
+                # truncated at the end of the buffer (eg: "12.4" of "12.48")
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in self.DELIMITERS):
+                    self.position = end
+                    return value
+            self._read()
+
+
+def iter_json_array(chunks, key):
+    """
+    parses incrementally a JSON object received in chunks of bytes and yields
+    one at a time the items of the array stored in its attribute key,
+    eg: iter_json_array(response.iter_content(), 'features') for GeoJSON.
+    Parsing stops at the end of the array, the rest of the document is not read.
+    """
+    reader = JsonStreamReader(chunks)
+    reader.expect('{')
+
+    if reader.peek() == '}':
+        return
+
+    while True:
+        name = reader.decode()
+        reader.expect(':')
+
+        if name == key:
+            reader.expect('[')
+            if reader.peek() == ']':
+                return
+            while True:
+                yield reader.decode()
+                if reader.expect(',', ']') == ']':
+                    return
+
+        # skip values of other attributes
+        reader.decode()
+        if reader.expect(',', '}') == '}':
+            return
@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+
+import simplejson as json
+
+
+class TourismPayloadBuilder(object):
+    """
+    Serializes the records sent to the CitySDK Tourism API.
+    The parts of the payload which are the same for every node of a layer
+    (srsName, term, category, base, lang, author, license) are serialized
+    once in a template, only the fields of each node are serialized later.
+    """
+    SRS_NAME = 'http://www.opengis.net/def/crs/EPSG/0/4326'
+    # fields which change for each node
+    FIELDS = ('id', 'posList', 'vcard', 'label', 'description', 'created')
+
+    def __init__(self, citysdk_type, term, lang, category_id, base, author):
+        self.key = (citysdk_type, term, lang, category_id, base, author)
+        record = {
+            "location": {
+                "point": [
+                    {
+                        "Point": {
+                            "posList": self._placeholder('posList'),
+                            "srsName": self.SRS_NAME
+                        },
+                        "term": term
+                    }
+                ],
+                "address": {
+                    "value": self._placeholder('vcard'),
+                    "type": "text/vcard"
+                },
+            },
+            "label": [
+                {
+                    "term": "primary",
+                    "value": self._placeholder('label')
+                },
+            ],
+            "description": [
+                {
+                    "value": self._placeholder('description'),
+                    "lang": lang
+                },
+            ],
+            "category": [
+                {
+                    "id": category_id
+                }
+            ],
+            "base": base,
+            "lang": lang,
+            "created": self._placeholder('created'),
+            "author": {
+                "term": "primary",
+                "value": author
+            },
+            "license": {
+                "term": "primary",
+                "value": "open-data"
+            }
+        }
+        self.add_template = self._compile({ citysdk_type: record })
+        record['id'] = self._placeholder('id')
+        self.change_template = self._compile({ citysdk_type: record })
+
+    @staticmethod
+    def _placeholder(field):
+        return '__citysdk_%s__' % field
+
+    def _compile(self, payload):
+        """ serialize payload once, leaving a %(field)s slot for each field of the nodes """
+        template = json.dumps(payload).replace('%', '%%')
+        for field in self.FIELDS:
+            template = template.replace('"%s"' % self._placeholder(field), '%%(%s)s' % field)
+        return template
+
+    def build(self, lat, lng, name, vcard_address, description, created, external_id=None):
+        """ returns the JSON payload (bytes) of a node, including its id if external_id is given """
+        values = {
+            'posList': json.dumps('%s %s' % (float(lat), float(lng))),
+            'vcard': json.dumps(u'BEGIN:VCARD\nN:;%s;;;;\n%s\nEND:VCARD' % (name, vcard_address)),
+            'label': json.dumps(name),
+            'description': json.dumps(description),
+            'created': json.dumps(created)
+        }
+        if external_id is None:
+            payload = self.add_template % values
+        else:
+            values['id'] = json.dumps(external_id)
+            payload = self.change_template % values
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        return payload
@@ -0,0 +1,231 @@
+from __future__ import absolute_import
+
+import simplejson as json
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from nodeshot.core.nodes.models import Node
+
+from .metrics import timed
+
+
+def diff_node(node, values):
+    """
+    field-level deltas {field: (old value, new value)} between
+    a node and the values of its external record; no query is performed
+    """
+    deltas = {}
+    for field, value in values.items():
+        old = getattr(node, field)
+        if field == 'geometry':
+            if old is None or not old.equals(value):
+                deltas[field] = (old, value)
+        elif old != value:
+            deltas[field] = (old, value)
+    return deltas
+
+
+def _dump_value(field, value):
+    if field == 'geometry' and value is not None:
+        return json.loads(value.json)
+    return value
+
+
+def _load_value(field, value):
+    if field == 'geometry' and value is not None:
+        return GEOSGeometry(json.dumps(value))
+    return value
+
+
+class SyncPlan(object):
+    """
+    Changes a sync would apply to the nodes of a layer, computed in memory
+    from the external records and a snapshot of the nodes, without side effects:
+        * adds: values of the fields of the nodes to create
+        * changes: primary key, slug, field-level deltas and fingerprint of the nodes to update
+        * stamps: primary key, slug and fingerprint of unmodified nodes
+          which only need their fingerprint stored
+        * deletes: primary key, slug and name of the nodes of the layer
+          which are not present in the external data anymore
+    Plans can be serialized with as_dict() and loaded again with from_dict(),
+    geometries are represented in GeoJSON.
+    """
+    def __init__(self, adds=None, changes=None, stamps=None, deletes=None,
+                 unmodified=0, fingerprint_hits=0, records=0):
+        self.adds = adds or []
+        self.changes = changes or []
+        self.stamps = stamps or []
+        self.deletes = deletes or []
+        # unmodified nodes, stamped ones included
+        self.unmodified = unmodified
+        self.fingerprint_hits = fingerprint_hits
+        self.records = records
+
+    @property
+    def is_noop(self):
+        """ True if executing the plan would not change anything """
+        return not (self.adds or self.changes or self.stamps or self.deletes)
+
+    def add(self, values):
+        self.adds.append(values)
+
+    def skip(self):
+        """ record unchanged since last sync according to its fingerprint """
+        self.fingerprint_hits += 1
+        self.unmodified += 1
+
+    def delete(self, node):
+        self.deletes.append({ 'pk': node.pk, 'slug': node.slug, 'name': node.name })
+
+    def compare(self, node, slug, deltas, fingerprint):
+        """ plan a change of an existing node, a fingerprint stamp or nothing """
+        if deltas:
+            self.changes.append({ 'pk': node.pk, 'slug': slug, 'deltas': deltas, 'fingerprint': fingerprint })
+            return
+        if (node.data or {}).get('fingerprint') != fingerprint:
+            self.stamps.append({ 'pk': node.pk, 'slug': slug, 'fingerprint': fingerprint })
+        self.unmodified += 1
+
+    def as_dict(self):
+        """ JSON serializable representation """
+        return {
+            'adds': [
+                dict((field, _dump_value(field, value)) for field, value in values.items())
+                for values in self.adds
+            ],
+            'changes': [
+                dict(change, deltas=dict(
+                    (field, [_dump_value(field, old), _dump_value(field, new)])
+                    for field, (old, new) in change['deltas'].items()
+                ))
+                for change in self.changes
+            ],
+            'stamps': list(self.stamps),
+            'deletes': list(self.deletes),
+            'unmodified': self.unmodified,
+            'fingerprint_hits': self.fingerprint_hits,
+            'records': self.records
+        }
+
+    @classmethod
+    def from_dict(cls, plan):
+        return cls(
+            adds=[
+                dict((field, _load_value(field, value)) for field, value in values.items())
+                for values in plan['adds']
+            ],
+            changes=[
+                dict(change, deltas=dict(
+                    (field, (old, _load_value(field, new)))
+                    for field, (old, new) in change['deltas'].items()
+                ))
+                for change in plan['changes']
+            ],
+            stamps=plan['stamps'],
+            deletes=plan['deletes'],
+            unmodified=plan['unmodified'],
+            fingerprint_hits=plan['fingerprint_hits'],
+            records=plan['records']
+        )
+
+
+class SyncPlanMixin(object):
+    """
+    Splits the sync of the nodes in two stages:
+        * plan(): compares the external records with the nodes of the layer,
+          loaded with a single query, and returns a SyncPlan without writing anything
+        * execute_plan(plan): applies a plan in bulk
+    preview() returns the plan of the next sync without applying it.
+    Added and changed nodes are saved by save_nodes(), so synchronizers which push
+    nodes to CitySDK through post_save receive exactly the adds and changes
+    of the plan; stamps are written without sending signals.
+    """
+    # fields which are not validated when executing a plan
+    plan_validate_exclude = None
+
+    def plan(self):
+        raise NotImplementedError()
+
+    def preview(self):
+        """ plan of the changes the next sync would apply """
+        self.retrieve_data()
+        self.parse()
+        return self.plan()
+
+    def validate_planned_node(self, node):
+        try:
+            node.full_clean(exclude=self.plan_validate_exclude)
+        except ValidationError as e:
+            raise Exception("%s errors: %s" % (node.name, e.messages))
+
+    @timed('execute_plan')
+    def execute_plan(self, plan):
+        """ apply plan to the DB, returns the number of deleted nodes """
+        if plan.is_noop:
+            return 0
+
+        # nodes to change or stamp are loaded with a single query
+        existing = dict(
+            (node.pk, node) for node in
+            Node.objects.filter(pk__in=[entry['pk'] for entry in plan.changes + plan.stamps])
+        )
+
+        def get_node(entry):
+            try:
+                return existing[entry['pk']]
+            except KeyError:
+                raise Exception('node "%s" has been deleted after the plan was computed' % entry['slug'])
+
+        added_nodes = []
+        for values in plan.adds:
+            node = Node(layer=self.layer, **values)
+            self.validate_planned_node(node)
+            added_nodes.append(node)
+
+        changed_nodes = []
+        for change in plan.changes:
+            node = get_node(change)
+            for field, (old, new) in change['deltas'].items():
+                setattr(node, field, new)
+            node.data = dict(node.data or {}, fingerprint=change['fingerprint'])
+            self.validate_planned_node(node)
+            changed_nodes.append(node)
+
+        self.save_nodes(added_nodes, changed_nodes)
+        for node in added_nodes:
+            self.verbose('new node saved with name "%s"' % node.name)
+        for node in changed_nodes:
+            self.verbose('node "%s" updated' % node.name)
+
+        # unmodified nodes would be pushed again by post_save
+        with transaction.atomic():
+            for stamp in plan.stamps:
+                node = get_node(stamp)
+                Node.objects.filter(pk=node.pk).update(data=dict(node.data or {}, fingerprint=stamp['fingerprint']))
+
+        # by primary key: the slug of a node might have been given to another one
+        if plan.deletes:
+            Node.objects.filter(layer=self.layer, pk__in=[entry['pk'] for entry in plan.deletes]).delete()
+        for entry in plan.deletes:
+            self.verbose('node "%s" deleted' % entry['name'])
+
+        return len(plan.deletes)
+
+    def check_slug_conflicts(self, nodes):
+        """
+        make sure, with a single query, that no other node has taken
+        the slugs of nodes since the beginning of the sync
+        """
+        conflicts = Node.objects.filter(slug__in=[node.slug for node in nodes])\
+                                .exclude(pk__in=[node.pk for node in nodes if node.pk is not None])\
+                                .values_list('slug', flat=True)
+        if conflicts:
+            raise Exception('slugs already taken by other nodes: %s' % ', '.join(conflicts))
+
+    def save_nodes(self, added_nodes, changed_nodes):
+        """ write added and changed nodes in the DB """
+        with transaction.atomic():
+            for node in added_nodes + changed_nodes:
+                node.save()
@@ -1,18 +1,27 @@
 from __future__ import absolute_import
 
-import requests
 import simplejson as json
 from datetime import date, datetime, timedelta
+from functools import partial
 
-from django.template.defaultfilters import slugify
 from django.contrib.gis.geos import GEOSGeometry
-from django.core.exceptions import ValidationError
+from django.utils.translation import ugettext_lazy as _
+from django.db import connection, transaction
 
 from nodeshot.core.nodes.models import Node, Status
 from nodeshot.interop.sync.synchronizers.base import BaseSynchronizer
 
+from .feeds import FeedCacheMixin
+from .metrics import SyncMetricsMixin, timed
+from .parsers import iter_json_array
+from .planning import SyncPlan, SyncPlanMixin, diff_node
+from .utils import SlugAllocator, record_fingerprint, fingerprint_hit_ratio
 
-class ProvinceRomeTraffic(BaseSynchronizer):
+from celery.utils.log import get_logger
+logger = get_logger(__name__)
+
+
+class ProvinceRomeTraffic(SyncMetricsMixin, SyncPlanMixin, FeedCacheMixin, BaseSynchronizer):
     """ Province of Rome Traffic synchronizer class """
     SCHEMA = [
         {
@@ -27,9 +36,24 @@ class ProvinceRomeTraffic(BaseSynchronizer):
             'name': 'check_streets_every_n_days',
             'class': 'IntegerField',
             'kwargs': { 'default': 2 }
+        },
+        {
+            'name': 'measurements_send_signals',
+            'class': 'BooleanField',
+            'kwargs': {
+                'default': False,
+                'help_text': _('Save each node when storing measurements so that post_save signals are sent (slower)')
+            }
         }
     ]
-
+    # bytes of the streets file read at a time
+    chunk_size = 65536
+    # measurements stored with each UPDATE query
+    measurements_chunk_size = 1000
+    # uniqueness of slugs is checked for all the nodes at once by save_streets
+    plan_validate_exclude = ['slug']
+
+    @timed('retrieve_data')
     def retrieve_data(self):
         """ retrieve data """
         # shortcuts for readability
@@ -38,8 +62,8 @@ class ProvinceRomeTraffic(BaseSynchronizer):
         last_time_streets_checked = self.config.get('last_time_streets_checked', None)
         measurements_url = self.config.get('measurements_url')
 
-        # do HTTP request and store content
-        self.measurements = requests.get(measurements_url, verify=self.verify_ssl).content
+        # download measurements unless they have not changed since the last sync
+        self.measurements = self.fetch_feed('measurements', measurements_url)
 
         try:
             last_time_streets_checked = datetime.strptime(last_time_streets_checked, '%Y-%m-%d').date()
@@ -48,67 +72,175 @@ class ProvinceRomeTraffic(BaseSynchronizer):
 
         # if last time checked more than days specified
         if last_time_streets_checked is None or last_time_streets_checked < date.today() - timedelta(days=check_streets_every_n_days):
-            # get huge streets file
-            self.streets = requests.get(streets_url, verify=self.verify_ssl).content
+            # get huge streets file unless it has not changed since the last check
+            self.streets = self.fetch_feed('streets', streets_url)
+            if self.streets is None:
+                self.config['last_time_streets_checked'] = str(date.today())
+                self.streets = False
         else:
             self.streets = False
 
+    @timed('parse')
     def parse(self):
         """ parse data """
-        self.measurements = json.loads(self.measurements)["features"]
+        if self.measurements is not None:
+            with self.measurements as measurements:
+                self.measurements = json.load(measurements)["features"]
         if self.streets:
-            self.streets = json.loads(self.streets)["features"]
+            # street features are parsed lazily, one at a time, while process_streets consumes them
+            chunks = iter(partial(self.streets.read, self.chunk_size), b'')
+            self.streets = iter_json_array(chunks, 'features')
 
+    @timed('save')
     def save(self):
         """ synchronize DB """
         self.process_streets()
         self.process_measurements()
+        self.store_feed_validators()
 
+    @timed('process_measurements')
     def process_measurements(self):
         items = self.measurements
-        if len(items) < 1:
+        if items is None:
+            self.message += """
+            Measurements not modified since last sync.
+            """
+        elif len(items) < 1:
             self.message += """
             No measurements found.
             """
         else:
-            saved_measurements = 0
+            measurements = {}
             for item in items:
                 try:
-                    node = Node.objects.get(pk=int(item['id']))
-                except Node.DoesNotExist:
-                    print "Could not retrieve node #%s" % item['id']
-                    continue
-                try:
-                    node.data['last_measurement'] = item['properties']['TIMESTAMP']
-                    node.data['velocity'] = item['properties']['VELOCITY']
-                    node.save()
-                    self.verbose('Updated measurement for node %s' % node.id)
-                    saved_measurements += 1
+                    measurements[int(item['id'])] = (
+                        item['properties']['TIMESTAMP'],
+                        item['properties']['VELOCITY']
+                    )
                 except KeyError:
                     pass
+
+            if self.config.get('measurements_send_signals', False):
+                updated = self.save_measurements(measurements)
+            else:
+                updated = self.update_measurements(measurements)
+
+            for pk in sorted(updated):
+                self.verbose('Updated measurement for node %s' % pk)
+
             self.message += """
             Updated measurements of %d street segments out of %d
-            """ % (saved_measurements, len(items))
-
+            """ % (len(updated), len(items))
+
+            missing = sorted(set(measurements) - set(updated))
+            if missing:
+                message = 'Could not retrieve %d nodes: %s' % (
+                    len(missing), ', '.join('#%s' % pk for pk in missing)
+                )
+                logger.warning(message)
+                self.message += """
+            %s
+            """ % message
+
+    def save_measurements(self, measurements):
+        """
+        store measurements by saving each node, post_save signals are sent;
+        returns the primary keys of the nodes which have been updated
+        """
+        nodes = Node.objects.in_bulk(list(measurements.keys()))
+        with transaction.atomic():
+            for pk, node in nodes.items():
+                node.data['last_measurement'], node.data['velocity'] = measurements[pk]
+                node.save()
+        return list(nodes.keys())
+
+    def update_measurements(self, measurements):
+        """
+        store measurements in the hstore data field of the nodes with a single
+        UPDATE query for each chunk of measurements, no signal is sent;
+        returns the primary keys of the nodes which have been updated
+        """
+        sql = (
+            'UPDATE {table} AS node '
+            'SET {data} = COALESCE(node.{data}, \'\'::hstore) || '
+            'hstore(ARRAY[\'last_measurement\', \'velocity\'], ARRAY[m.last_measurement::text, m.velocity::text]) '
+            'FROM (VALUES {values}) AS m (id, last_measurement, velocity) '
+            'WHERE node.{pk} = m.id '
+            'RETURNING node.{pk}'
+        )
+        quote_name = connection.ops.quote_name
+        items = list(measurements.items())
+        updated = []
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            for i in range(0, len(items), self.measurements_chunk_size):
+                chunk = items[i:i + self.measurements_chunk_size]
+                params = []
+                for pk, (timestamp, velocity) in chunk:
+                    # null values are stored as NULL, as node.save() does
+                    params += [pk] + [None if value is None else unicode(value) for value in (timestamp, velocity)]
+                cursor.execute(sql.format(
+                    table=quote_name(Node._meta.db_table),
+                    data=quote_name(Node._meta.get_field('data').column),
+                    pk=quote_name(Node._meta.pk.column),
+                    values=', '.join(['(%s, %s, %s)'] * len(chunk))
+                ), params)
+                updated += [row[0] for row in cursor.fetchall()]
+
+        return updated
+
+    @timed('process_streets')
     def process_streets(self):
         if not self.streets:
             self.message = """
             Street data not processed.
             """
             return False
-        # retrieve all items
-        items = self.streets
 
-        # init empty lists
-        added_nodes = []
-        changed_nodes = []
-        unmodified_nodes = []
+        plan = self.plan()
+        deleted_nodes_count = self.execute_plan(plan)
 
-        # retrieve a list of local nodes in DB
-        local_nodes_slug = Node.objects.filter(layer=self.layer).values_list('slug', flat=True)
-        # init empty list of slug of external nodes that will be needed to perform delete operations
-        external_nodes_slug = []
-        deleted_nodes_count = 0
+        # stored in the DB by store_feed_validators
+        self.config['last_time_streets_checked'] = str(date.today())
+
+        # message that will be returned
+        self.message = """
+            %s streets added
+            %s streets changed
+            %s streets deleted
+            %s streets unmodified
+            %s fingerprint hits (%.1f%% of external records)
+            %s total external records processed
+            %s total local records for this layer
+        """ % (
+            len(plan.adds),
+            len(plan.changes),
+            deleted_nodes_count,
+            plan.unmodified,
+            plan.fingerprint_hits,
+            fingerprint_hit_ratio(plan.fingerprint_hits, plan.records),
+            plan.records,
+            Node.objects.filter(layer=self.layer).count()
+        )
+
+    @timed('plan')
+    def plan(self):
+        """ compare the street segments with the nodes, returns a SyncPlan """
+        plan = SyncPlan()
+        if not self.streets:
+            return plan
+
+        # retrieve local nodes of this layer with a single query
+        local_nodes = dict((node.pk, node) for node in Node.objects.filter(layer=self.layer))
+        # slugs of external nodes, needed to give unique names and to perform delete operations;
+        # slugs of all the nodes in the DB are loaded once to find name collisions in memory
+        reserved = dict(Node.objects.values_list('slug', 'pk'))
+        external_nodes_slug = SlugAllocator(reserved=reserved)
+        # segments whose node belongs to another layer, compared at the end with a single query
+        other_layers_pks = set(reserved.values()) - set(local_nodes)
+        deferred = []
+        external_nodes_pk = set()
 
         try:
             self.status = Status.objects.get(slug=self.config.get('status', None))
@@ -116,116 +248,76 @@ class ProvinceRomeTraffic(BaseSynchronizer):
             self.status = None
 
         # loop over every parsed item
-        for item in items:
+        for item in self.streets:
+            plan.records += 1
             # retrieve info in auxiliary variables
             # readability counts!
-            pk = item['id']
+            pk = int(item['id'])
+            external_nodes_pk.add(pk)
             name = item['properties'].get('LOCATION', '')[0:70]
             address = name
-            slug = slugify(name)
 
-            number = 1
+            # items might have the same name... so we add a number..
+            # slugs of other nodes in the DB are taken too
             original_name = name
-            needed_different_name = False
-
-            while True:
-                # items might have the same name... so we add a number..
-                # check in DB too
-                if slug in external_nodes_slug or Node.objects.filter(slug__exact=slug).exclude(pk=pk).count() > 0:
-                    needed_different_name = True
-                    number = number + 1
-                    name = "%s - %d" % (original_name, number)
-                    slug = slug = slugify(name)
-                else:
-                    if needed_different_name:
-                        self.verbose('needed a different name for %s, trying "%s"' % (original_name, name))
-                    break
-
-            # geometry object
-            geometry = GEOSGeometry(json.dumps(item["geometry"]))
-
-            # default values
-            added = False
-            changed = False
-
-            try:
-                # edit existing node
-                node = Node.objects.get(pk=pk)
-            except Node.DoesNotExist:
-                # add a new node
-                node = Node()
-                node.id = pk
-                node.layer = self.layer
-                node.status = self.status
-                node.data = {}
-                added = True
-
-            if node.name != name:
-                node.name = name
-                changed = True
-
-            if node.slug != slug:
-                node.slug = slug
-                changed = True
-
-            if added is True or node.geometry.equals(geometry) is False:
-                node.geometry = geometry
-                changed = True
-
-            if node.address != address:
-                node.address = address
-                changed = True
-
-            # perform save or update only if necessary
-            if added or changed:
-                try:
-                    node.full_clean()
-                    node.save()
-                except ValidationError as e:
-                    raise Exception("%s errors: %s" % (name, e.messages))
-
-            if added:
-                added_nodes.append(node)
-                self.verbose('new node saved with name "%s"' % node.name)
-            elif changed:
-                changed_nodes.append(node)
-                self.verbose('node "%s" updated' % node.name)
-            else:
-                unmodified_nodes.append(node)
-                self.verbose('node "%s" unmodified' % node.name)
-
-            # fill node list container
-            external_nodes_slug.append(node.slug)
-
-        # delete old nodes
-        for local_node in local_nodes_slug:
-            # if local node not found in external nodes
-            if local_node not in external_nodes_slug:
-                node_name = node.name
-                # retrieve from DB and delete
-                node = Node.objects.get(slug=local_node)
-                node.delete()
-                # then increment count that will be included in message
-                deleted_nodes_count = deleted_nodes_count + 1
-                self.verbose('node "%s" deleted' % node_name)
+            name, slug = external_nodes_slug.allocate(original_name, pk=pk)
+            if name != original_name:
+                self.verbose('needed a different name for %s, trying "%s"' % (original_name, name))
 
-        self.config['last_time_streets_checked'] = str(date.today())
-        self.layer.external.config = self.config
-        self.layer.external.save()
+            geometry_json = json.dumps(item["geometry"], sort_keys=True)
+            fingerprint = record_fingerprint(name, address, geometry_json)
+            node = local_nodes.get(pk)
 
-        # message that will be returned
-        self.message = """
-            %s streets added
-            %s streets changed
-            %s streets deleted
-            %s streets unmodified
-            %s total external records processed
-            %s total local records for this layer
-        """ % (
-            len(added_nodes),
-            len(changed_nodes),
-            deleted_nodes_count,
-            len(unmodified_nodes),
-            len(items),
-            Node.objects.filter(layer=self.layer).count()
-        )
+            # record unchanged since last sync, no need to compare fields
+            if node is not None and node.data and node.data.get('fingerprint') == fingerprint:
+                plan.skip()
+                self.verbose('node "%s" unmodified' % node.name)
+                continue
+
+            values = {
+                'name': name,
+                'slug': slug,
+                'geometry': GEOSGeometry(geometry_json),
+                'address': address
+            }
+
+            # edit existing node (it might belong to another layer)
+            if node is None and pk in other_layers_pks:
+                deferred.append((pk, values, fingerprint))
+            elif node is None:
+                plan.add(dict(values, id=pk, status_id=self.status.pk if self.status else None,
+                              data={ 'fingerprint': fingerprint }))
+            else:
+                self.compare_street(plan, node, values, fingerprint)
+
+        if deferred:
+            other_layers_nodes = Node.objects.in_bulk([pk for pk, values, fingerprint in deferred])
+            for pk, values, fingerprint in deferred:
+                self.compare_street(plan, other_layers_nodes[pk], values, fingerprint)
+
+        # nodes not present in the streets file anymore; compared by primary key,
+        # the slug of a street changes when it is renamed or when its number shifts
+        for pk, node in local_nodes.items():
+            if pk not in external_nodes_pk:
+                plan.delete(node)
+        return plan
+
+    def compare_street(self, plan, node, values, fingerprint):
+        deltas = diff_node(node, values)
+        plan.compare(node, values['slug'], deltas, fingerprint)
+        if not deltas:
+            self.verbose('node "%s" unmodified' % node.name)
+
+    def save_nodes(self, added_nodes, changed_nodes):
+        self.save_streets(added_nodes + changed_nodes)
+
+    def save_streets(self, nodes):
+        """
+        write added and changed streets in the DB after making sure, with a single query,
+        that no other node has taken their slugs since the beginning of the sync
+        """
+        self.check_slug_conflicts(nodes)
+
+        with transaction.atomic():
+            for node in nodes:
+                node.save()
@@ -1,167 +1,184 @@
 from __future__ import absolute_import
 
-from django.template.defaultfilters import slugify
+from collections import namedtuple
+
 from django.contrib.gis.geos import Point
-from django.core.exceptions import ValidationError
+from django.db import transaction
 
 from nodeshot.core.nodes.models import Node, Status
 from nodeshot.interop.sync.synchronizers.base import XmlSynchronizer, GenericGisSynchronizer
 
+from .feeds import FeedCacheMixin
+from .metrics import SyncMetricsMixin, timed
+from .parsers import iter_xml_records
+from .planning import SyncPlan, SyncPlanMixin, diff_node
+from .utils import SlugAllocator, record_fingerprint, fingerprint_hit_ratio
+
+
+AccessPoint = namedtuple('AccessPoint', [
+    'Denominazione', 'Indirizzo', 'Comune', 'Latitudine', 'longitudine', 'Tipologia'
+])
 
-class ProvinciaWifi(XmlSynchronizer):
+class ProvinciaWifi(SyncMetricsMixin, SyncPlanMixin, FeedCacheMixin, XmlSynchronizer):
     """ ProvinciaWifi synchronizer class """
     SCHEMA = GenericGisSynchronizer.SCHEMA[0:3]
-
+    # insert new nodes with a single query in one transaction;
+    # bulk_create does not send the post_save signal, synchronizers which
+    # push the new nodes to external services through it must disable this
+    bulk_create_nodes = True
+    # uniqueness of slugs is checked for all the nodes at once by save_nodes
+    plan_validate_exclude = ['slug']
+
+    @timed('retrieve_data')
+    def retrieve_data(self):
+        """ download the XML feed unless it has not changed since the last sync """
+        self.data = self.fetch_feed('xml', self.config.get('url'))
+
+    @timed('parse')
+    def parse(self):
+        """ AccessPoint records are parsed lazily, one at a time, while save() consumes them """
+        if self.data is None:
+            self.parsed_data = None
+        else:
+            self.parsed_data = iter_xml_records(self.data, 'AccessPoint', AccessPoint)
+
+    @timed('save')
     def save(self):
         """ synchronize DB """
-        # retrieve all items
-        items = self.parsed_data.getElementsByTagName('AccessPoint')
+        if self.parsed_data is None:
+            self.message = """
+            Feed not modified since last sync.
+            """
+            self.store_feed_validators()
+            return
+
+        plan = self.plan()
+        deleted_nodes_count = self.execute_plan(plan)
+
+        self.data.close()
+        self.store_feed_validators()
+
+        # message that will be returned
+        self.message = """
+            %s nodes added
+            %s nodes changed
+            %s nodes deleted
+            %s nodes unmodified
+            %s fingerprint hits (%.1f%% of external records)
+            %s total external records processed
+            %s total local nodes for this layer
+        """ % (
+            len(plan.adds),
+            len(plan.changes),
+            deleted_nodes_count,
+            plan.unmodified,
+            plan.fingerprint_hits,
+            fingerprint_hit_ratio(plan.fingerprint_hits, plan.records),
+            plan.records,
+            Node.objects.filter(layer=self.layer).count()
+        )
 
-        # init empty lists
-        added_nodes = []
-        changed_nodes = []
-        unmodified_nodes = []
+    @timed('plan')
+    def plan(self):
+        """ compare the AccessPoint records with the nodes of the layer, returns a SyncPlan """
+        plan = SyncPlan()
+        if self.parsed_data is None:
+            return plan
 
-        # retrieve a list of local nodes in DB
-        local_nodes_slug = Node.objects.filter(layer=self.layer).values_list('slug', flat=True)
-        # init empty list of slug of external nodes that will be needed to perform delete operations
-        external_nodes_slug = []
-        deleted_nodes_count = 0
+        # retrieve local nodes of this layer with a single query
+        local_nodes = dict((node.slug, node) for node in Node.objects.filter(layer=self.layer))
+        # slugs of external nodes, needed to give unique names and to perform delete operations;
+        # slugs of the nodes of other layers are loaded once to find name collisions in memory
+        reserved = dict(Node.objects.exclude(layer=self.layer).values_list('slug', 'pk'))
+        external_nodes_slug = SlugAllocator(reserved=reserved)
 
         try:
             self.status = Status.objects.get(slug=self.config.get('default_status', None))
         except Status.DoesNotExist:
             self.status = None
+        status_pk = self.status.pk if self.status is not None else None
+        # bulk_create does not call Node.save(), which gives new nodes the default status
+        new_status_pk = status_pk
+        if new_status_pk is None:
+            new_status_pk = Status.objects.filter(is_default=True).values_list('pk', flat=True).first()
 
         # loop over every parsed item
-        for item in items:
-            address = '%s, %s' % (
-                self.get_text(item, 'Indirizzo'),
-                self.get_text(item, 'Comune')
-            )
+        for item in self.parsed_data:
+            plan.records += 1
+            address = '%s, %s' % (item.Indirizzo, item.Comune)
             # retrieve info in auxiliary variables
             # readability counts!
-            name = self.get_text(item, 'Denominazione')[0:70]
+            name = item.Denominazione[0:70]
             # "denominazione" might be empty
             if not name:
                 name = address
-            slug = slugify(name)
             # items might have the same name... so we add a number..
-            number = 1
+            # slugs of the nodes of other layers are taken too
             original_name = name
-            needed_different_name = False
-            while True:
-                if slug in external_nodes_slug:
-                    needed_different_name = True
-                    number = number + 1
-                    name = "%s - %d" % (original_name, number)
-                    slug = slug = slugify(name)
-                else:
-                    if needed_different_name:
-                        self.verbose('needed a different name for %s, trying "%s"' % (original_name, name))
-                    break
-
-            lat = self.get_text(item, 'Latitudine')
-            lng = self.get_text(item, 'longitudine')
-            description = 'Indirizzo: %s, %s; Tipologia: %s' % (
-                self.get_text(item, 'Indirizzo'),
-                self.get_text(item, 'Comune'),
-                self.get_text(item, 'Tipologia')
-            )
-
-            # point object
-            point = Point(float(lng), float(lat))
-
-            # default values
-            added = False
-            changed = False
-
-            try:
-                # edit existing node
-                node = Node.objects.get(slug=slug)
-            except Node.DoesNotExist:
-                # add a new node
-                node = Node()
-                node.layer = self.layer
-                node.status = self.status
-                added = True
-
-            if self.status is not None and node.status != self.status:
-                node.status = self.status
-                changed = True
-
-            if node.name != name:
-                node.name = name
-                changed = True
-
-            if node.slug != slug:
-                node.slug = slug
-                changed = True
-
-            if added is True or node.geometry.equals(point) is False:
-                node.geometry = point
-                changed = True
-
-            if node.description != description:
-                node.description = description
-                changed = True
-
-            if node.address != address:
-                node.address = address  # complete address
-                node.data = {
-                    'address': self.get_text(item, 'Indirizzo'),
-                    'city': self.get_text(item, 'Comune'),
-                    'province': 'Roma',
-                    'country': 'Italia'
-                }
-                changed = True
-
-            # perform save or update only if necessary
-            if added or changed:
-                try:
-                    node.full_clean()
-                    node.save()
-                except ValidationError as e:
-                    raise Exception("%s errors: %s" % (name, e.messages))
-
-            if added:
-                added_nodes.append(node)
-                self.verbose('new node saved with name "%s"' % node.name)
-            elif changed:
-                changed_nodes.append(node)
-                self.verbose('node "%s" updated' % node.name)
-            else:
-                unmodified_nodes.append(node)
-                self.verbose('node "%s" unmodified' % node.name)
+            name, slug = external_nodes_slug.allocate(original_name)
+            if name != original_name:
+                self.verbose('needed a different name for %s, trying "%s"' % (original_name, name))
 
-            # fill node list container
-            external_nodes_slug.append(node.slug)
-
-        # delete old nodes
-        for local_node in local_nodes_slug:
-            # if local node not found in external nodes
-            if local_node not in external_nodes_slug:
-                node_name = node.name
-                # retrieve from DB and delete
-                node = Node.objects.get(slug=local_node)
-                node.delete()
-                # then increment count that will be included in message
-                deleted_nodes_count = deleted_nodes_count + 1
-                self.verbose('node "%s" deleted' % node_name)
+            lat = item.Latitudine
+            lng = item.longitudine
 
-        # message that will be returned
-        self.message = """
-            %s nodes added
-            %s nodes changed
-            %s nodes deleted
-            %s nodes unmodified
-            %s total external records processed
-            %s total local nodes for this layer
-        """ % (
-            len(added_nodes),
-            len(changed_nodes),
-            deleted_nodes_count,
-            len(unmodified_nodes),
-            len(items),
-            Node.objects.filter(layer=self.layer).count()
-        )
+            fingerprint = record_fingerprint(name, item.Indirizzo, item.Comune,
+                                             lat, lng, item.Tipologia, status_pk)
+            node = local_nodes.get(slug)
+
+            # record unchanged since last sync, no need to compare fields
+            if node is not None and node.data and node.data.get('fingerprint') == fingerprint:
+                plan.skip()
+                self.verbose('node "%s" unmodified' % node.name)
+                continue
+
+            values = {
+                'name': name,
+                'slug': slug,
+                'geometry': Point(float(lng), float(lat)),
+                'description': 'Indirizzo: %s; Tipologia: %s' % (address, item.Tipologia),
+                'address': address  # complete address
+            }
+            data = {
+                'address': item.Indirizzo,
+                'city': item.Comune,
+                'province': 'Roma',
+                'country': 'Italia'
+            }
+
+            if node is None:
+                plan.add(dict(values, status_id=new_status_pk, data=dict(data, fingerprint=fingerprint)))
+                continue
+
+            if status_pk is not None:
+                values['status_id'] = status_pk
+            deltas = diff_node(node, values)
+            # data is replaced only together with the address
+            if 'address' in deltas:
+                deltas['data'] = (node.data, data)
+            plan.compare(node, slug, deltas, fingerprint)
+            if not deltas:
+                self.verbose('node "%s" unmodified' % node.name)
+
+        # nodes not present in the feed anymore
+        for slug, node in local_nodes.items():
+            if slug not in external_nodes_slug:
+                plan.delete(node)
+        return plan
+
+    def save_nodes(self, added_nodes, changed_nodes):
+        """
+        write added and changed nodes in the DB after making sure, with a single query,
+        that no other node has taken their slugs since the beginning of the sync
+        """
+        self.check_slug_conflicts(added_nodes + changed_nodes)
+
+        if not self.bulk_create_nodes:
+            for node in added_nodes + changed_nodes:
+                node.save()
+            return
+
+        with transaction.atomic():
+            Node.objects.bulk_create(added_nodes)
+            for node in changed_nodes:
+                node.save()
@@ -11,3 +11,5 @@ class ProvinciaWifiCitySdkMobility(CitySdkMobilityMixin, ProvinciaWifi):
     to CitySDK mobility API
     """
     SCHEMA = CitySdkMobilityMixin.SCHEMA + ProvinciaWifi.SCHEMA
+    # new nodes are pushed to CitySDK by the post_save signal
+    bulk_create_nodes = False
@@ -11,3 +11,5 @@ class ProvinciaWifiCitySdkTourism(CitySdkTourismMixin, ProvinciaWifi):
     to CitySDK tourism API
     """
     SCHEMA = CitySdkTourismMixin.SCHEMA + ProvinciaWifi.SCHEMA
+    # new nodes are pushed to CitySDK by the post_save signal
+    bulk_create_nodes = False
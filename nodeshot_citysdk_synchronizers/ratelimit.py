@@ -0,0 +1,236 @@
+from __future__ import absolute_import
+
+import hashlib
+import threading
+from contextlib import contextmanager
+from time import time, sleep
+
+from django.core.cache import cache
+
+from celery.utils.log import get_logger
+logger = get_logger(__name__)
+
+STATE_KEY = 'citysdk-rate-%s'
+LOCK_KEY = 'citysdk-rate-lock-%s'
+
+
+class TokenBucket(object):
+    """
+    Token bucket which limits the requests sent to a CitySDK instance:
+        * up to rate requests per second, with bursts of up to burst requests
+        * the rate is halved when the server shows signs of overload
+          (429 or 503 responses, latency spikes) and goes back up
+          gradually as requests succeed
+        * Retry-After headers stop all the requests for the time requested
+    The state of the bucket is kept in the Django cache, so the same budget
+    is shared by the threads and the processes (eg: celery workers) which use
+    a bucket with the same key, as long as the cache backend is shared too
+    (eg: memcached, not locmem). Each owner (eg: a layer) configures its own
+    limit, the lowest limit of the owners which sent requests recently applies.
+    """
+    # rate never goes below this fraction of the configured rate
+    min_rate_ratio = 0.05
+    # fraction of the configured rate recovered after each successful request
+    recovery_ratio = 0.02
+    # a request slower than this multiple of the average latency is a spike
+    latency_spike_factor = 4
+    # weight of the last request in the average latency
+    latency_smoothing = 0.1
+    # seconds after which the lock left by a crashed process expires
+    lock_timeout = 10
+    # seconds after which the state of an unused bucket is discarded
+    state_timeout = 86400
+    # seconds after which the limit of an owner which sent no requests is ignored
+    owner_timeout = 3600
+
+    def __init__(self, key, rate=None, burst=None, owner=None):
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+        self.state_key = STATE_KEY % digest
+        self.lock_key = LOCK_KEY % digest
+        self.lock = threading.Lock()
+        self.owner = owner
+        self.limit = None
+        # a bucket without rate can only release() the limit of its owner
+        if rate is not None:
+            self.configure(rate, burst, owner)
+
+    def _initial_state(self):
+        rate, capacity = self.limit
+        return {
+            'limits': { self.owner: self.limit + (time(),) },
+            'max_rate': rate,
+            'capacity': capacity,
+            'rate': rate,
+            'tokens': capacity,
+            'updated': time(),
+            'blocked_until': 0,
+            'latency': None
+        }
+
+    @contextmanager
+    def _state(self, create=True):
+        """
+        state of the bucket, locked while in use and stored again at exit;
+        None if the state does not exist and create is False
+        """
+        with self.lock:
+            while not cache.add(self.lock_key, True, self.lock_timeout):
+                sleep(0.005)
+            try:
+                state = cache.get(self.state_key)
+                # state discarded by the cache, start over with the limit of this owner
+                if not state and create:
+                    state = self._initial_state()
+                yield state
+                if state:
+                    cache.set(self.state_key, state, self.state_timeout)
+                else:
+                    cache.delete(self.state_key)
+            finally:
+                cache.delete(self.lock_key)
+
+    def _get(self, name):
+        return (cache.get(self.state_key) or self._initial_state())[name]
+
+    @property
+    def rate(self):
+        return self._get('rate')
+
+    @property
+    def max_rate(self):
+        return self._get('max_rate')
+
+    @property
+    def capacity(self):
+        return self._get('capacity')
+
+    def configure(self, rate, burst=None, owner=None):
+        """
+        set the limit of owner; a rate lowered by slow_down() is kept
+        if it is still lower than the lowest limit
+        """
+        self.owner = owner
+        self.limit = (float(rate), float(burst or max(1, rate)))
+        with self._state() as state:
+            self._touch(state, time())
+
+    def release(self):
+        """ remove the limit of the owner of this bucket (eg: its limit has been disabled) """
+        with self._state(create=False) as state:
+            if state is None:
+                return
+            state['limits'].pop(self.owner, None)
+            self._apply_limits(state, time())
+            if not state['limits']:
+                # no owner left, the state is discarded
+                state.clear()
+
+    def _touch(self, state, now):
+        """ store the limit of this owner, which has just been used, and apply the limits """
+        state['limits'][self.owner] = self.limit + (now,)
+        self._apply_limits(state, now)
+
+    def _apply_limits(self, state, now):
+        """ apply the lowest limit of the owners which sent requests recently """
+        limits = state['limits']
+        for owner, limit in list(limits.items()):
+            # eg: layers deleted or moved to another CitySDK instance
+            if now - limit[2] > self.owner_timeout:
+                del limits[owner]
+        if not limits:
+            return
+        state['max_rate'] = min(limit[0] for limit in limits.values())
+        state['capacity'] = min(limit[1] for limit in limits.values())
+        state['rate'] = min(state['rate'], state['max_rate'])
+        state['tokens'] = min(state['tokens'], state['capacity'])
+
+    def _refill(self, state, now):
+        state['tokens'] = min(state['capacity'], state['tokens'] + (now - state['updated']) * state['rate'])
+        state['updated'] = now
+
+    def acquire(self):
+        """ wait until a request can be sent, returns the seconds waited """
+        waited = 0
+        while True:
+            with self._state() as state:
+                now = time()
+                self._touch(state, now)
+                self._refill(state, now)
+                if now >= state['blocked_until'] and state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return waited
+                wait = max(state['blocked_until'] - now, (1 - state['tokens']) / state['rate'])
+            sleep(wait)
+            waited += wait
+
+    def _slow_down(self, state, retry_after=None):
+        self._refill(state, time())
+        state['rate'] = max(state['max_rate'] * self.min_rate_ratio, state['rate'] / 2)
+        state['tokens'] = min(state['tokens'], 0)
+        if retry_after:
+            state['blocked_until'] = max(state['blocked_until'], time() + retry_after)
+        logger.warning('CitySDK is overloaded, rate limited to %.2f requests per second' % state['rate'])
+
+    def _speed_up(self, state):
+        self._refill(state, time())
+        state['rate'] = min(state['max_rate'], state['rate'] + state['max_rate'] * self.recovery_ratio)
+
+    def slow_down(self, retry_after=None):
+        """ halve the rate, stop sending requests for retry_after seconds if given """
+        with self._state() as state:
+            self._slow_down(state, retry_after)
+
+    def speed_up(self):
+        with self._state() as state:
+            self._speed_up(state)
+
+    def record(self, response, elapsed):
+        """ adapt the rate to the response received after elapsed seconds """
+        with self._state() as state:
+            latency = state['latency']
+            state['latency'] = elapsed if latency is None else (
+                latency * (1 - self.latency_smoothing) + elapsed * self.latency_smoothing
+            )
+
+            if response.status_code in (429, 503):
+                try:
+                    retry_after = float(response.headers.get('Retry-After'))
+                except (TypeError, ValueError):
+                    retry_after = None
+                self._slow_down(state, retry_after)
+            elif latency is not None and elapsed > latency * self.latency_spike_factor:
+                self._slow_down(state)
+            else:
+                self._speed_up(state)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_rate_limiter(key, rate, burst=None, owner=None):
+    """
+    returns the TokenBucket of owner (eg: the primary key of a layer) identified
+    by key (eg: the URL of a CitySDK instance), creating it if necessary;
+    the budget is shared by all the synchronizers which target the same
+    CitySDK instance, the limit is stored again only if owner changed it
+    """
+    limit = (float(rate), float(burst or max(1, rate)))
+    with _buckets_lock:
+        bucket = _buckets.get((key, owner))
+        if bucket is None:
+            bucket = _buckets[(key, owner)] = TokenBucket(key, rate, burst, owner)
+        elif bucket.limit != limit:
+            bucket.configure(rate, burst, owner)
+        return bucket
+
+
+def release_rate_limiter(key, owner):
+    """
+    remove the limit of owner from the budget identified by key,
+    eg: when the rate limit of a layer is disabled; the limits
+    of the other owners apply
+    """
+    with _buckets_lock:
+        _buckets.pop((key, owner), None)
+    TokenBucket(key, owner=owner).release()
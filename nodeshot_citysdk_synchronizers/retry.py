@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+
+import random
+
+import requests
+
+from .settings import CITYSDK_RETRIES, CITYSDK_RETRY_BACKOFF, CITYSDK_RETRY_MAX_BACKOFF
+
+
+class RetryPolicy(object):
+    """
+    Decides whether a request sent to CitySDK should be sent again:
+        * connection errors, timeouts and 408, 429, 502, 503, 504 responses
+          are temporary, any other response is final
+        * each operation (add, change, delete, default) has its own number of retries
+        * waits grow exponentially with full jitter, so that concurrent
+          workers do not retry all at the same time; Retry-After is honoured
+    """
+    RETRIABLE_STATUS = (408, 429, 502, 503, 504)
+    RETRIABLE_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+
+    def __init__(self, retries=None, backoff=CITYSDK_RETRY_BACKOFF, max_backoff=CITYSDK_RETRY_MAX_BACKOFF):
+        self.retries = dict(CITYSDK_RETRIES)
+        self.retries.update(retries or {})
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def max_retries(self, operation):
+        return self.retries.get(operation, self.retries.get('default', 0))
+
+    def is_retriable(self, result):
+        """ result is either a response or the exception raised while sending the request """
+        if isinstance(result, Exception):
+            return isinstance(result, self.RETRIABLE_EXCEPTIONS)
+        return result.status_code in self.RETRIABLE_STATUS
+
+    def delay(self, attempt, result=None):
+        """ seconds to wait before the retry number attempt (starting from 0) """
+        try:
+            return min(self.max_backoff, float(result.headers['Retry-After']))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+
+import threading
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .settings import (CITYSDK_HTTP_POOL_SIZE,
+                       CITYSDK_HTTP_TIMEOUT,
+                       CITYSDK_HTTP_KEEP_ALIVE)
+
+
+class PooledSession(requests.Session):
+    """
+    requests.Session which:
+        * keeps a pool of keep-alive connections for each host
+        * applies a default timeout to every request
+        * keeps track of when the last request has been sent
+    """
+    def __init__(self, pool_size=CITYSDK_HTTP_POOL_SIZE,
+                 timeout=CITYSDK_HTTP_TIMEOUT,
+                 keep_alive=CITYSDK_HTTP_KEEP_ALIVE):
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+        self.last_request_at = None
+        # failed connections are not retried here: CitySdkClient retries failed
+        # requests according to its RetryPolicy, which knows whether a request
+        # which might have reached the server can be sent again
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=0)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        self.last_request_at = time()
+        return super(PooledSession, self).request(method, url, **kwargs)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_pooled_session(key, **kwargs):
+    """
+    returns the PooledSession identified by key, creating it if necessary;
+    the same session (with its cookies, headers and open connections)
+    is shared by all the synchronizer instances of the current process
+    """
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = PooledSession(**kwargs)
+        return session
+
+
+def close_pooled_session(key):
+    """ closes the connections of the session identified by key and forgets it """
+    with _sessions_lock:
+        session = _sessions.pop(key, None)
+    if session is not None:
+        session.close()
+
@@ -19,3 +19,35 @@ setattr(settings, 'NODESHOT_SYNCHRONIZERS', NODESHOT_SYNCHRONIZERS+CITYSDK_SYNCH
 
 CITYSDK_TOURISM_TEST_CONFIG = getattr(settings, 'NODESHOT_CITYSDK_TOURISM_TEST_CONFIG', False)
 CITYSDK_MOBILITY_TEST_CONFIG = getattr(settings, 'NODESHOT_CITYSDK_MOBILITY_TEST_CONFIG', False)
+
+# pooled HTTP sessions used by the CitySDK mixins
+CITYSDK_HTTP_POOL_SIZE = getattr(settings, 'NODESHOT_CITYSDK_HTTP_POOL_SIZE', 10)
+CITYSDK_HTTP_TIMEOUT = getattr(settings, 'NODESHOT_CITYSDK_HTTP_TIMEOUT', 30)
+CITYSDK_HTTP_KEEP_ALIVE = getattr(settings, 'NODESHOT_CITYSDK_HTTP_KEEP_ALIVE', True)
+
+# persistent outbound queue of the operations pushed to CitySDK
+CITYSDK_OUTBOUND_DELAY = getattr(settings, 'NODESHOT_CITYSDK_OUTBOUND_DELAY', 10)
+CITYSDK_OUTBOUND_BATCH_SIZE = getattr(settings, 'NODESHOT_CITYSDK_OUTBOUND_BATCH_SIZE', 500)
+CITYSDK_OUTBOUND_RATE = getattr(settings, 'NODESHOT_CITYSDK_OUTBOUND_RATE', 0)
+CITYSDK_OUTBOUND_MAX_ATTEMPTS = getattr(settings, 'NODESHOT_CITYSDK_OUTBOUND_MAX_ATTEMPTS', 5)
+CITYSDK_OUTBOUND_LOCK_TIMEOUT = getattr(settings, 'NODESHOT_CITYSDK_OUTBOUND_LOCK_TIMEOUT', 3600)
+
+# seconds for which the categories of a CitySDK Tourism instance are cached
+CITYSDK_CATEGORY_CACHE_TTL = getattr(settings, 'NODESHOT_CITYSDK_CATEGORY_CACHE_TTL', 300)
+
+# retries of the requests sent to CitySDK which failed for temporary reasons
+CITYSDK_RETRIES = getattr(settings, 'NODESHOT_CITYSDK_RETRIES', {
+    'add': 3,
+    'change': 3,
+    'delete': 3,
+    'default': 2
+})
+CITYSDK_RETRY_BACKOFF = getattr(settings, 'NODESHOT_CITYSDK_RETRY_BACKOFF', 0.5)
+CITYSDK_RETRY_MAX_BACKOFF = getattr(settings, 'NODESHOT_CITYSDK_RETRY_MAX_BACKOFF', 30)
+
+# metrics of sync runs, see metrics.py
+CITYSDK_METRICS_QUERIES = getattr(settings, 'NODESHOT_CITYSDK_METRICS_QUERIES', False)
+CITYSDK_METRICS_EXPORTER = getattr(settings, 'NODESHOT_CITYSDK_METRICS_EXPORTER', None)
+CITYSDK_METRICS_STATSD_ADDRESS = getattr(settings, 'NODESHOT_CITYSDK_METRICS_STATSD_ADDRESS', ('localhost', 8125))
+CITYSDK_METRICS_STATSD_PREFIX = getattr(settings, 'NODESHOT_CITYSDK_METRICS_STATSD_PREFIX', 'nodeshot.citysdk')
+CITYSDK_METRICS_PROMETHEUS_FILE = getattr(settings, 'NODESHOT_CITYSDK_METRICS_PROMETHEUS_FILE', '/tmp/nodeshot_citysdk')
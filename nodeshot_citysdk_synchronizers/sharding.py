@@ -0,0 +1,230 @@
+from __future__ import absolute_import
+
+import simplejson as json
+
+from celery import chord, current_task
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.exceptions import ValidationError
+from django.utils.translation import ugettext_lazy as _
+
+from nodeshot.core.nodes.models import Node, Status
+
+from .utils import SlugAllocator, record_fingerprint, fingerprint_hit_ratio
+
+from celery.utils.log import get_logger
+logger = get_logger(__name__)
+
+# counters returned by ShardedSyncMixin.save_shard, along with
+# the primary keys of the existing nodes synced by the shard ('pks')
+SHARD_COUNTERS = ('added', 'changed', 'unmodified', 'fingerprint_hits')
+
+
+def split_shards(records, shards):
+    """ split a list of records in up to shards contiguous lists of the same size """
+    size = max(1, -(-len(records) // shards))
+    return [records[i:i + size] for i in range(0, len(records), size)]
+
+
+class ShardedSyncMixin(object):
+    """
+    Splits the features of large GeoJSON feeds in contiguous shards which
+    are compared with the DB and saved by a celery chord: shards are synced
+    in parallel by the sync_shard tasks, then the merge_shards task deletes,
+    by primary key, the nodes which no shard has synced; slugs of all the features
+    are allocated beforehand by the synchronizer which splits the feed.
+    Nodes are saved one by one, so external services still receive them
+    through the post_save signal.
+    """
+    SCHEMA = [
+        {
+            'name': 'sync_shards',
+            'class': 'IntegerField',
+            'kwargs': {
+                'default': 0,
+                'help_text': _('Split the features in this number of shards synced by '
+                               'parallel celery tasks, 0 processes all of them in one loop')
+            }
+        },
+    ]
+
+    def save(self):
+        """ synchronize DB, in shards if enabled """
+        shards = int(self.config.get('sync_shards') or 0)
+        if shards < 2:
+            return super(ShardedSyncMixin, self).save()
+
+        from .tasks import sync_shard, merge_shards
+
+        records = self.shard_records()
+        try:
+            status_id = Status.objects.get(slug=self.config.get('default_status', None)).pk
+        except Status.DoesNotExist:
+            status_id = None
+
+        # primary key and name of the nodes of the layer before the shards run
+        local_nodes = list(Node.objects.filter(layer=self.layer).values_list('pk', 'name'))
+        header = [sync_shard.s(self.layer.pk, shard, status_id) for shard in split_shards(records, shards)]
+        # merge step: deletions need the nodes synced by all the shards
+        merge = merge_shards.s(self.layer.pk, local_nodes, len(records))
+        result = chord(header)(merge)
+
+        # waiting for other tasks inside a worker might exhaust the pool
+        if current_task and not current_task.request.is_eager:
+            self.message = """
+            %s total external records dispatched in %s shards, merged by task %s
+            """ % (len(records), len(header), result.id)
+        else:
+            self.message = result.get()
+
+    def shard_records(self):
+        """ records of the features of the feed, with slugs unique across shards """
+        features = self.parsed_data
+        if isinstance(features, dict):
+            features = features.get('features', [])
+
+        external_nodes_slug = SlugAllocator()
+        records = []
+        for feature in features:
+            record = self.feature_to_record(feature)
+            original_name = record['name']
+            record['name'], record['slug'] = external_nodes_slug.allocate(original_name)
+            if record['name'] != original_name:
+                self.verbose('needed a different name for %s, trying "%s"' % (original_name, record['name']))
+            records.append(record)
+        return records
+
+    def merge_shards(self, results, local_nodes, records_count):
+        """
+        delete the nodes of local_nodes, a list of (primary key, name), which no shard
+        has synced; returns the message of the sync.
+        Nodes are deleted with a single query, pre_delete and post_delete signals are
+        still sent for each node, so records on external services get deleted too
+        """
+        totals = dict((key, sum(result[key] for result in results)) for key in SHARD_COUNTERS)
+        synced = set(pk for result in results for pk in result['pks'])
+        stale_nodes = [(pk, name) for pk, name in local_nodes if pk not in synced]
+
+        if stale_nodes:
+            Node.objects.filter(layer=self.layer, pk__in=[pk for pk, name in stale_nodes]).delete()
+        for pk, name in stale_nodes:
+            self.verbose('node "%s" deleted' % name)
+        deleted_nodes_count = len(stale_nodes)
+
+        return """
+            %s nodes added
+            %s nodes changed
+            %s nodes deleted
+            %s nodes unmodified
+            %s fingerprint hits (%.1f%% of external records)
+            %s total external records processed in %s shards
+            %s total local nodes for this layer
+        """ % (
+            totals['added'],
+            totals['changed'],
+            deleted_nodes_count,
+            totals['unmodified'],
+            totals['fingerprint_hits'],
+            fingerprint_hit_ratio(totals['fingerprint_hits'], records_count),
+            records_count,
+            len(results),
+            Node.objects.filter(layer=self.layer).count()
+        )
+
+    def feature_to_record(self, feature):
+        """
+        JSON serializable fields of the node of a GeoJSON feature,
+        properties are mapped by the parse_item() of the GeoJson synchronizer
+        """
+        item = self.parse_item(feature)
+        return {
+            'name': (item['name'] or '')[0:70],
+            'description': item['description'] or '',
+            'address': item['address'] or '',
+            'elev': item['elev'],
+            'geometry': item['geometry'],
+            'data': dict((key, unicode(value)) for key, value in item['data'].items() if value is not None)
+        }
+
+    def prepare_shard(self):
+        """
+        setup of the synchronizers which sync a shard, in place of before_start():
+        the state of the layer shared by the process (pooled sessions, session
+        tokens, queues of the CitySDK mixins) belongs to the synchronizer which
+        split the feed, which might be running in the same process (eg: with
+        CELERY_ALWAYS_EAGER), and must not be touched; nodes saved by the shard
+        are pushed by the post_save signal, which authenticates when needed
+        """
+        pass
+
+    def save_shard(self, records, status_id):
+        """ compare a shard of records with the nodes of the layer and save the differences """
+        counters = dict((key, 0) for key in SHARD_COUNTERS)
+        counters['pks'] = []
+        local_nodes = dict(
+            (node.slug, node) for node in
+            Node.objects.filter(layer=self.layer, slug__in=[record['slug'] for record in records])
+        )
+
+        for record in records:
+            fingerprint = record_fingerprint(record['name'], record['description'], record['address'],
+                                             record['elev'], record['geometry'], status_id,
+                                             json.dumps(record['data'], sort_keys=True))
+            node = local_nodes.get(record['slug'])
+
+            if node is not None:
+                counters['pks'].append(node.pk)
+
+            # record unchanged since last sync, no need to compare fields
+            if node is not None and node.data and node.data.get('fingerprint') == fingerprint:
+                counters['fingerprint_hits'] += 1
+                counters['unmodified'] += 1
+                continue
+
+            added = node is None
+            if added:
+                node = Node(layer=self.layer, slug=record['slug'])
+
+            data = dict(record['data'], fingerprint=fingerprint)
+            changed = (added or
+                       node.name != record['name'] or
+                       node.description != record['description'] or
+                       node.address != record['address'] or
+                       node.elev != record['elev'] or
+                       (status_id is not None and node.status_id != status_id) or
+                       dict(node.data or {}, fingerprint=None) != dict(data, fingerprint=None) or
+                       not node.geometry.equals(GEOSGeometry(record['geometry'])))
+
+            # unmodified node without a fingerprint yet, store it
+            # without sending post_save, which would push it again
+            if not changed:
+                Node.objects.filter(pk=node.pk).update(data=data)
+                counters['unmodified'] += 1
+                self.verbose('node "%s" unmodified' % node.name)
+                continue
+
+            node.name = record['name']
+            node.description = record['description']
+            node.address = record['address']
+            node.elev = record['elev']
+            node.geometry = GEOSGeometry(record['geometry'])
+            node.data = data
+            if status_id is not None:
+                node.status_id = status_id
+
+            try:
+                node.full_clean()
+            except ValidationError as e:
+                raise Exception("%s errors: %s" % (record['name'], e.messages))
+            node.save()
+
+            if added:
+                counters['added'] += 1
+                self.verbose('new node saved with name "%s"' % node.name)
+            else:
+                counters['changed'] += 1
+                self.verbose('node "%s" updated' % node.name)
+
+        logger.info('shard of %d records synced: %s' % (
+            len(records), ', '.join('%s %d' % (key, counters[key]) for key in SHARD_COUNTERS)
+        ))
+        return counters
@@ -0,0 +1,129 @@
+from __future__ import absolute_import
+
+from time import sleep
+
+from celery import task
+from django.core.cache import cache
+
+from .models import OutboundOperation
+from .settings import (CITYSDK_OUTBOUND_DELAY,
+                       CITYSDK_OUTBOUND_BATCH_SIZE,
+                       CITYSDK_OUTBOUND_RATE,
+                       CITYSDK_OUTBOUND_MAX_ATTEMPTS,
+                       CITYSDK_OUTBOUND_LOCK_TIMEOUT)
+
+from celery.utils.log import get_logger
+logger = get_logger(__name__)
+
+SCHEDULED_KEY = 'citysdk-outbound-scheduled-%s'
+LOCK_KEY = 'citysdk-outbound-lock-%s'
+
+
+def schedule_outbound_drain(layer_id):
+    """
+    schedule a drain of the outbound queue of a layer unless one is already scheduled;
+    operations queued while waiting are coalesced and drained together
+    """
+    if cache.add(SCHEDULED_KEY % layer_id, True, CITYSDK_OUTBOUND_DELAY + 60):
+        drain_outbound_queue.apply_async(args=[layer_id], countdown=CITYSDK_OUTBOUND_DELAY)
+
+
+def pending_operations(layer_id):
+    return OutboundOperation.objects.filter(layer_id=layer_id,
+                                            attempts__lt=CITYSDK_OUTBOUND_MAX_ATTEMPTS)
+
+
+@task
+def drain_outbound_queue(layer_id, limit=CITYSDK_OUTBOUND_BATCH_SIZE):
+    """
+    push the operations in the outbound queue of a layer to its external service;
+    operations are removed from the queue only after being performed,
+    so the operations left by a crashed drain are performed by the next one
+    """
+    from nodeshot.core.layers.models import Layer
+
+    cache.delete(SCHEDULED_KEY % layer_id)
+    # only one drain at a time for each layer
+    if not cache.add(LOCK_KEY % layer_id, True, CITYSDK_OUTBOUND_LOCK_TIMEOUT):
+        return 0
+
+    performed = 0
+    try:
+        synchronizer = Layer.objects.get(pk=layer_id).external.synchronizer
+        synchronizer.prepare_drain()
+        operations = list(pending_operations(layer_id)[0:limit])
+
+        for operation in operations:
+            try:
+                result = operation.perform(synchronizer)
+            except Exception as e:
+                result = False
+                operation.last_error = unicode(e)
+            if result is False:
+                operation.attempts += 1
+                operation.last_error = operation.last_error or 'operation failed'
+                operation.save()
+                logger.error('outbound %s failed (attempt %d)' % (operation, operation.attempts))
+            else:
+                operation.delete()
+                performed += 1
+            if CITYSDK_OUTBOUND_RATE:
+                sleep(1.0 / CITYSDK_OUTBOUND_RATE)
+    finally:
+        cache.delete(LOCK_KEY % layer_id)
+
+    # queue not empty yet, go on with next batch
+    if len(operations) >= limit and pending_operations(layer_id).exists():
+        schedule_outbound_drain(layer_id)
+
+    return performed
+
+
+@task
+def drain_outbound_queues():
+    """
+    drain the outbound queues of all the layers which have pending operations,
+    can be scheduled periodically to resume the drains interrupted by a crash
+    """
+    layers = OutboundOperation.objects.filter(attempts__lt=CITYSDK_OUTBOUND_MAX_ATTEMPTS)\
+                                      .values_list('layer_id', flat=True).distinct()
+    for layer_id in layers:
+        schedule_outbound_drain(layer_id)
+
+
+@task
+def reconcile_external_layer(layer_id):
+    """
+    align the external service of a layer with its nodes,
+    see CitySdkTourismMixin.reconcile
+    """
+    from nodeshot.core.layers.models import Layer
+
+    synchronizer = Layer.objects.get(pk=layer_id).external.synchronizer
+    return synchronizer.reconcile()
+
+
+
+@task
+def sync_shard(layer_id, records, status_id):
+    """
+    sync a shard of the records of a layer with a new synchronizer,
+    see ShardedSyncMixin; returns the counters of the shard
+    """
+    from nodeshot.core.layers.models import Layer
+
+    synchronizer = Layer.objects.get(pk=layer_id).external.synchronizer
+    synchronizer.prepare_shard()
+    return synchronizer.save_shard(records, status_id)
+
+
+@task
+def merge_shards(results, layer_id, local_nodes, records_count):
+    """
+    callback of the chord of sync_shard tasks: delete the nodes
+    which no shard has synced, returns the message of the sync
+    """
+    from nodeshot.core.layers.models import Layer
+
+    synchronizer = Layer.objects.get(pk=layer_id).external.synchronizer
+    return synchronizer.merge_shards(results, local_nodes, records_count)
@@ -1,20 +1,40 @@
 import simplejson as json
 import requests
+import threading
+from collections import OrderedDict, namedtuple
 from datetime import date, timedelta
+from io import BytesIO
 from time import sleep
 
 from django.core import management
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.contrib.gis.geos import Point, GEOSGeometry
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
 
 from nodeshot.core.layers.models import Layer
 from nodeshot.core.base.tests import user_fixtures
 from nodeshot.interop.sync.models import LayerExternal, NodeExternal
-from nodeshot.core.nodes.models import Node
+from nodeshot.interop.sync.synchronizers.base import XmlSynchronizer
+from nodeshot.core.nodes.models import Node, Status
 from nodeshot.interop.sync.tests import capture_output
 
 from nodeshot_citysdk_synchronizers.settings import settings, CITYSDK_TOURISM_TEST_CONFIG, CITYSDK_MOBILITY_TEST_CONFIG
+from nodeshot_citysdk_synchronizers.utils import SlugAllocator, record_fingerprint, loaded_external
+from nodeshot_citysdk_synchronizers.models import OutboundOperation
+from nodeshot_citysdk_synchronizers.payloads import TourismPayloadBuilder
+from nodeshot_citysdk_synchronizers.citysdk_tourism import CategoryIndex, CitySdkTourismMixin, _push_queues
+from nodeshot_citysdk_synchronizers.citysdk_mobility import CitySdkMobilityMixin, _bulk_queues
+from nodeshot_citysdk_synchronizers.client import CitySdkClient, CitySdkError, make_response
+from nodeshot_citysdk_synchronizers.retry import RetryPolicy
+from nodeshot_citysdk_synchronizers.sharding import ShardedSyncMixin, split_shards
+from nodeshot_citysdk_synchronizers.tasks import sync_shard, merge_shards
+from nodeshot_citysdk_synchronizers.metrics import SyncMetrics, StatsdExporter, PrometheusTextExporter
+from nodeshot_citysdk_synchronizers.planning import SyncPlan
+from nodeshot_citysdk_synchronizers.parsers import iter_xml_records, iter_json_array
+from nodeshot_citysdk_synchronizers.provinciawifi import AccessPoint
+from nodeshot_citysdk_synchronizers.ratelimit import TokenBucket, get_rate_limiter, release_rate_limiter
 
 
 TEST_FILES_PATH = '%snodeshot/testing' % settings.STATIC_URL
@@ -77,6 +97,20 @@ class CitySdkSyncTest(TestCase):
         node = Node.objects.get(slug='largo-agostino-gemelli-8-3')
         node = Node.objects.get(slug='largo-agostino-gemelli-8-4')
 
+        ### --- the feed has not changed, nothing should happen --- ###
+
+        output = capture_output(
+            management.call_command,
+            ['sync', 'vienna'],
+            kwargs={ 'verbosity': 0 }
+        )
+
+        self.assertIn('Feed not modified since last sync', output)
+        self.assertEqual(nodes.count(), 5)
+        layer = Layer.objects.get(pk=layer.pk)
+        self.assertEqual(layer.external.config['xml_feed_url'], external.url)
+        self.assertEqual(len(layer.external.config['xml_feed_hash']), 40)
+
         ### --- with the following step we expect some nodes to be deleted and some to be added --- ###
 
         external.url = '%s/provincia-wifi2.xml' % TEST_FILES_PATH
@@ -94,6 +128,7 @@ class CitySdkSyncTest(TestCase):
         self.assertIn('2 nodes unmodified', output)
         self.assertIn('3 nodes deleted', output)
         self.assertIn('0 nodes changed', output)
+        self.assertIn('fingerprint hits', output)
         self.assertIn('3 total external', output)
         self.assertIn('3 total local', output)
 
@@ -107,6 +142,605 @@ class CitySdkSyncTest(TestCase):
         self.assertEqual(node.description, 'Indirizzo: Via G. Pullino 97, Roma; Tipologia: Privati federati')
         point = Point(12.484, 41.8641)
         self.assertTrue(node.geometry.equals(point))
+        self.assertEqual(len(node.data['fingerprint']), 16)
+
+    def test_provinciawifi_plan(self):
+        """ sync plans are computed without side effects and executed later """
+        layer = Layer.objects.external()[0]
+        layer.minimum_distance = 0
+        layer.area = 'POINT (12.0 42.0)'
+        layer.new_nodes_allowed = False
+        layer.save()
+        layer = Layer.objects.get(pk=layer.pk)
+
+        external = LayerExternal(layer=layer)
+        external.synchronizer_path = 'nodeshot_citysdk_synchronizers.ProvinciaWifi'
+        external._reload_schema()
+        external.url = '%s/provincia-wifi.xml' % TEST_FILES_PATH
+        external.full_clean()
+        external.save()
+
+        synchronizer = Layer.objects.get(pk=layer.pk).external.synchronizer
+        plan = synchronizer.preview()
+        self.assertEqual(len(plan.adds), 5)
+        self.assertEqual(plan.records, 5)
+        self.assertEqual(layer.node_set.count(), 0)
+
+        # plans can be stored and executed later
+        plan = SyncPlan.from_dict(json.loads(json.dumps(plan.as_dict())))
+        synchronizer.execute_plan(plan)
+        self.assertEqual(layer.node_set.count(), 5)
+        node = Node.objects.get(slug='viale-di-valle-aurelia-73')
+        self.assertTrue(node.geometry.equals(Point(12.4373, 41.9025)))
+        self.assertEqual(node.data['city'], 'Roma')
+
+        # nothing to do
+        plan = Layer.objects.get(pk=layer.pk).external.synchronizer.preview()
+        self.assertTrue(plan.is_noop)
+        self.assertEqual(plan.fingerprint_hits, 5)
+
+        external.url = '%s/provincia-wifi2.xml' % TEST_FILES_PATH
+        external.full_clean()
+        external.save()
+
+        plan = Layer.objects.get(pk=layer.pk).external.synchronizer.preview()
+        self.assertEqual(len(plan.adds), 1)
+        self.assertEqual(len(plan.changes), 0)
+        self.assertEqual(len(plan.deletes), 3)
+        self.assertEqual(plan.unmodified, 2)
+        self.assertEqual(layer.node_set.count(), 5)
+
+    def test_provinciawifi_default_status(self):
+        """ nodes created in bulk without default_status get the default status """
+        status = Status.objects.all()[0]
+        Status.objects.exclude(pk=status.pk).update(is_default=False)
+        Status.objects.filter(pk=status.pk).update(is_default=True)
+
+        layer = Layer.objects.external()[0]
+        layer.minimum_distance = 0
+        layer.area = 'POINT (12.0 42.0)'
+        layer.new_nodes_allowed = False
+        layer.save()
+
+        external = LayerExternal(layer=layer)
+        external.synchronizer_path = 'nodeshot_citysdk_synchronizers.ProvinciaWifi'
+        external._reload_schema()
+        external.url = '%s/provincia-wifi.xml' % TEST_FILES_PATH
+        external.full_clean()
+        external.save()
+        self.assertFalse((external.config or {}).get('default_status'))
+
+        synchronizer = Layer.objects.get(pk=layer.pk).external.synchronizer
+        self.assertTrue(synchronizer.bulk_create_nodes)
+        synchronizer.execute_plan(synchronizer.preview())
+        self.assertEqual(layer.node_set.count(), 5)
+        self.assertEqual(layer.node_set.exclude(status=status).count(), 0)
+
+    def test_provinciawifi_slug_conflicts(self):
+        """ slugs of nodes of other layers are not reused, slugs taken after planning stop the sync """
+        other_layer_node, late_node = Node.objects.all()[0:2]
+        Node.objects.filter(pk=other_layer_node.pk).update(slug='viale-di-valle-aurelia-73')
+
+        layer = Layer.objects.external()[0]
+        layer.minimum_distance = 0
+        layer.area = 'POINT (12.0 42.0)'
+        layer.new_nodes_allowed = False
+        layer.save()
+
+        external = LayerExternal(layer=layer)
+        external.synchronizer_path = 'nodeshot_citysdk_synchronizers.ProvinciaWifi'
+        external._reload_schema()
+        external.url = '%s/provincia-wifi.xml' % TEST_FILES_PATH
+        external.full_clean()
+        external.save()
+
+        synchronizer = Layer.objects.get(pk=layer.pk).external.synchronizer
+        plan = synchronizer.preview()
+        slugs = [values['slug'] for values in plan.adds]
+        self.assertIn('viale-di-valle-aurelia-73-2', slugs)
+        self.assertNotIn('viale-di-valle-aurelia-73', slugs)
+
+        # another node takes one of the slugs before the plan is executed
+        Node.objects.filter(pk=late_node.pk).update(slug='largo-agostino-gemelli-8')
+        with self.assertRaises(Exception) as context:
+            synchronizer.execute_plan(plan)
+        self.assertIn('slugs already taken by other nodes: largo-agostino-gemelli-8', str(context.exception))
+        self.assertEqual(layer.node_set.count(), 0)
+
+        Node.objects.filter(pk=late_node.pk).update(slug='late-node')
+        synchronizer.execute_plan(plan)
+        self.assertEqual(layer.node_set.count(), 5)
+        self.assertEqual(Node.objects.get(slug='viale-di-valle-aurelia-73').pk, other_layer_node.pk)
+
+    def test_record_fingerprint(self):
+        """ fingerprints of external records """
+        fingerprint = record_fingerprint(u'Via Roma', u'41.9', u'12.4', None)
+        self.assertEqual(len(fingerprint), 16)
+        self.assertEqual(fingerprint, record_fingerprint(u'Via Roma', u'41.9', u'12.4', None))
+        self.assertNotEqual(fingerprint, record_fingerprint(u'Via Roma', u'41.9', u'12.5', None))
+        self.assertNotEqual(fingerprint, record_fingerprint(u'Via Roma', u'41.9', u'12.4', 1))
+
+    def test_iter_xml_records(self):
+        """ missing fields are empty, namespaces are ignored """
+        Record = namedtuple('Record', ['name', 'city'])
+        xml = b"""<?xml version="1.0" encoding="UTF-8"?>
+        <feed xmlns="http://example.com/feed" xmlns:x="http://example.com/x">
+            <header><name>not a record</name></header>
+            <items>
+                <Record><name>Via Roma</name><x:city>Roma</x:city></Record>
+                <x:Record><name>Via Milano</name></x:Record>
+                <Record><city/><name>Via Napoli</name><name>ignored</name></Record>
+            </items>
+        </feed>"""
+        records = list(iter_xml_records(BytesIO(xml), 'Record', Record))
+        self.assertEqual(records, [
+            Record(u'Via Roma', u'Roma'),
+            Record(u'Via Milano', u''),
+            Record(u'Via Napoli', u'')
+        ])
+        self.assertEqual(list(iter_xml_records(BytesIO(b'<feed/>'), 'Record', Record)), [])
+
+    def test_iter_xml_records_memory(self):
+        """ elements are freed as soon as they have been processed """
+        Record = namedtuple('Record', ['name'])
+        count = 5000
+        xml = b'<feed><items>%s</items></feed>' % b''.join(
+            b'<Record><name>record %d</name></Record>' % i for i in range(count)
+        )
+        records = iter_xml_records(BytesIO(xml), 'Record', Record)
+        sizes = []
+        for record in records:
+            # elements still attached to the container of the records
+            sizes.append(len(records.gi_frame.f_locals['parents'][-1]))
+        self.assertEqual(len(sizes), count)
+        self.assertTrue(max(sizes) < count / 5)
+
+    def test_iter_xml_records_provinciawifi(self):
+        """ records are the same parsed by XmlSynchronizer from the whole document """
+        layer = Layer.objects.external()[0]
+        external = LayerExternal(layer=layer)
+        external.synchronizer_path = 'nodeshot_citysdk_synchronizers.ProvinciaWifi'
+        external._reload_schema()
+        external.url = '%s/provincia-wifi.xml' % TEST_FILES_PATH
+        external.full_clean()
+        external.save()
+
+        synchronizer = Layer.objects.get(pk=layer.pk).external.synchronizer
+        synchronizer.data = requests.get(external.url, verify=False).content
+        XmlSynchronizer.parse(synchronizer)
+        expected = [
+            AccessPoint(*[synchronizer.get_text(item, field) for field in AccessPoint._fields])
+            for item in synchronizer.parsed_data.getElementsByTagName('AccessPoint')
+        ]
+
+        records = list(iter_xml_records(BytesIO(synchronizer.data), 'AccessPoint', AccessPoint))
+        self.assertEqual(len(records), 5)
+        self.assertEqual(records, expected)
+
+    def test_iter_json_array(self):
+        """ items are the same whatever the size of the chunks """
+        document = {
+            'type': 'FeatureCollection',
+            'meta': { 'bbox': [[12, 41], [13, { 'nested': [42] }]], 'empty': {} },
+            'features': [
+                { 'id': 12.48, 'velocity': -1.5e-3, 'name': u'Via d\'Aracoeli \u00e8 \u20ac "1" \\ \n',
+                  'active': True, 'address': None },
+                [1, [2, 3]],
+                u'\u4e2d\u6587',
+                1234567890
+            ],
+            'after': [1, 2]
+        }
+        data = json.dumps(document, ensure_ascii=False).encode('utf-8')
+        for size in (1, 2, 3, 7, len(data)):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            self.assertEqual(list(iter_json_array(chunks, 'features')), document['features'])
+
+    def test_iter_json_array_edge_cases(self):
+        """ empty arrays, missing keys, rest of the document and truncated documents """
+        self.assertEqual(list(iter_json_array([b'{"features": []}'], 'features')), [])
+        self.assertEqual(list(iter_json_array([b'{"features": [ ] , "count": 0}'], 'features')), [])
+        self.assertEqual(list(iter_json_array([b'{"other": [1, 2]}'], 'features')), [])
+        self.assertEqual(list(iter_json_array([b'{}'], 'features')), [])
+
+        # the rest of the document is not read
+        def chunks():
+            yield b'{"features": [1, 2], "after": '
+            raise AssertionError('read after the end of the array')
+        self.assertEqual(list(iter_json_array(chunks(), 'features')), [1, 2])
+
+        for truncated in (b'', b'{"feat', b'{"features": [1, 2', b'{"features": [1, 2, ', b'{"features": [{"id": 1}, {"id"'):
+            pieces = [truncated[i:i + 3] for i in range(0, len(truncated), 3)]
+            self.assertRaises(ValueError, list, iter_json_array(pieces, 'features'))
+
+    def test_split_shards(self):
+        """ records are split in contiguous shards of the same size """
+        self.assertEqual(split_shards(range(5), 2), [[0, 1, 2], [3, 4]])
+        self.assertEqual(split_shards(range(2), 4), [[0], [1]])
+        self.assertEqual(split_shards([], 4), [])
+
+    def test_outbound_queue_coalescing(self):
+        """ operations pending for the same record are coalesced """
+        node, node2 = Node.objects.all()[0:2]
+        layer = node.layer
+        NodeExternal.objects.create(node=node2, external_id='ext-2')
+
+        OutboundOperation.objects.push(layer, 'add', node)
+        OutboundOperation.objects.push(layer, 'change', node)
+        OutboundOperation.objects.push(layer, 'change', node)
+        queue = OutboundOperation.objects.filter(layer=layer)
+        self.assertEqual(queue.count(), 1)
+        self.assertEqual(queue[0].operation, 'add')
+
+        # node2 is already present on the external service
+        OutboundOperation.objects.push(layer, 'add', node2)
+        self.assertEqual(queue.get(node_id=node2.pk).operation, 'change')
+        OutboundOperation.objects.push(layer, 'delete', 'ext-2')
+        self.assertEqual(queue.get(node_id=node2.pk).operation, 'delete')
+
+        OutboundOperation.objects.push(layer, 'delete', 'ext-3')
+        self.assertEqual(queue.count(), 3)
+        self.assertEqual(queue.get(external_id='ext-3').node_id, None)
+
+    def test_tourism_payload_builder(self):
+        """ payloads built from the template are the same records built before """
+        builder = TourismPayloadBuilder('poi', 'center', 'it', 'cat', 'http://citysdk/pois/', '100% open')
+        payload = builder.build(41.9, 12.4, u'Via Roma', 'ADR;INTL;PARCEL;WORK:;;Roma;', u'descrizione', u'2014-01-01')
+        self.assertTrue(isinstance(payload, bytes))
+        self.assertEqual(json.loads(payload), {
+            'poi': {
+                'location': {
+                    'point': [{
+                        'Point': {
+                            'posList': '41.9 12.4',
+                            'srsName': 'http://www.opengis.net/def/crs/EPSG/0/4326'
+                        },
+                        'term': 'center'
+                    }],
+                    'address': {
+                        'value': 'BEGIN:VCARD\nN:;Via Roma;;;;\nADR;INTL;PARCEL;WORK:;;Roma;\nEND:VCARD',
+                        'type': 'text/vcard'
+                    }
+                },
+                'label': [{ 'term': 'primary', 'value': 'Via Roma' }],
+                'description': [{ 'value': 'descrizione', 'lang': 'it' }],
+                'category': [{ 'id': 'cat' }],
+                'base': 'http://citysdk/pois/',
+                'lang': 'it',
+                'created': '2014-01-01',
+                'author': { 'term': 'primary', 'value': '100% open' },
+                'license': { 'term': 'primary', 'value': 'open-data' }
+            }
+        })
+        payload = builder.build(41.9, 12.4, u'Via Roma', '', u'', u'2014-01-01', external_id='abc')
+        self.assertEqual(json.loads(payload)['poi']['id'], 'abc')
+
+    def test_category_index(self):
+        """ category lookups are exact """
+        index = CategoryIndex([
+            { 'id': '52a0f1', 'value': 'wifi' },
+            { 'id': '52a0f2', 'value': 'wifi hotspots' }
+        ])
+        self.assertIn('52a0f1', index)
+        self.assertIn('wifi hotspots', index)
+        self.assertNotIn('52a0', index)
+        self.assertNotIn('hotspots', index)
+        self.assertEqual(index['wifi'], '52a0f1')
+        index.add('52a0f3', 'free wifi')
+        self.assertEqual(index['free wifi'], '52a0f3')
+        self.assertFalse(index.expired)
+        self.assertTrue(CategoryIndex([], ttl=-1).expired)
+
+    def test_citysdk_client_decode(self):
+        """ responses are checked and decoded in one place """
+        client = CitySdkClient(('test', 0))
+        response = requests.models.Response()
+        response.status_code = 200
+        response._content = b'{"results": ["token"]}'
+        self.assertEqual(client.decode(response, 'error'), { 'results': ['token'] })
+        response._content = b'not json'
+        self.assertRaises(CitySdkError, client.decode, response, 'error')
+        response.status_code = 502
+        try:
+            client.decode(response, 'error')
+        except CitySdkError as e:
+            self.assertIs(e.response, response)
+        else:
+            self.fail('CitySdkError not raised')
+
+    def test_retry_policy(self):
+        """ temporary failures are retried, retry_check prevents duplicates """
+        policy = RetryPolicy(retries={ 'add': 2 }, backoff=0, max_backoff=0)
+        self.assertTrue(policy.is_retriable(make_response(b'', 502)))
+        self.assertTrue(policy.is_retriable(requests.ConnectionError()))
+        self.assertFalse(policy.is_retriable(make_response(b'', 400)))
+        self.assertFalse(policy.is_retriable(ValueError()))
+        self.assertEqual(policy.max_retries('add'), 2)
+        self.assertTrue(0 <= RetryPolicy(backoff=1, max_backoff=3).delay(5) <= 3)
+        response = make_response(b'', 429)
+        response.headers['Retry-After'] = '2'
+        self.assertEqual(RetryPolicy().delay(0, response), 2)
+
+        client = CitySdkClient(('test', 0), retry_policy=policy)
+        responses = [make_response(b'', 502), make_response(b'', 503), make_response(b'{}')]
+        client._send_authenticated = lambda method, url, **kwargs: responses.pop(0)
+        self.assertEqual(client.request('PUT', 'http://citysdk/', operation='add').status_code, 200)
+        # gives up after the retries allowed for the operation
+        responses = [make_response(b'', 502)] * 4
+        self.assertEqual(client.request('PUT', 'http://citysdk/', operation='add').status_code, 502)
+        self.assertEqual(len(responses), 1)
+        # the record has been created by the first request, it is not sent again
+        responses = [make_response(b'', 504), make_response(b'{}')]
+        response = client.request('PUT', 'http://citysdk/', operation='add',
+                                  retry_check=lambda: make_response(b'{"id": "1"}'))
+        self.assertEqual(response.content, b'{"id": "1"}')
+        self.assertEqual(len(responses), 1)
+        # failed connections are retried by the policy only, not by the pooled session too
+        self.assertEqual(client.http.get_adapter('http://citysdk/').max_retries.total, 0)
+
+    def test_tourism_find_added(self):
+        """ a record created by a failed add is adopted only if it matches the node and has no owner """
+        node, other = Node.objects.all()[0:2]
+        NodeExternal.objects.create(node=other, external_id='owned')
+
+        class Tourism(CitySdkTourismMixin):
+            config = { 'citysdk_category': 'wifi', 'citysdk_type': 'poi' }
+            citysdk_search_url = 'http://citysdk/pois/search'
+            client = CitySdkClient(('test', 0))
+
+            def __init__(self):
+                pass
+
+            def convert_format(self, node):
+                return { 'poi': { 'label': [{ 'value': node.name }],
+                                  'location': { 'point': [{ 'Point': { 'posList': '41.9 12.4' } }] } } }
+
+        def record(external_id, pos_list):
+            return { 'id': external_id, 'label': [{ 'value': node.name }],
+                     'location': { 'point': [{ 'Point': { 'posList': pos_list } }] } }
+
+        records = [record('elsewhere', '42.0 12.5'), record('owned', '41.9 12.4'), record('free', '41.9 12.4')]
+        synchronizer = Tourism()
+        synchronizer.client._send_authenticated = lambda method, url, **kwargs: make_response(
+            json.dumps({ 'poi': records }).encode('utf-8')
+        )
+        self.assertEqual(json.loads(synchronizer._find_added(node).content), { 'id': 'free' })
+        records.pop()
+        self.assertIsNone(synchronizer._find_added(node))
+
+        # the NodeExternal already loaded by the caller is used, the DB is not queried
+        self.assertIsNone(loaded_external(Node.objects.get(pk=other.pk)))
+        self.assertEqual(loaded_external(Node.objects.select_related('external').get(pk=other.pk)).external_id, 'owned')
+
+    def test_mobility_bulk_queue(self):
+        """ a node saved more than once during a bulk import is sent once """
+        node = Node.objects.all()[0]
+
+        class Mobility(CitySdkMobilityMixin):
+            layer = node.layer
+            bulk_size = 10
+
+            def __init__(self):
+                pass
+
+        synchronizer = Mobility()
+        # no import running in this process
+        self.assertFalse(synchronizer._enqueue(node, 'create'))
+
+        _bulk_queues[node.layer.pk] = { 'create': OrderedDict(), 'update': OrderedDict() }
+        try:
+            self.assertTrue(synchronizer._enqueue(node, 'create'))
+            # change() queues a create as long as the node has no NodeExternal
+            self.assertTrue(synchronizer._enqueue(Node.objects.get(pk=node.pk), 'create'))
+            self.assertTrue(synchronizer._enqueue(Node.objects.get(pk=node.pk), 'update'))
+            queue = _bulk_queues[node.layer.pk]
+            self.assertEqual(list(queue['create']), [node.pk])
+            self.assertEqual(len(queue['update']), 0)
+        finally:
+            _bulk_queues.pop(node.layer.pk, None)
+
+    def test_mobility_bulk_queue_failed_import(self):
+        """ the bulk queue is removed and the session token released when an import fails """
+        node = Node.objects.all()[0]
+        queued = []
+        released = []
+
+        class FailingSynchronizer(object):
+            def sync(self):
+                queued.append(node.layer.pk in _bulk_queues)
+                raise ValueError('feed not available')
+
+        class Mobility(CitySdkMobilityMixin, FailingSynchronizer):
+            layer = node.layer
+            bulk_size = 10
+            client = CitySdkClient(('test-mobility', 0))
+
+            def __init__(self):
+                pass
+
+            def release_session(self, session):
+                released.append(session)
+
+        synchronizer = Mobility()
+        synchronizer.http.headers['X-Auth'] = 'token'
+        with self.settings(CELERY_ALWAYS_EAGER=True):
+            self.assertRaises(ValueError, synchronizer.sync)
+        self.assertEqual(queued, [True])
+        self.assertNotIn(node.layer.pk, _bulk_queues)
+        self.assertEqual(released, ['token'])
+        # nodes saved after the import are not queued
+        self.assertFalse(synchronizer._enqueue(node, 'create'))
+
+    def test_tourism_push_queue(self):
+        """ a node saved more than once during a concurrent import is pushed once """
+        node = Node.objects.all()[0]
+
+        class Tourism(CitySdkTourismMixin):
+            layer = node.layer
+
+            def __init__(self):
+                pass
+
+        synchronizer = Tourism()
+        self.assertFalse(synchronizer._enqueue('add', node))
+
+        _push_queues[node.layer.pk] = OrderedDict()
+        try:
+            self.assertTrue(synchronizer._enqueue('add', node))
+            # change() adds the node again as long as it has no NodeExternal
+            self.assertTrue(synchronizer._enqueue('add', Node.objects.get(pk=node.pk)))
+            self.assertTrue(synchronizer._enqueue('change', Node.objects.get(pk=node.pk)))
+            self.assertTrue(synchronizer._enqueue('delete', 'ext-1'))
+            operations = list(_push_queues[node.layer.pk].values())
+            self.assertEqual([operation for operation, obj in operations], ['add', 'delete'])
+            self.assertEqual(operations[0][1].pk, node.pk)
+        finally:
+            _push_queues.pop(node.layer.pk, None)
+
+    def test_tourism_push_queue_failed_import(self):
+        """ the push queue is removed when an import fails """
+        node = Node.objects.all()[0]
+        queued = []
+
+        class FailingSynchronizer(object):
+            def sync(self):
+                queued.append(node.layer.pk in _push_queues)
+                raise ValueError('feed not available')
+
+        class Tourism(CitySdkTourismMixin, FailingSynchronizer):
+            layer = node.layer
+            workers = 4
+            client = CitySdkClient(('test-tourism', 0))
+
+            def __init__(self):
+                pass
+
+        synchronizer = Tourism()
+        with self.settings(CELERY_ALWAYS_EAGER=True):
+            self.assertRaises(ValueError, synchronizer.sync)
+        self.assertEqual(queued, [True])
+        self.assertNotIn(node.layer.pk, _push_queues)
+        # nodes saved after the import are not queued
+        self.assertFalse(synchronizer._enqueue('add', node))
+
+    def test_sync_metrics(self):
+        """ phases, counters and latency histograms of a run """
+        metrics = SyncMetrics('vienna', count_queries=True)
+        with metrics.phase('save'):
+            Node.objects.count()
+            with metrics.phase('add'):
+                Node.objects.count()
+        metrics.observe_request('add', 0.2, sent=100, received=10)
+        metrics.observe_request('add', 20)
+        metrics.finish()
+        report = metrics.as_dict()
+        self.assertEqual(report['phases']['save']['calls'], 1)
+        self.assertEqual(report['phases']['save']['queries'], 2)
+        self.assertEqual(report['phases']['add']['queries'], 1)
+        self.assertEqual(report['counters']['http_bytes_sent'], 100)
+        self.assertEqual(report['latency']['add']['count'], 2)
+        self.assertIn((0.25, 1), report['latency']['add']['buckets'])
+        self.assertEqual(report['latency']['add']['buckets'][-1][1], 2)
+        # report is JSON serializable
+        json.dumps(report)
+
+        lines = PrometheusTextExporter().lines(report)
+        self.assertIn('nodeshot_citysdk_request_seconds_bucket{layer="vienna",operation="add",le="+Inf"} 2', lines)
+        self.assertIn('nodeshot_citysdk_phase_queries{layer="vienna",phase="save"} 2', lines)
+        lines = StatsdExporter(prefix='nodeshot').lines(report)
+        self.assertIn('nodeshot.vienna.add.calls:1|c', lines)
+        self.assertIn('nodeshot.vienna.http_bytes_sent:100|c', lines)
+
+    def test_rate_limiter(self):
+        """ token bucket slows down when CitySDK is overloaded and recovers gradually """
+        bucket = TokenBucket('http://citysdk-overloaded/', 10, burst=3)
+        self.assertEqual([bucket.acquire() for i in range(3)], [0, 0, 0])
+        self.assertTrue(bucket.acquire() > 0)
+
+        response = requests.models.Response()
+        response.status_code = 503
+        bucket.record(response, 0.1)
+        self.assertEqual(bucket.rate, 5)
+
+        response.status_code = 200
+        bucket.record(response, 0.1)
+        self.assertTrue(5 < bucket.rate <= 10)
+        # latency spike
+        bucket.record(response, 5)
+        self.assertTrue(bucket.rate < 5)
+
+        # layers which use the same CitySDK instance share the same budget
+        self.assertIs(get_rate_limiter('http://citysdk/', 10), get_rate_limiter('http://citysdk/', 10))
+
+    def test_rate_limiter_shared(self):
+        """ the budget is kept in the cache and the lowest limit applies """
+        first = get_rate_limiter('http://citysdk-shared/', 10, burst=3, owner=1)
+        # a bucket built by another process
+        second = TokenBucket('http://citysdk-shared/', 10, burst=3, owner=1)
+        self.assertEqual([first.acquire() for i in range(3)], [0, 0, 0])
+        self.assertTrue(second.acquire() > 0)
+
+        # another layer with a lower limit
+        get_rate_limiter('http://citysdk-shared/', 4, owner=2)
+        self.assertEqual(first.max_rate, 4)
+        self.assertEqual(first.capacity, 3)
+
+        # the rate lowered by the server is not reset by the configuration
+        first.slow_down()
+        self.assertEqual(first.rate, 2)
+        get_rate_limiter('http://citysdk-shared/', 20, burst=3, owner=1)
+        get_rate_limiter('http://citysdk-shared/', 4, owner=2)
+        self.assertEqual(second.rate, 2)
+        self.assertEqual(second.max_rate, 4)
+
+    def test_rate_limiter_owners(self):
+        """ limits disabled or not used anymore do not apply to the other owners """
+        first = get_rate_limiter('http://citysdk-owners/', 10, burst=3, owner=1)
+        get_rate_limiter('http://citysdk-owners/', 1, owner=2)
+        self.assertEqual(first.max_rate, 1)
+
+        # the limit of the second layer has been disabled
+        release_rate_limiter('http://citysdk-owners/', 2)
+        self.assertEqual(first.max_rate, 10)
+        self.assertEqual(first.capacity, 3)
+
+        # the second layer has been deleted or moved to another CitySDK instance
+        get_rate_limiter('http://citysdk-owners/', 1, owner=2)
+        self.assertEqual(first.max_rate, 1)
+        first.owner_timeout = 0.1
+        sleep(0.2)
+        first.acquire()
+        self.assertEqual(first.max_rate, 10)
+
+        # nothing left after the last owner is released
+        release_rate_limiter('http://citysdk-owners/', 1)
+        release_rate_limiter('http://citysdk-owners/', 1)
+        self.assertIsNone(cache.get(first.state_key))
+
+    def test_slug_allocator(self):
+        """ SlugAllocator must give the same names given by the old algorithm """
+        allocator = SlugAllocator()
+        names = ['largo agostino gemelli 8'] * 4 + ['largo agostino gemelli 8 - 2', 'Via Roma', 'via roma']
+        results = [allocator.allocate(name) for name in names]
+        self.assertEqual(results, [
+            ('largo agostino gemelli 8', 'largo-agostino-gemelli-8'),
+            ('largo agostino gemelli 8 - 2', 'largo-agostino-gemelli-8-2'),
+            ('largo agostino gemelli 8 - 3', 'largo-agostino-gemelli-8-3'),
+            ('largo agostino gemelli 8 - 4', 'largo-agostino-gemelli-8-4'),
+            ('largo agostino gemelli 8 - 2 - 2', 'largo-agostino-gemelli-8-2-2'),
+            ('Via Roma', 'via-roma'),
+            ('via roma - 2', 'via-roma-2'),
+        ])
+        self.assertIn('via-roma', allocator)
+        self.assertEqual(len(allocator), 7)
+
+    def test_slug_allocator_reserved(self):
+        """ slugs reserved in the DB can be allocated only by the node which owns them """
+        allocator = SlugAllocator(reserved={ 'via-casilina': 2, 'via-casilina-2': 3 })
+        self.assertEqual(allocator.allocate('VIA CASILINA', pk=1), ('VIA CASILINA - 3', 'via-casilina-3'))
+        self.assertEqual(allocator.allocate('VIA CASILINA', pk=2), ('VIA CASILINA', 'via-casilina'))
+        self.assertEqual(allocator.allocate('VIA CASILINA', pk=3), ('VIA CASILINA - 2', 'via-casilina-2'))
+        self.assertEqual(allocator.allocate('VIA CASILINA', pk=4), ('VIA CASILINA - 4', 'via-casilina-4'))
 
     def test_province_rome_traffic(self):
         """ test ProvinceRomeTraffic converter """
@@ -166,6 +800,10 @@ class CitySdkSyncTest(TestCase):
         # ensure last_time_streets_checked is today
         layer = Layer.objects.get(pk=layer.id)
         self.assertEqual(layer.external.config['last_time_streets_checked'], str(date.today()))
+        # validators of the feeds do not overwrite the urls
+        self.assertEqual(layer.external.config['streets_url'], streets_url)
+        self.assertEqual(layer.external.config['streets_feed_url'], streets_url)
+        self.assertEqual(len(layer.external.config['measurements_feed_hash']), 40)
 
         ### --- not much should happen --- ###
 
@@ -177,6 +815,7 @@ class CitySdkSyncTest(TestCase):
 
         # ensure following text is in output
         self.assertIn('Street data not processed', output)
+        self.assertIn('Measurements not modified since last sync', output)
 
         # set last_time_streets_checked to 6 days ago
         layer.external.config['last_time_streets_checked'] = str(date.today() - timedelta(days=6))
@@ -215,6 +854,111 @@ class CitySdkSyncTest(TestCase):
         layer = Layer.objects.get(pk=layer.id)
         self.assertEqual(layer.external.config['last_time_streets_checked'], str(date.today()))
 
+    def _province_rome_traffic_synchronizer(self):
+        layer = Layer.objects.external()[0]
+        layer.minimum_distance = 0
+        layer.area = 'POINT (12.0 42.0)'
+        layer.new_nodes_allowed = False
+        layer.save()
+
+        external = LayerExternal(layer=layer)
+        external.synchronizer_path = 'nodeshot_citysdk_synchronizers.ProvinceRomeTraffic'
+        external._reload_schema()
+        external.config = {
+            "streets_url": '%s/citysdk-wp4-streets.json' % TEST_FILES_PATH,
+            "measurements_url": '%s/citysdk-wp4-measurements.json' % TEST_FILES_PATH,
+            "check_streets_every_n_days": 2
+        }
+        external.full_clean()
+        external.save()
+        return Layer.objects.get(pk=layer.pk).external.synchronizer
+
+    def _street(self, pk, name):
+        """ street segment of the streets file """
+        return {
+            'id': str(pk),
+            'properties': { 'LOCATION': name },
+            'geometry': {
+                'type': 'LineString',
+                'coordinates': [[12.48378, 41.88236 + (pk - 900000) / 10000.0], [12.48390, 41.88206 + (pk - 900000) / 10000.0]]
+            }
+        }
+
+    def test_province_rome_traffic_slug_conflicts(self):
+        """ slugs of other nodes are not reused, slugs taken after planning stop the sync """
+        other_layer_node, late_node = Node.objects.all()[0:2]
+        Node.objects.filter(pk=other_layer_node.pk).update(slug='via-roma')
+        synchronizer = self._province_rome_traffic_synchronizer()
+
+        synchronizer.streets = [self._street(900001, 'VIA ROMA'), self._street(900002, 'VIA MILANO')]
+        plan = synchronizer.plan()
+        self.assertEqual(sorted(values['slug'] for values in plan.adds), ['via-milano', 'via-roma-2'])
+
+        # another node takes one of the slugs before the plan is executed
+        Node.objects.filter(pk=late_node.pk).update(slug='via-milano')
+        with self.assertRaises(Exception) as context:
+            synchronizer.execute_plan(plan)
+        self.assertIn('slugs already taken by other nodes: via-milano', str(context.exception))
+        self.assertFalse(Node.objects.filter(pk__in=[900001, 900002]).exists())
+
+    def test_province_rome_traffic_measurements_chunks(self):
+        """ measurements are stored in chunks, unknown nodes are reported """
+        nodes = list(Node.objects.order_by('pk')[0:3])
+        Node.objects.filter(pk=nodes[0].pk).update(data={ 'keep': 'me' })
+        synchronizer = self._province_rome_traffic_synchronizer()
+        synchronizer.measurements_chunk_size = 2
+
+        synchronizer.measurements = [
+            { 'id': str(node.pk), 'properties': { 'TIMESTAMP': '09-09-2013 22:31:00', 'VELOCITY': '4%d' % i } }
+            for i, node in enumerate(nodes)
+        ] + [
+            { 'id': '999999', 'properties': { 'TIMESTAMP': '09-09-2013 22:31:00', 'VELOCITY': '50' } },
+            # incomplete measurements are skipped
+            { 'id': str(nodes[0].pk), 'properties': {} }
+        ]
+        synchronizer.message = ''
+        synchronizer.process_measurements()
+
+        self.assertIn('Updated measurements of 3 street segments out of 5', synchronizer.message)
+        self.assertIn('Could not retrieve 1 nodes: #999999', synchronizer.message)
+        for i, node in enumerate(nodes):
+            data = Node.objects.get(pk=node.pk).data
+            self.assertEqual(data['last_measurement'], '09-09-2013 22:31:00')
+            self.assertEqual(data['velocity'], '4%d' % i)
+        # other keys of the hstore are kept
+        self.assertEqual(Node.objects.get(pk=nodes[0].pk).data['keep'], 'me')
+
+        # null values are stored as NULL, not as "None"
+        synchronizer.measurements = [
+            { 'id': str(nodes[0].pk), 'properties': { 'TIMESTAMP': '09-09-2013 22:36:00', 'VELOCITY': None } }
+        ]
+        synchronizer.process_measurements()
+        data = Node.objects.get(pk=nodes[0].pk).data
+        self.assertEqual(data['last_measurement'], '09-09-2013 22:36:00')
+        self.assertIsNone(data['velocity'])
+
+    def test_province_rome_traffic_renamed_street(self):
+        """ renamed streets are changed, not deleted """
+        synchronizer = self._province_rome_traffic_synchronizer()
+        layer = synchronizer.layer
+        street = self._street
+
+        synchronizer.streets = [street(900001, 'VIA ROMA'), street(900002, 'VIA ROMA')]
+        synchronizer.process_streets()
+        self.assertIn('2 streets added', synchronizer.message)
+        self.assertEqual(Node.objects.get(pk=900002).slug, 'via-roma-2')
+
+        # the slug of the first street is not in the feed anymore, its node is
+        synchronizer = Layer.objects.get(pk=layer.pk).external.synchronizer
+        synchronizer.streets = [street(900001, 'VIA MILANO'), street(900002, 'VIA ROMA')]
+        synchronizer.process_streets()
+        self.assertIn('0 streets added', synchronizer.message)
+        self.assertIn('1 streets changed', synchronizer.message)
+        self.assertIn('0 streets deleted', synchronizer.message)
+        self.assertEqual(Node.objects.get(pk=900001).slug, 'via-milano')
+        self.assertEqual(Node.objects.get(pk=900002).slug, 'via-roma-2')
+        self.assertEqual(layer.node_set.count(), 2)
+
     def test_openwisp_citysdk_tourism(self):
         layer = Layer.objects.external()[0]
         layer.minimum_distance = 0
@@ -474,6 +1218,147 @@ class CitySdkSyncTest(TestCase):
         data = json.loads(requests.get(CITYSDK_TOURISM_TEST_CONFIG['search_url'], params=querystring_params).content)
         self.assertEqual(len(data['poi']), 0)
 
+    def test_provinciawifi_citysdk_tourism_concurrent(self):
+        layer = Layer.objects.external()[0]
+        layer.minimum_distance = 0
+        layer.area = 'POINT (12.0 42.0)'
+        layer.new_nodes_allowed = False
+        layer.save()
+        layer = Layer.objects.get(pk=layer.pk)
+
+        xml_url = '%s/provincia-wifi.xml' % TEST_FILES_PATH
+
+        external = LayerExternal(layer=layer)
+        external.synchronizer_path = 'nodeshot_citysdk_synchronizers.ProvinciaWifiCitySdkTourism'
+        external._reload_schema()
+        external.config = CITYSDK_TOURISM_TEST_CONFIG.copy()
+        external.config.update({
+            "status": "active",
+            "url": xml_url,
+            "verify_ssl": False,
+            "citysdk_workers": 4
+        })
+        external.full_clean()
+        external.save()
+
+        querystring_params = {
+            'category': CITYSDK_TOURISM_TEST_CONFIG['citysdk_category'],
+            'limit': '-1'
+        }
+
+        output = capture_output(
+            management.call_command,
+            ['sync', 'vienna'],
+            kwargs={ 'verbosity': 0 }
+        )
+
+        # ensure following text is in output
+        self.assertIn('5 nodes added', output)
+        self.assertIn('5 total local', output)
+        # external IDs have been saved from the main thread
+        self.assertEqual(NodeExternal.objects.filter(node__layer=layer).count(), 5)
+
+        sleep(1)
+
+        data = json.loads(requests.get(CITYSDK_TOURISM_TEST_CONFIG['search_url'], params=querystring_params).content)
+        self.assertEqual(len(data['poi']), 5)
+
+        ### --- delete everything --- ###
+
+        for node in layer.node_set.all():
+            node.delete()
+
+        sleep(1)  # wait 1 second
+
+        data = json.loads(requests.get(CITYSDK_TOURISM_TEST_CONFIG['search_url'], params=querystring_params).content)
+        self.assertEqual(len(data['poi']), 0)
+
+    def test_provinciawifi_citysdk_tourism_reconcile(self):
+        layer = Layer.objects.external()[0]
+        layer.minimum_distance = 0
+        layer.area = 'POINT (12.0 42.0)'
+        layer.new_nodes_allowed = False
+        layer.save()
+        layer = Layer.objects.get(pk=layer.pk)
+
+        external = LayerExternal(layer=layer)
+        external.synchronizer_path = 'nodeshot_citysdk_synchronizers.ProvinciaWifiCitySdkTourism'
+        external._reload_schema()
+        external.config = CITYSDK_TOURISM_TEST_CONFIG.copy()
+        external.config.update({
+            "status": "active",
+            "url": '%s/provincia-wifi.xml' % TEST_FILES_PATH,
+            "verify_ssl": False,
+            "citysdk_workers": 4
+        })
+        external.full_clean()
+        external.save()
+
+        querystring_params = {
+            'category': CITYSDK_TOURISM_TEST_CONFIG['citysdk_category'],
+            'limit': '-1'
+        }
+
+        capture_output(
+            management.call_command,
+            ['sync', 'vienna'],
+            kwargs={ 'verbosity': 0 }
+        )
+
+        sleep(1)
+
+        synchronizer = Layer.objects.get(pk=layer.pk).external.synchronizer
+        self.assertEqual(synchronizer.reconcile(), { 'add': 0, 'change': 0, 'delete': 0, 'kept': 0, 'unmodified': 5 })
+
+        # make local DB and CitySDK drift apart
+        node = layer.node_set.all()[0]
+        synchronizer.delete(node.external.external_id)
+        Node.objects.filter(pk=layer.node_set.all()[1].pk).update(name='changed on nodeshot')
+
+        sleep(1)
+
+        self.assertEqual(synchronizer.reconcile(), { 'add': 1, 'change': 1, 'delete': 0, 'kept': 0, 'unmodified': 3 })
+
+        sleep(1)
+
+        data = json.loads(requests.get(CITYSDK_TOURISM_TEST_CONFIG['search_url'], params=querystring_params).content)
+        self.assertEqual(len(data['poi']), 5)
+
+        ### --- records without a node are kept if another layer uses the same category --- ###
+
+        other_layer = Layer.objects.exclude(pk=layer.pk)[0]
+        other_layer.is_external = True
+        other_layer.save()
+        other_external = LayerExternal(layer=other_layer)
+        other_external.synchronizer_path = external.synchronizer_path
+        other_external.config = CITYSDK_TOURISM_TEST_CONFIG.copy()
+        other_external.save(after_save=False)
+
+        node = layer.node_set.all()[0]
+        NodeExternal.objects.filter(node=node).delete()
+        synchronizer = Layer.objects.get(pk=layer.pk).external.synchronizer
+        self.assertEqual(synchronizer.reconcile(), { 'add': 1, 'change': 0, 'delete': 0, 'kept': 1, 'unmodified': 4 })
+
+        sleep(1)
+
+        other_external.delete()
+        self.assertEqual(synchronizer.reconcile(), { 'add': 0, 'change': 0, 'delete': 1, 'kept': 0, 'unmodified': 5 })
+
+        sleep(1)
+
+        data = json.loads(requests.get(CITYSDK_TOURISM_TEST_CONFIG['search_url'], params=querystring_params).content)
+        self.assertEqual(len(data['poi']), 5)
+
+        ### --- delete everything --- ###
+
+        for node in layer.node_set.all():
+            node.delete()
+
+        sleep(1)  # wait 1 second
+
+        data = json.loads(requests.get(CITYSDK_TOURISM_TEST_CONFIG['search_url'], params=querystring_params).content)
+        self.assertEqual(len(data['poi']), 0)
+
     def test_geojson_citysdk_mobility(self):
         layer = Layer.objects.external()[0]
         layer.minimum_distance = 0
@@ -571,6 +1456,117 @@ class CitySdkSyncTest(TestCase):
         data = json.loads(requests.get(citysdk_nodes_url, params=querystring_params, verify=False).content)
         self.assertEqual(len(data['results']), 0)
 
+    def test_geojson_citysdk_mobility_bulk(self):
+        layer = Layer.objects.external()[0]
+        layer.minimum_distance = 0
+        layer.area = 'POINT (12.0 42.0)'
+        layer.new_nodes_allowed = False
+        layer.save()
+        layer = Layer.objects.get(pk=layer.pk)
+
+        url = '%s/geojson1.json' % TEST_FILES_PATH
+
+        external = LayerExternal(layer=layer)
+        external.synchronizer_path = 'nodeshot_citysdk_synchronizers.GeoJsonCitySdkMobility'
+        external._reload_schema()
+        external.config = CITYSDK_MOBILITY_TEST_CONFIG.copy()
+        external.config.update({
+            "url": url,
+            "verify_ssl": False,
+            "citysdk_bulk_size": 500
+        })
+        external.full_clean()
+        external.save()
+
+        querystring_params = {
+            'layer': CITYSDK_MOBILITY_TEST_CONFIG['citysdk_layer'],
+            'per_page': '1000'
+        }
+        citysdk_nodes_url = '%s/nodes' % CITYSDK_MOBILITY_TEST_CONFIG['citysdk_url']
+
+        output = capture_output(
+            management.call_command,
+            ['sync', 'vienna'],
+            kwargs={ 'verbosity': 0 }
+        )
+
+        # ensure following text is in output
+        self.assertIn('2 nodes added', output)
+        self.assertIn('2 total local', output)
+        # both nodes have been sent in one request and NodeExternal rows created
+        self.assertEqual(NodeExternal.objects.filter(node__layer=layer).count(), 2)
+
+        sleep(1)  # wait 1 second
+
+        data = json.loads(requests.get(citysdk_nodes_url, params=querystring_params, verify=False).content)
+        self.assertEqual(len(data['results']), 2)
+
+        ### --- delete everything --- ###
+
+        for node in layer.node_set.all():
+            node.delete()
+
+        sleep(1)  # wait 1 second
+
+        data = json.loads(requests.get(citysdk_nodes_url, params=querystring_params, verify=False).content)
+        self.assertEqual(len(data['results']), 0)
+
+    def test_geojson_citysdk_mobility_sharded(self):
+        layer = Layer.objects.external()[0]
+        layer.minimum_distance = 0
+        layer.area = 'POINT (12.0 42.0)'
+        layer.new_nodes_allowed = False
+        layer.save()
+        layer = Layer.objects.get(pk=layer.pk)
+
+        external = LayerExternal(layer=layer)
+        external.synchronizer_path = 'nodeshot_citysdk_synchronizers.GeoJsonCitySdkMobility'
+        external._reload_schema()
+        external.config = CITYSDK_MOBILITY_TEST_CONFIG.copy()
+        external.config.update({
+            "url": '%s/geojson1.json' % TEST_FILES_PATH,
+            "verify_ssl": False,
+            "sync_shards": 2
+        })
+        external.full_clean()
+        external.save()
+
+        output = capture_output(
+            management.call_command,
+            ['sync', 'vienna'],
+            kwargs={ 'verbosity': 0 }
+        )
+
+        self.assertIn('2 nodes added', output)
+        self.assertIn('2 total external records processed in 2 shards', output)
+        self.assertEqual(NodeExternal.objects.filter(node__layer=layer).count(), 2)
+
+        output = capture_output(
+            management.call_command,
+            ['sync', 'vienna'],
+            kwargs={ 'verbosity': 0 }
+        )
+
+        self.assertIn('2 nodes unmodified', output)
+        self.assertIn('2 fingerprint hits', output)
+
+        ### --- nodes which are not in any shard are deleted by the merge step --- ###
+
+        external.config['url'] = '%s/geojson4.json' % TEST_FILES_PATH
+        external.save()
+
+        output = capture_output(
+            management.call_command,
+            ['sync', 'vienna'],
+            kwargs={ 'verbosity': 0 }
+        )
+
+        self.assertIn('1 nodes deleted', output)
+        self.assertEqual(layer.node_set.count(), 1)
+
+        for node in layer.node_set.all():
+            node.delete()
+
     def test_provinciawifi_citysdk_mobility(self):
         layer = Layer.objects.external()[0]
         layer.minimum_distance = 0
@@ -653,3 +1649,104 @@ class CitySdkSyncTest(TestCase):
 
         data = json.loads(requests.get(citysdk_nodes_url, params=querystring_params, verify=False).content)
         self.assertEqual(len(data['results']), 0)
+
+
+class CitySdkShardingTest(TransactionTestCase):
+    """ shards are committed, so that tasks running in other threads see them """
+    fixtures = [
+        'initial_data.json',
+        user_fixtures,
+        'test_layers.json',
+        'test_status.json',
+        'test_nodes.json'
+    ]
+
+    def test_shards_run_concurrently(self):
+        layer = Layer.objects.external()[0]
+        layer.minimum_distance = 0
+        layer.area = 'POINT (12.0 42.0)'
+        layer.new_nodes_allowed = False
+        layer.save()
+
+        external = LayerExternal(layer=layer)
+        external.synchronizer_path = 'nodeshot_citysdk_synchronizers.GeoJsonCitySdkMobility'
+        external._reload_schema()
+        external.config = CITYSDK_MOBILITY_TEST_CONFIG.copy()
+        external.config.update({
+            "url": '%s/geojson1.json' % TEST_FILES_PATH,
+            "verify_ssl": False,
+            "sync_shards": 2
+        })
+        external.full_clean()
+        external.save()
+
+        synchronizer = Layer.objects.get(pk=layer.pk).external.synchronizer
+        synchronizer.retrieve_data()
+        synchronizer.parse()
+        records = synchronizer.shard_records()
+        shards = split_shards(records, 2)
+        self.assertEqual(len(shards), 2)
+
+        # a shard can complete only after the other one has started
+        started = []
+        all_started = threading.Event()
+        overlapped = []
+        lock = threading.Lock()
+        save_shard = ShardedSyncMixin.__dict__['save_shard']
+
+        def concurrent_save_shard(synchronizer, records, status_id):
+            with lock:
+                started.append(records)
+                if len(started) == len(shards):
+                    all_started.set()
+            overlapped.append(all_started.wait(10))
+            return save_shard(synchronizer, records, status_id)
+
+        results = [None] * len(shards)
+        errors = []
+
+        def run(index):
+            try:
+                results[index] = sync_shard.apply(args=(layer.pk, shards[index], None)).get()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        ShardedSyncMixin.save_shard = concurrent_save_shard
+        try:
+            threads = [threading.Thread(target=run, args=(index,)) for index in range(len(shards))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            ShardedSyncMixin.save_shard = save_shard
+
+        self.assertEqual(errors, [])
+        self.assertEqual(overlapped, [True, True])
+        self.assertEqual(sum(result['added'] for result in results), 2)
+
+        message = merge_shards.apply(args=(results, layer.pk, [], len(records))).get()
+        self.assertIn('2 nodes added', message)
+        self.assertIn('0 nodes deleted', message)
+        self.assertIn('2 total external records processed in 2 shards', message)
+        self.assertEqual(layer.node_set.count(), 2)
+
+        # nodes which no shard has synced are deleted by primary key;
+        # shards do not touch the bulk queue of the run which split the feed
+        local_nodes = list(layer.node_set.values_list('pk', 'name'))
+        queue = _bulk_queues[layer.pk] = { 'create': OrderedDict(), 'update': OrderedDict() }
+        try:
+            results = [sync_shard.apply(args=(layer.pk, shard, None)).get() for shard in shards]
+            self.assertIs(_bulk_queues.get(layer.pk), queue)
+        finally:
+            _bulk_queues.pop(layer.pk, None)
+        self.assertEqual(sorted(pk for result in results for pk in result['pks']),
+                         sorted(pk for pk, name in local_nodes))
+        message = merge_shards.apply(args=(results[0:1], layer.pk, local_nodes, len(shards[0]))).get()
+        self.assertIn('1 nodes deleted', message)
+        self.assertEqual(list(layer.node_set.values_list('pk', flat=True)), results[0]['pks'])
+
+        for node in layer.node_set.all():
+            node.delete()
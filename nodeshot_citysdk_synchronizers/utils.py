@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+
+import hashlib
+
+from django.conf import settings
+from django.template.defaultfilters import slugify
+
+from nodeshot.core.nodes.models import Node
+
+
+class SlugAllocator(object):
+    """
+    Assigns unique slugs to the items of an external feed;
+    items with the same name get a number appended to their name
+    (eg: "name - 2", "name - 3", ...) until their slug is unique.
+
+    Slugs are kept in a set and, for each name, the allocator remembers
+    how many of its candidate slugs have already been taken, so that
+    repeated names do not need to try again all the numbers.
+
+    reserved is an optional dictionary {slug: primary key} of the slugs
+    already present in the DB: a reserved slug can be allocated only
+    to the node which owns it.
+    """
+    def __init__(self, reserved=None):
+        self.slugs = set()
+        self.reserved = reserved or {}
+        self._taken = {}
+
+    def __contains__(self, slug):
+        return slug in self.slugs
+
+    def __len__(self):
+        return len(self.slugs)
+
+    def _candidate(self, name, number):
+        if number > 1:
+            name = "%s - %d" % (name, number)
+        return name, slugify(name)
+
+    def is_taken(self, slug, pk=None):
+        if slug in self.slugs:
+            return True
+        owner = self.reserved.get(slug)
+        return owner is not None and owner != pk
+
+    def allocate(self, name, pk=None):
+        """
+        returns a tuple (name, slug) where slug has not been allocated yet;
+        name differs from the one supplied if a number had to be appended
+        """
+        # candidates up to this number are known to be in self.slugs
+        taken = self._taken.get(name, 0)
+        number = taken
+
+        while True:
+            number = number + 1
+            new_name, slug = self._candidate(name, number)
+            if slug in self.slugs:
+                if number == taken + 1:
+                    taken = number
+            elif not self.is_taken(slug, pk):
+                break
+
+        self.slugs.add(slug)
+
+        if number == taken + 1:
+            taken = number
+        self._taken[name] = taken
+
+        return new_name, slug
+
+
+def pushes_run_in_sync_process():
+    """
+    True if the nodes saved by a sync are pushed to the external layers
+    by the process running the sync, which happens only if celery tasks
+    are executed eagerly: nodeshot pushes them with a celery task
+    """
+    return getattr(settings, 'CELERY_ALWAYS_EAGER', False)
+
+
+def loaded_external(node):
+    """
+    NodeExternal of node if the caller has already loaded it (by accessing
+    node.external or with select_related), None otherwise; never queries the DB
+    """
+    return getattr(node, Node.external.cache_name, None)
+
+
+def record_fingerprint(*values):
+    """
+    returns a compact fingerprint (64 bit hash, hex encoded) of the
+    normalized values of an external record; records with the same
+    fingerprint of the last sync can be skipped without comparing
+    the fields of their nodes one by one
+    """
+    normalized = u'\x1f'.join(u'%s' % value for value in values)
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[0:16]
+
+
+def fingerprint_hit_ratio(hits, total):
+    """ percentage of records skipped thanks to their fingerprint """
+    if not total:
+        return 0.0
+    return 100.0 * hits / total